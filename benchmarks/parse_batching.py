@@ -0,0 +1,68 @@
+'''
+Benchmark of parse.py batching: fixed batch_size slices versus token budget batches.
+Reports token imbalance between batches (largest batch tokens / mean batch tokens) and,
+unless --dry-run is given, parsing speed in sentences/s with the stanza pipeline
+(models must be available locally).
+Run from the repository root:
+python benchmarks/parse_batching.py --file=./data/en-fr/bitext_raw/en-fr.en.txt --lang=en
+'''
+import argparse
+import sys
+import time
+
+sys.path.insert(0, "./up2")
+
+import stanza
+import parse
+from utils import read_config
+
+
+def imbalance(lengths: list, ranges: list) -> float:
+    '''
+    Ratio of the largest batch to the mean batch measured in tokens, workers that get
+    the largest batches finish last
+    '''
+    tokens = [sum(lengths[start:end]) for start, end in ranges]
+    return max(tokens) / (sum(tokens) / len(tokens))
+
+
+def measure(name: str, sentences: list, lengths: list, ranges: list, dry_run: bool):
+    line = f'{name}: batches: {len(ranges)}, imbalance: {imbalance(lengths, ranges):.2f}'
+    if not dry_run:
+        s1 = time.time()
+        for start, end in ranges:
+            parse.parse_documents([stanza.Document([], text=d) for d in sentences[start:end]])
+        s2 = time.time()
+        line += f', time: {s2 - s1:.1f} s, {len(sentences) / (s2 - s1):.1f} sentences/s'
+    print(line)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Parse batching benchmark')
+    parser.add_argument('--file', type=str, required=True)
+    parser.add_argument('--lang', type=str, required=True)
+    parser.add_argument('--sentences', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--batch-tokens', type=int, nargs='+', default=[2000, 5000, 10000])
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--dry-run', action='store_true')
+
+    args = parser.parse_args()
+
+    params = read_config()["params"]
+
+    with open(args.file, "r", encoding="utf-8") as f:
+        sentences = list(filter(None, f.read().split("\n")))[0:args.sentences]
+
+    lengths = [parse.count_tokens(s, args.lang, params) for s in sentences]
+
+    if not args.dry_run:
+        parse.nlp = parse.load_pipeline(args.lang, args.gpu)
+
+    measure(f'batch_size={args.batch_size}', sentences, lengths,
+            parse.get_batch_ranges(lengths, args.batch_size), args.dry_run)
+    for budget in args.batch_tokens:
+        measure(f'batch_size={args.batch_size}, batch_tokens={budget}', sentences, lengths,
+                parse.get_batch_ranges(lengths, args.batch_size, budget), args.dry_run)
@@ -0,0 +1,40 @@
+'''
+Benchmark of parse.py CoNLL-U serialization of parsed stanza documents.
+Compares the original implementation (CoNLL.doc2conll and two passes over every document)
+with the single-pass serializer on documents read from tests/golden/parse.input.conllu.
+Run from the repository root: python benchmarks/parse_serialize.py
+'''
+import argparse
+import sys
+import time
+
+sys.path.insert(0, ".")
+sys.path.insert(0, "./up2")
+
+import parse
+from tests.test_parse import GOLDEN, read_documents, serialize_reference
+
+
+def measure(name: str, fn, documents: list) -> dict:
+    s1 = time.time()
+    result = fn(documents)
+    s2 = time.time()
+    print(f'{name}: {s2 - s1:.3f} s, {len(documents) / (s2 - s1):.0f} sentences/s')
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Parse serialization benchmark')
+    parser.add_argument('--sentences', type=int, default=100000)
+
+    args = parser.parse_args()
+
+    golden = read_documents(GOLDEN + ".input.conllu")
+    documents = [golden[i % len(golden)] for i in range(args.sentences)]
+
+    expected = measure("serialize (reference)", serialize_reference, documents)
+    result = measure("serialize", parse.serialize, documents)
+
+    assert result == expected
@@ -0,0 +1,64 @@
+'''
+Micro-benchmark of preprocess.py sentence normalisation and validation on a synthetic corpus.
+Compares the original repr() based validate_alpha with the precompiled kernel.
+Run from the repository root: python benchmarks/preprocess_validate.py
+'''
+import argparse
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, ".")
+sys.path.insert(0, "./up2")
+
+import preprocess
+from tests.test_preprocess import validate_alpha_reference
+
+WORDS = ["the", "European", "Parliament", "zasadniczo", "věc", "Ελλάδα", "सरकार",
+         "中国", "123", "(", ")", ",", "fiancée", "Straße", "!", "—", "€"]
+
+
+def get_corpus(size: int) -> list:
+    rnd = random.Random(1)
+    corpus = []
+    for i in range(size):
+        words = [rnd.choice(WORDS) for j in range(rnd.randint(3, 40))]
+        if i % 50 == 0:
+            words.append(rnd.choice(["\x07", "�", "​", "\x85"]))
+        if i % 10 == 0:
+            words.append(" \t")
+        corpus.append(" ".join(words))
+    return corpus
+
+
+def measure(name: str, fn, corpus: list) -> list:
+    s1 = time.time()
+    result = fn(corpus)
+    s2 = time.time()
+    print(f'{name}: {s2 - s1:.3f} s, {len(corpus) / (s2 - s1):.0f} sentences/s')
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Preprocess validation benchmark')
+    parser.add_argument('--sentences', type=int, default=200000)
+
+    args = parser.parse_args()
+
+    corpus = get_corpus(args.sentences)
+
+    measure("preprocess_sentence (re.sub)",
+            lambda c: [re.sub(r'\s+', ' ', s) for s in c], corpus)
+    normalised = measure("preprocess_sentence (split/join)",
+                         lambda c: [preprocess.preprocess_sentence(s) for s in c], corpus)
+    expected = measure("validate_alpha (reference)",
+                       lambda c: [validate_alpha_reference(s) for s in c], normalised)
+    result = measure("validate_alpha",
+                     lambda c: [preprocess.validate_alpha(s) for s in c], normalised)
+    bulk = measure("validate_alpha_bulk", preprocess.validate_alpha_bulk, normalised)
+
+    assert result == expected and bulk == expected
+    print(f'Rejected: {expected.count(False)} of {len(expected)}')
@@ -3,9 +3,20 @@ import sys
 
 sys.path.insert(0, "./up2")
 
+import tests.test_fetch
 import tests.test_download
+import tests.test_dedup
 import tests.test_preprocess
+import tests.test_checkpoint
+import tests.test_batch_queue
 import tests.test_parse
+import tests.test_prefilter
+import tests.test_parse_cache
+import tests.test_batch_metrics
+import tests.test_cpu_planner
+import tests.test_quantization
+import tests.test_pipeline_cache
+import tests.test_service
 import tests.test_merge_parse
 import tests.test_wordalignment
 import tests.test_merge_align
@@ -17,9 +28,20 @@ loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 
 #steps before SPADE
+suite.addTests(loader.loadTestsFromModule(tests.test_fetch))
 suite.addTests(loader.loadTestsFromModule(tests.test_download))
+suite.addTests(loader.loadTestsFromModule(tests.test_dedup))
 suite.addTests(loader.loadTestsFromModule(tests.test_preprocess))
+suite.addTests(loader.loadTestsFromModule(tests.test_checkpoint))
+suite.addTests(loader.loadTestsFromModule(tests.test_batch_queue))
 suite.addTests(loader.loadTestsFromModule(tests.test_parse))
+suite.addTests(loader.loadTestsFromModule(tests.test_prefilter))
+suite.addTests(loader.loadTestsFromModule(tests.test_parse_cache))
+suite.addTests(loader.loadTestsFromModule(tests.test_batch_metrics))
+suite.addTests(loader.loadTestsFromModule(tests.test_cpu_planner))
+suite.addTests(loader.loadTestsFromModule(tests.test_quantization))
+suite.addTests(loader.loadTestsFromModule(tests.test_pipeline_cache))
+suite.addTests(loader.loadTestsFromModule(tests.test_service))
 suite.addTests(loader.loadTestsFromModule(tests.test_merge_parse))
 suite.addTests(loader.loadTestsFromModule(tests.test_wordalignment))
 suite.addTests(loader.loadTestsFromModule(tests.test_merge_align))
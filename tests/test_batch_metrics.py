@@ -0,0 +1,64 @@
+import unittest
+import os
+import tempfile
+from up2 import batch_metrics
+
+
+def record(index, sentences, words, seconds, finished):
+    return {
+        "index": index,
+        "sentences": sentences,
+        "parsed": sentences,
+        "words": words,
+        "seconds": seconds,
+        "processors": {"tokenize": seconds / 4, "depparse": seconds / 2},
+        "rss_mb": 100.0 * index,
+        "device": "cpu",
+        "finished": finished
+    }
+
+
+class TestBatchMetrics(unittest.TestCase):
+
+    def setUp(self):
+        # metrics files are written into ./data of a temporary working directory
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+
+    def test_run(self):
+        self.assertEqual(batch_metrics.percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(batch_metrics.percentile([5, 1, 4, 2, 3], 90), 5)
+        self.assertEqual(batch_metrics.percentile([5, 1, 4, 2, 3], 0), 1)
+        file = batch_metrics.get_metrics_file("en-test-metrics", "en", 1, 2)
+        self.assertTrue(file.endswith("/parsed/en-test-metrics.en.metrics.shard-1-of-2.jsonl"))
+        writer = batch_metrics.MetricsWriter(file)
+        writer.write(record(1, 10, 100, 2.0, 102.0))
+        writer.write(record(2, 10, 300, 1.0, 104.0))
+        writer.close()
+        writer = batch_metrics.MetricsWriter(batch_metrics.get_metrics_file("en-test-metrics", "en", 0, 2))
+        writer.write(record(3, 20, 200, 4.0, 104.0))
+        writer.close()
+        records = batch_metrics.read_metrics("en-test-metrics", "en")
+        self.assertEqual([r["index"] for r in records], [1, 2, 3])
+        lines = batch_metrics.summary(records)
+        self.assertIn("sentences: 40", lines[0])
+        self.assertIn("time: 4.0 s, 10.0 sentences/s, 150.0 words/s", lines[0])
+        self.assertEqual(lines[1], "Batch time p50/p90/p99/max: 2.00 / 4.00 / 4.00 / 4.00 s")
+        self.assertEqual(lines[2], "Batch throughput p50/p10/p1/min: 50.0 / 50.0 / 50.0 / 50.0 words/s")
+        self.assertIn("depparse: 3.5 s (50%)", lines[3])
+        self.assertIn("Max RSS: 300 MB", lines[4])
+
+    def test_attack(self):
+        self.assertEqual(batch_metrics.summary([]), ["Batch metrics: no batches"])
+        writer = batch_metrics.MetricsWriter(batch_metrics.get_metrics_file("en-test-metrics", "en"))
+        writer.write(record(1, 0, 0, 0.0, 100.0))
+        writer.file.write('{"index": 2, "sente')
+        writer.close()
+        records = batch_metrics.read_metrics("en-test-metrics", "en")
+        self.assertEqual(len(records), 1)
+        self.assertIn("0.0 sentences/s", batch_metrics.summary(records)[0])
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.dir.cleanup()
@@ -0,0 +1,129 @@
+import unittest
+import tempfile
+import time
+from multiprocessing import Pool
+from up2 import batch_queue
+
+
+def square(batch):
+    return {"index": batch["index"], "data": [x * x for x in batch["data"]]}
+
+
+class TestBatchQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name + "/checkpoint/parse.en.queue.sqlite"
+        self.ranges = [(0, 3), (3, 6), (6, 8)]
+
+    def test_run(self):
+        data = list(range(8))
+        results = {}
+        queue = batch_queue.BatchQueue(self.path)
+        queue.add(self.ranges)
+        # the second job adds the same batches
+        batch_queue.BatchQueue(self.path).add(self.ranges)
+        with Pool(2) as pool:
+            batch_queue.drain(queue, "job-1", lambda i, s, e: {"index": i, "data": data[s:e]},
+                              square, lambda r: results.update({r["index"]: r["data"]}), pool, 2, 0.1)
+        self.assertEqual(results, {1: [0, 1, 4], 2: [9, 16, 25], 3: [36, 49]})
+        self.assertEqual(queue.counts(), {"done": 3})
+        self.assertIsNone(queue.acquire("job-2"))
+        self.assertIsNone(queue.wait_time())
+        queue.close()
+
+    def test_lease(self):
+        queue = batch_queue.BatchQueue(self.path, lease=0.2)
+        queue.add(self.ranges)
+        self.assertEqual(queue.acquire("job-1"), (1, 0, 3))
+        self.assertEqual(queue.acquire("job-2"), (2, 3, 6))
+        queue.complete(2, "job-2")
+        self.assertEqual(queue.acquire("job-2"), (3, 6, 8))
+        queue.complete(3, "job-2")
+        self.assertIsNone(queue.acquire("job-2"))
+        # job-1 crashed, its batch is taken after the lease expires
+        time.sleep(0.3)
+        self.assertEqual(queue.acquire("job-2"), (1, 0, 3))
+        # late result of job-1 is ignored
+        self.assertFalse(queue.hold(1, "job-1"))
+        self.assertTrue(queue.hold(1, "job-2"))
+        queue.complete(1, "job-1")
+        self.assertEqual(queue.counts(), {"done": 2, "leased": 1})
+        queue.complete(1, "job-2")
+        self.assertEqual(queue.counts(), {"done": 3})
+        queue.close()
+
+    def test_retry(self):
+        queue = batch_queue.BatchQueue(self.path, retries=2, backoff=0.1)
+        queue.add(self.ranges[:1])
+        attempts = []
+
+        def fail(batch):
+            attempts.append(time.time())
+            raise Exception("out of memory")
+
+        with self.assertRaises(Exception):
+            batch_queue.drain(queue, "job-1", lambda i, s, e: {"index": i}, fail, None, poll=0.05)
+        self.assertEqual(len(attempts), 2)
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.1)
+        self.assertEqual(queue.counts(), {"failed": 1})
+        # the next job retries failed batches
+        queue.add(self.ranges[:1])
+        self.assertEqual(queue.counts(), {"pending": 1})
+        queue.close()
+
+    def test_expired(self):
+        queue = batch_queue.BatchQueue(self.path, lease=0.1)
+        queue.add(self.ranges[:1])
+        results = []
+        calls = []
+
+        def slow(batch):
+            calls.append(batch["index"])
+            if len(calls) == 1:
+                # job-1 was suspended longer than the lease, job-2 took the batch and crashed
+                queue.connection.execute(
+                    "UPDATE batches SET owner = 'job-2', lease_until = ?, attempts = attempts + 1",
+                    (time.time() + 0.1,))
+            return batch
+
+        batch_queue.drain(queue, "job-1", lambda i, s, e: {"index": i}, slow, results.append, poll=0.05)
+        # the result of the lost lease is dropped, the batch is taken again after job-2 lease expired
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(results, [{"index": 1}])
+        self.assertEqual(queue.counts(), {"done": 1})
+        queue.close()
+
+    def test_serial_lease(self):
+        queue = batch_queue.BatchQueue(self.path, lease=0.3)
+        created = []
+        queue.add(self.ranges[:1], lambda: created.append(True))
+        queue.add(self.ranges[:1], lambda: created.append(True))
+        self.assertEqual(created, [True])
+        results = []
+
+        def slow(batch):
+            # batch processed in the main process takes longer than the lease
+            for i in range(4):
+                time.sleep(0.25)
+                self.assertIsNone(other.acquire("job-2"))
+            return batch
+
+        other = batch_queue.BatchQueue(self.path, lease=0.3)
+        batch_queue.drain(queue, "job-1", lambda i, s, e: {"index": i}, slow, results.append, poll=0.05)
+        self.assertEqual(results, [{"index": 1}])
+        self.assertEqual(queue.counts(), {"done": 1})
+        other.close()
+        queue.close()
+
+    def test_attack(self):
+        queue = batch_queue.BatchQueue(self.path)
+        queue.add(self.ranges)
+        # queue created for different batches must not be drained
+        with self.assertRaises(Exception):
+            queue.add([(0, 4), (4, 8)])
+        self.assertEqual(queue.counts(), {"pending": 3})
+        queue.close()
+
+    def tearDown(self):
+        self.dir.cleanup()
@@ -0,0 +1,111 @@
+import unittest
+import os
+import tempfile
+from up2 import checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.manifest = self.dir.name + "/checkpoint/parse.en.jsonl"
+
+    def test_run(self):
+        file = checkpoint.write_file(self.dir.name + "/batch.0001.txt", "a|||b\nc")
+        self.assertEqual(file["size"], 7)
+        self.assertFalse(os.path.exists(self.dir.name + "/batch.0001.txt.tmp"))
+        manifest = checkpoint.Checkpoint(self.manifest)
+        self.assertFalse(manifest.verified(1, 0, 2))
+        manifest.record(1, 0, 2, [file], 2)
+        manifest.close()
+        manifest = checkpoint.Checkpoint(self.manifest)
+        self.assertTrue(manifest.verified(1, 0, 2))
+        self.assertFalse(manifest.verified(1, 0, 3))
+        self.assertFalse(manifest.verified(2, 2, 2))
+        manifest.close()
+
+    def test_shards(self):
+        self.assertEqual([i for i in range(1, 8) if checkpoint.in_shard(i, 1, 3)], [2, 5])
+        folder = self.dir.name + "/checkpoint"
+        files = [checkpoint.write_file(self.dir.name + "/batch." + str(i), "x" * i) for i in range(4)]
+        for shard in range(2):
+            manifest = checkpoint.Checkpoint(checkpoint.get_manifest(folder, "align", shard, 2))
+            for i in range(1, 4):
+                if checkpoint.in_shard(i, shard, 2):
+                    manifest.record(i, (i - 1) * 10, 10, [files[i]], 3)
+            manifest.close()
+        batches = checkpoint.read_manifests(folder, "align")
+        self.assertEqual(sorted(batches), [1, 2, 3])
+        self.assertEqual(checkpoint.check_batches(batches), [])
+        del batches[2]
+        self.assertEqual(checkpoint.check_batches(batches), ["Missing batches: [2]"])
+        batches = checkpoint.read_manifests(folder, "align")
+        batches[3]["start"] = 25
+        self.assertEqual(len(checkpoint.check_batches(batches)), 1)
+        self.assertEqual(checkpoint.check_batches({}), ["No batches in the manifest"])
+
+    def test_runs(self):
+        folder = self.dir.name + "/checkpoint"
+        files = [checkpoint.write_file(self.dir.name + "/batch." + str(i), "x" * i) for i in range(4)]
+        first = checkpoint.get_run([(0, 10), (10, 20), (20, 30)])
+        second = checkpoint.get_run([(0, 15), (15, 30)])
+        self.assertNotEqual(first, second)
+        self.assertEqual(first, checkpoint.get_run([[0, 10], [10, 20], [20, 30]]))
+        for shard in range(2):
+            manifest = checkpoint.Checkpoint(checkpoint.get_manifest(folder, "align", shard, 2), first)
+            for i in range(1, 4):
+                if checkpoint.in_shard(i, shard, 2):
+                    manifest.record(i, (i - 1) * 10, 10, [files[i]], 3)
+            manifest.close()
+        # batch_size changed, the job runs without shards
+        manifest = checkpoint.Checkpoint(checkpoint.get_manifest(folder, "align"), second)
+        manifest.record(1, 0, 15, [files[1]], 2)
+        manifest.record(2, 15, 15, [files[2]], 2)
+        manifest.close()
+        batches = checkpoint.read_manifests(folder, "align")
+        self.assertEqual([(i, e["sentences"]) for i, e in sorted(batches.items())], [(1, 15), (2, 15)])
+        self.assertEqual(checkpoint.check_batches(batches), [])
+        # the newest entry of a batch is used, also from a manifest read earlier
+        manifest = checkpoint.Checkpoint(checkpoint.get_manifest(folder, "align", 1, 2), second)
+        self.assertFalse(manifest.verified(2, 10, 10))
+        manifest.record(2, 15, 15, [files[3]], 2)
+        manifest.close()
+        batches = checkpoint.read_manifests(folder, "align")
+        self.assertEqual(batches[2]["files"], [files[3]])
+        # entries of the earlier run are removed from the manifest of the shard
+        self.assertEqual(sorted(checkpoint.read_manifest(checkpoint.get_manifest(folder, "align", 1, 2))), [2])
+        manifest = checkpoint.Checkpoint(checkpoint.get_manifest(folder, "align", 0, 2), second)
+        self.assertEqual(manifest.batches, {})
+        manifest.close()
+
+    def test_remove_queue(self):
+        folder = self.dir.name + "/checkpoint"
+        for owner in ["host-1", "host-2"]:
+            checkpoint.Checkpoint(checkpoint.get_manifest(folder, "parse.en", owner=owner)).close()
+        checkpoint.Checkpoint(checkpoint.get_manifest(folder, "parse.pl", owner="host-1")).close()
+        checkpoint.Checkpoint(checkpoint.get_manifest(folder, "parse.en", 0, 2)).close()
+        self.assertEqual(checkpoint.remove_queue_manifests(checkpoint.get_manifest(folder, "parse.en")), 2)
+        self.assertEqual(sorted(os.listdir(folder)), ["parse.en.shard-0-of-2.jsonl", "parse.pl.queue-host-1.jsonl"])
+
+    def test_attack(self):
+        file = checkpoint.write_file(self.dir.name + "/batch.0001.txt", "a|||b\nc")
+        manifest = checkpoint.Checkpoint(self.manifest)
+        manifest.record(1, 0, 2, [file], 2)
+        manifest.close()
+        # interrupted manifest write
+        with open(self.manifest, "a", encoding="utf-8") as f:
+            f.write('{"index": 2, "start": 2, "sent')
+        # truncated batch file
+        with open(file["path"], "w", encoding="utf-8") as f:
+            f.write("a|||b\n")
+        manifest = checkpoint.Checkpoint(self.manifest)
+        self.assertFalse(manifest.verified(1, 0, 2))
+        self.assertFalse(manifest.verified(2, 2, 2))
+        # same size, different content
+        with open(file["path"], "w", encoding="utf-8") as f:
+            f.write("a|||x\nc")
+        self.assertFalse(manifest.verified(1, 0, 2))
+        manifest.close()
+
+    def tearDown(self):
+        self.dir.cleanup()
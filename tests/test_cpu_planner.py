@@ -0,0 +1,51 @@
+import unittest
+import json
+import shutil
+import tempfile
+import torch
+from up2 import cpu_planner
+
+PARAMS = {"processes": 2, "gpu": False, "cpu_threads": 0, "cpu_pinning": True}
+
+
+class TestCpuPlanner(unittest.TestCase):
+
+    def test_run(self):
+        self.assertGreater(len(cpu_planner.available_cpus()), 0)
+        plan = cpu_planner.get_plan(PARAMS, cpus=[0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual((plan["processes"], plan["threads"]), (2, 3))
+        self.assertEqual(plan["cores"], [[0, 1, 2], [3, 4, 5]])
+        plan = cpu_planner.get_plan(dict(PARAMS, cpu_pinning=False), 4, cpus=list(range(8)))
+        self.assertEqual((plan["threads"], plan["cores"]), (2, None))
+        plan = cpu_planner.get_plan(dict(PARAMS, gpu=True), cpus=list(range(8)))
+        self.assertIsNone(plan["threads"])
+        self.assertEqual(cpu_planner.get_configurations(12), [(1, 12), (2, 6), (4, 3), (8, 1), (12, 1)])
+        self.assertEqual(cpu_planner.get_configurations(8, 2), [(1, 8), (2, 4)])
+        threads = torch.get_num_threads()
+        cpu_planner.apply_plan({"threads": 1, "cores": None}, 0)
+        self.assertEqual(torch.get_num_threads(), 1)
+        torch.set_num_threads(threads)
+
+    def test_update_params(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = folder + "/config.json"
+            shutil.copy("./config/config.json", path)
+            cpu_planner.update_params({"processes": 3, "cpu_threads": 2}, path)
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            config = json.loads(text)
+            self.assertEqual((config["params"]["processes"], config["params"]["cpu_threads"]), (3, 2))
+            self.assertEqual(config["download"]["processes"], 4)
+            self.assertIn('"excluded_tokens_validation": ["zh", "ja"]', text)
+
+    def test_attack(self):
+        with self.assertRaises(Exception):
+            cpu_planner.get_plan(dict(PARAMS, cpu_threads=-1), cpus=[0])
+        # more processes than cores, workers are not pinned
+        plan = cpu_planner.get_plan(dict(PARAMS, processes=4), cpus=[0, 1])
+        self.assertEqual((plan["threads"], plan["cores"]), (1, None))
+        with tempfile.TemporaryDirectory() as folder:
+            path = folder + "/config.json"
+            shutil.copy("./config/config.json", path)
+            with self.assertRaises(Exception):
+                cpu_planner.update_params({"unknown": 1}, path)
@@ -0,0 +1,62 @@
+import unittest
+import os
+import tempfile
+from up2 import dedup
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def check_store(self, store):
+        self.assertTrue(store.add("This is a sentence ."))
+        self.assertTrue(store.add("This is another sentence ."))
+        self.assertFalse(store.add("This is a sentence ."))
+        self.assertIn("This is another sentence .", store)
+        self.assertNotIn("This is a new sentence .", store)
+        self.assertEqual(len(store), 2)
+        self.assertGreater(store.memory(), 0)
+        self.assertIn("digests: 2", dedup.summary(store))
+
+    def test_run(self):
+        for bits in [64, 128]:
+            params = {"dedup_store": "memory", "dedup_bits": bits}
+            store = dedup.create_store(params, self.dir.name)
+            self.check_store(store)
+            store.close()
+
+    def test_memory(self):
+        for bits in [64, 128]:
+            store = dedup.MemoryStore(bits, capacity=8)
+            sentences = [f'Sentence number {i} .' for i in range(5000)]
+            for sentence in sentences:
+                self.assertTrue(store.add(sentence))
+            # the table is resized and all digests are kept
+            for sentence in sentences:
+                self.assertFalse(store.add(sentence))
+                self.assertIn(sentence, store)
+            self.assertNotIn("Sentence number 5000 .", store)
+            self.assertEqual(len(store), 5000)
+            self.assertLessEqual(store.memory() / len(store), 3 * bits / 8)
+            store.close()
+
+    def test_sqlite(self):
+        params = {"dedup_store": "sqlite", "dedup_bits": 128}
+        store = dedup.create_store(params, self.dir.name)
+        self.check_store(store)
+        store.close()
+        self.assertFalse(os.path.exists(self.dir.name + "/dedup.sqlite"))
+
+    def test_estimates(self):
+        self.assertLess(dedup.expected_collisions(50000000, 64), 1e-3)
+        self.assertLess(dedup.false_positive_rate(50000000, 64), 1e-11)
+
+    def test_attack(self):
+        with self.assertRaises(Exception):
+            dedup.create_store({"dedup_store": "memory", "dedup_bits": 32}, self.dir.name)
+        with self.assertRaises(Exception):
+            dedup.create_store({"dedup_store": "redis", "dedup_bits": 64}, self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
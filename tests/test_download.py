@@ -1,4 +1,6 @@
 import unittest
+import io
+import zipfile
 from up2 import download
 
 
@@ -10,6 +12,30 @@ class TestDownload(unittest.TestCase):
     def test_run(self):
         download.download("en-test")
 
+    def test_host_limits(self):
+        config = {"download": {"hosts": {"default": 2, "a.org": 4}}}
+        limits = download.get_host_limits(
+            config, ["https://a.org/x.zip", "https://a.org/y.zip", "https://b.org/z.zip"])
+        self.assertEqual(set(limits), {"a.org", "b.org"})
+        for i in range(4):
+            self.assertTrue(limits["a.org"].acquire(blocking=False))
+        self.assertFalse(limits["a.org"].acquire(blocking=False))
+        for i in range(2):
+            self.assertTrue(limits["b.org"].acquire(blocking=False))
+        self.assertFalse(limits["b.org"].acquire(blocking=False))
+
+    def test_members(self):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, "w") as zip:
+            for name in ["en-zh_cn.en", "en-zh_cn.zh_cn", "en-zh_cn.ids", "README"]:
+                zip.writestr("OpenSubtitles." + name, "")
+        with zipfile.ZipFile(data, "r") as zip:
+            members = download.get_members(zip, ["en", "zh"])
+        self.assertEqual(members, {
+            "OpenSubtitles.en-zh_cn.en": "OpenSubtitles.en-zh.en",
+            "OpenSubtitles.en-zh_cn.zh_cn": "OpenSubtitles.en-zh.zh"
+        })
+
     def test_attack(self):
         pass
 
@@ -0,0 +1,188 @@
+import unittest
+import os
+import tempfile
+import threading
+import hashlib
+import importlib
+import time
+import requests
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from up2 import fetch
+
+download_ud = importlib.import_module("up2.other.download-ud")
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+ETAG = '"' + hashlib.md5(DATA).hexdigest() + '"'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in for the OPUS object storage: serves DATA with Range support and
+    drops the connection in the middle of the first `drops` responses
+    '''
+    drops = 0
+    ranges = []
+
+    def do_GET(self):
+        start = 0
+        header = self.headers.get("Range")
+        RangeHandler.ranges.append(header)
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if header:
+            start = int(header.split("=")[1].split("-")[0])
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header("Content-Range", f'bytes */{len(DATA)}')
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             f'bytes {start}-{len(DATA) - 1}/{len(DATA)}')
+        else:
+            self.send_response(200)
+        body = DATA[start:]
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if RangeHandler.drops > 0:
+            RangeHandler.drops -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TreebankHandler(RangeHandler):
+    '''
+    Stand-in for the universal-dependencies treebank page linking conllu files,
+    the files are served by RangeHandler
+    '''
+
+    def do_GET(self):
+        if self.path == "/stall":
+            time.sleep(2)
+        if self.path in ("/treebank", "/stall"):
+            body = ('<a href="/ud/blob/master/en_test-ud-train.conllu">train</a>'
+                    '<a href="/ud/blob/master/en_test-ud-test.conllu">test</a>').encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        super().do_GET()
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        RangeHandler.drops = 0
+        RangeHandler.ranges = []
+        self.server = HTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/data.zip'
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "data.zip")
+
+    def test_run(self):
+        result = fetch.stream_download(self.url, self.path, chunk_size=64 * 1024)
+        self.assertTrue(result["modified"])
+        self.assertEqual(result["size"], len(DATA))
+        self.assertEqual(result["etag"], ETAG)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+    def test_resume(self):
+        RangeHandler.drops = 2
+        fetch.stream_download(self.url, self.path, chunk_size=64 * 1024, backoff=0)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertIsNone(RangeHandler.ranges[0])
+        self.assertTrue(RangeHandler.ranges[1].startswith("bytes="))
+        self.assertEqual(len(RangeHandler.ranges), 3)
+
+    def test_complete_part(self):
+        with open(self.path + ".part", "wb") as f:
+            f.write(DATA)
+        fetch.stream_download(self.url, self.path, backoff=0)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+
+    def test_not_modified(self):
+        result = fetch.stream_download(self.url, self.path, validators={"etag": ETAG})
+        self.assertFalse(result["modified"])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_sha256(self):
+        fetch.stream_download(self.url, self.path)
+        self.assertEqual(fetch.file_sha256(self.path, 1000),
+                         hashlib.sha256(DATA).hexdigest())
+
+    def test_attack(self):
+        with self.assertRaises(Exception):
+            RangeHandler.drops = 10
+            fetch.stream_download(self.url, self.path, retries=1, backoff=0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+
+class TestDownloadUD(unittest.TestCase):
+
+    def setUp(self):
+        RangeHandler.drops = 0
+        RangeHandler.ranges = []
+        self.server = HTTPServer(("127.0.0.1", 0), TreebankHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.dir = tempfile.TemporaryDirectory()
+        self.session = requests.Session()
+
+    def test_run(self):
+        urls = download_ud.get_file_urls(self.session, self.url + "/treebank")
+        self.assertEqual(urls, [self.url + "/ud/raw/master/en_test-ud-train.conllu",
+                                self.url + "/ud/raw/master/en_test-ud-test.conllu"])
+        path = os.path.join(self.dir.name, "en_test-ud-train.conllu")
+        entry = download_ud.download_conllu(self.session, urls[0], path, None)
+        self.assertFalse(entry["skipped"])
+        self.assertEqual(entry["sha256"], hashlib.sha256(DATA).hexdigest())
+        # unchanged file matching the manifest checksum is skipped
+        self.assertTrue(download_ud.download_conllu(self.session, urls[0], path, entry)["skipped"])
+
+    def test_attack(self):
+        timeout = download_ud.fetch.TIMEOUT
+        download_ud.fetch.TIMEOUT = 0.5
+        try:
+            with self.assertRaises(requests.exceptions.Timeout):
+                download_ud.get_file_urls(self.session, self.url + "/stall")
+        finally:
+            download_ud.fetch.TIMEOUT = timeout
+        # local copy not matching the manifest checksum is downloaded again
+        path = os.path.join(self.dir.name, "en_test-ud-test.conllu")
+        entry = download_ud.download_conllu(self.session, self.url + "/ud/raw/x.conllu", path, None)
+        with open(path, "wb") as f:
+            f.write(b"changed")
+        self.assertFalse(download_ud.download_conllu(self.session, self.url + "/ud/raw/x.conllu", path, entry)["skipped"])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
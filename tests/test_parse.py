@@ -1,6 +1,70 @@
 import unittest
+import queue
+import os
+import tempfile
+import threading
+import time
+from stanza.utils.conll import CoNLL
 from up2 import parse
 
+GOLDEN = "./tests/golden/parse"
+
+CONLLU = """1-2\tDon't\t_\t_\t_\t_\t_\t_\t_\tstart_char=0|end_char=5
+1\tDo\tdo\tAUX\tVBP\tMood=Ind\t3\taux\t_\t_
+2\tn't\tnot\tPART\tRB\t_\t3\tadvmod\t_\t_
+3\tgo\tgo\tVERB\tVB\tVerbForm=Inf\t0\troot\t_\tstart_char=6|end_char=8
+4\t.\t.\tPUNCT\t.\t_\t3\tpunct\t_\tstart_char=9|end_char=10
+
+"""
+
+CONLLU_MULTI = """1\tHi\thi\tINTJ\tUH\t_\t0\troot\t_\tstart_char=0|end_char=2
+2\t!\t!\tPUNCT\t.\t_\t1\tpunct\t_\tstart_char=2|end_char=3
+
+1\tYes\tyes\tINTJ\tUH\t_\t0\troot\t_\tstart_char=4|end_char=7
+
+"""
+
+
+def read_documents(file: str) -> list:
+    '''
+    Reads parsed stanza documents from CoNLL-U file, documents start with # newdoc line
+    '''
+    with open(file, "r", encoding="utf-8") as f:
+        data = f.read()
+    return [CoNLL.conll2doc(input_str=d) for d in data.split("# newdoc\n") if d]
+
+
+def serialize_reference(documents: list, start: int = 0) -> dict:
+    '''
+    Original implementation of parse.serialize (doc2conll_text and save)
+    '''
+    def doc2conll_text(doc):
+        doc_conll = CoNLL.doc2conll(doc)
+        for sentence in doc_conll:
+            for i, line in enumerate(sentence):
+                seg = line.split("\t")
+                if len(seg[0].split("-")) == 2:
+                    del sentence[i]
+        return "\n\n".join("\n".join(line for line in sentence)
+                           for sentence in doc_conll) + "\n\n"
+
+    asentences = []
+    sentences = []
+    tsentences = []
+    for d in documents:
+        asentences.append(" ".join(t.text for s in d.sentences for t in s.tokens))
+        tokens = [w.text for s in d.sentences for w in s.words]
+        sentences.append(" ".join(tokens))
+        tsentences.append("|||".join(tokens))
+    conllu = ""
+    for counter, d in enumerate(documents, 1):
+        conllu += "# sent_id = " + str(start + counter) + "\n"
+        if sentences[counter - 1] != asentences[counter - 1]:
+            conllu += "# actual text = " + asentences[counter - 1] + "\n"
+        conllu += "# text = " + sentences[counter - 1] + "\n"
+        conllu += doc2conll_text(d)
+    return {"sentences": len(documents), "tokenized": "\n".join(tsentences), "conllu": conllu}
+
 
 class TestParse(unittest.TestCase):
 
@@ -11,6 +75,104 @@ class TestParse(unittest.TestCase):
         parse.parse("en-test", "en")
         parse.parse("en-test", "pl")
 
+    def test_device(self):
+        self.assertEqual(parse.get_device(3, False), "cpu")
+
+    def test_batch_ranges(self):
+        lengths = [5, 80, 80, 5, 5, 5, 40]
+        self.assertEqual(parse.get_batch_ranges(lengths, 3), [(0, 3), (3, 6), (6, 7)])
+        self.assertEqual(parse.get_batch_ranges(lengths, 10, 100),
+                         [(0, 2), (2, 6), (6, 7)])
+        self.assertEqual(parse.get_batch_ranges([200, 5], 10, 100), [(0, 1), (1, 2)])
+        self.assertEqual(parse.get_batch_ranges([], 10, 100), [])
+        outliers = [False, True, True, False, False, False, True]
+        self.assertEqual(parse.get_batch_ranges(lengths, 3, 0, outliers, 1),
+                         [(0, 1), (1, 2), (2, 3), (3, 6), (6, 7)])
+        params = {"outlier_chars": 10, "outlier_tokens": 0}
+        self.assertTrue(parse.is_outlier("这是一个很长很长很长的句子。", 14, params))
+        self.assertFalse(parse.is_outlier("Short .", 2, params))
+
+    def test_count_tokens(self):
+        params = {"excluded_tokens_validation": ["zh", "ja"]}
+        self.assertEqual(parse.count_tokens("This is a sentence .", "en", params), 5)
+        self.assertEqual(parse.count_tokens("这是一个句子。", "zh", params), 7)
+
+    def test_serialize(self):
+        documents = [CoNLL.conll2doc(input_str=CONLLU), CoNLL.conll2doc(input_str=CONLLU_MULTI)]
+        result = parse.serialize(documents, 10)
+        self.assertEqual(result["sentences"], 2)
+        self.assertEqual(result["tokenized"], "Do|||n't|||go|||.\nHi|||!|||Yes")
+        conllu = result["conllu"].split("\n")
+        self.assertEqual(conllu[0:3], ["# sent_id = 11", "# actual text = Don't go .",
+                                       "# text = Do n't go ."])
+        self.assertTrue(conllu[3].startswith("1\tDo\tdo"))
+        self.assertNotIn("1-2\tDon't", result["conllu"])
+        self.assertIn("# sent_id = 12\n# text = Hi ! Yes\n1\tHi", result["conllu"])
+        self.assertTrue(result["conllu"].endswith("Yes\tyes\tINTJ\tUH\t_\t0\troot\t_\tstart_char=4|end_char=7\n\n"))
+
+    def test_serialize_golden(self):
+        documents = read_documents(GOLDEN + ".input.conllu")
+        result = parse.serialize(documents, 100)
+        self.assertEqual(result, serialize_reference(documents, 100))
+        with open(GOLDEN + ".expected.conllu", "r", encoding="utf-8") as f:
+            self.assertEqual(result["conllu"], f.read())
+        with open(GOLDEN + ".expected.txt", "r", encoding="utf-8") as f:
+            self.assertEqual(result["tokenized"], f.read())
+
+    def test_write_results(self):
+        # output files are written into ./data of a temporary working directory
+        cwd = os.getcwd()
+        folder = tempfile.TemporaryDirectory()
+        os.chdir(folder.name)
+        try:
+            documents = [CoNLL.conll2doc(input_str=CONLLU), CoNLL.conll2doc(input_str=CONLLU_MULTI)]
+            results = queue.Queue(maxsize=1)
+            errors = []
+            writer = threading.Thread(target=parse.write_results,
+                                      args=(results, "en-test-writer", "en", errors))
+            writer.start()
+            try:
+                results.put(parse.serialize(documents[0:1], 0))
+                results.put(parse.serialize(documents[1:2], 1))
+            finally:
+                results.put(None)
+                writer.join()
+            self.assertEqual(errors, [])
+            parse.finish_output("en-test-writer", "en")
+            expected = parse.serialize(documents, 0)
+            file_parsed, file_tokenized = parse.get_output_files("en-test-writer", "en")
+            with open(file_tokenized, "r", encoding="utf-8") as f:
+                self.assertEqual(f.read(), expected["tokenized"])
+            with open(file_parsed, "r", encoding="utf-8") as f:
+                self.assertEqual(f.read(), expected["conllu"])
+        finally:
+            os.chdir(cwd)
+            folder.cleanup()
+
+    def test_time_budget(self):
+        class SlowProcessor:
+            # parsing of a batch with a long sentence takes 0.5 second
+            def bulk_process(self, documents):
+                if any(len(d.text) > 20 for d in documents):
+                    time.sleep(0.5)
+                return documents
+
+        nlp = parse.nlp
+        parse.nlp = type("Pipeline", (), {"processors": {"tokenize": SlowProcessor()}})
+        try:
+            texts = ["A b .", "C d .", "A very long sentence to be quarantined .", "E f .", "G h ."]
+            quarantine = []
+            result = parse.parse_within_budget(texts, None, [0, 1, 2, 3, 4], {}, 0.05, quarantine)
+            self.assertEqual(sorted(result), [0, 1, 2, 3, 4])
+            self.assertEqual([r.text for i, r in sorted(result.items())], texts)
+            self.assertEqual([i for i, seconds in quarantine], [2])
+            self.assertGreaterEqual(quarantine[0][1], 0.5)
+            quarantine = []
+            parse.parse_within_budget(texts, None, [0, 1, 2], {}, 0, quarantine)
+            self.assertEqual(quarantine, [])
+        finally:
+            parse.nlp = nlp
+
     def test_attack(self):
         pass
 
@@ -0,0 +1,59 @@
+import unittest
+import tempfile
+from up2 import parse_cache
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name + "/parse.sqlite"
+
+    def test_run(self):
+        cache = parse_cache.ParseCache(self.path, 1024 * 1024, "en", "1.3.0", "tokenize")
+        self.assertEqual(cache.get(["A sentence .", "Another sentence ."]), [None, None])
+        cache.put([("A sentence .", "A|||sentence|||.", "# text = A sentence .\n1\tA\n\n")])
+        cache.close()
+        cache = parse_cache.ParseCache(self.path, 1024 * 1024, "en", "1.3.0", "tokenize")
+        self.assertEqual(cache.get(["Another sentence .", "A sentence ."]),
+                         [None, ("A|||sentence|||.", "# text = A sentence .\n1\tA\n\n")])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertIn("hit rate: 50.0%", parse_cache.summary(cache))
+        cache.close()
+        other = parse_cache.ParseCache(self.path, 1024 * 1024, "en", "1.4.0", "tokenize")
+        self.assertEqual(other.get(["A sentence ."]), [None])
+        other.close()
+
+    def test_evict(self):
+        cache = parse_cache.ParseCache(self.path, 950, "en", "1.3.0", "tokenize")
+        for i in range(10):
+            cache.put([(str(i), "x" * 50, "y" * 50)])
+            cache.get(["0"])
+        self.assertEqual(cache.total(), 800)
+        self.assertEqual(len(cache), 8)
+        self.assertIsNotNone(cache.get(["0"])[0])
+        self.assertEqual(cache.get(["1", "2", "3"]), [None, None, ("x" * 50, "y" * 50)])
+        self.assertEqual(cache.evicted, 2)
+        cache.close()
+
+    def test_shared(self):
+        first = parse_cache.ParseCache(self.path, 950, "en", "1.3.0", "tokenize")
+        second = parse_cache.ParseCache(self.path, 950, "en", "1.3.0", "tokenize")
+        # size limit holds for jobs sharing the cache
+        for i in range(5):
+            first.put([("a" + str(i), "x" * 50, "y" * 50)])
+            second.put([("b" + str(i), "x" * 50, "y" * 50)])
+        self.assertEqual(first.total(), second.total())
+        self.assertLessEqual(first.total(), 950)
+        self.assertEqual(first.total(), 100 * len(first))
+        self.assertEqual(first.evicted + second.evicted, 10 - len(first))
+        first.close()
+        second.close()
+
+    def test_attack(self):
+        self.assertIsNone(parse_cache.create_cache({"parse_cache_size": 0}, "en", "1.3.0", "tokenize"))
+        with self.assertRaises(Exception):
+            parse_cache.create_cache({"parse_cache_size": -1}, "en", "1.3.0", "tokenize")
+
+    def tearDown(self):
+        self.dir.cleanup()
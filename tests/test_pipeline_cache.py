@@ -0,0 +1,75 @@
+import unittest
+import weakref
+import torch
+from up2 import parse, pipeline_cache
+
+MB = 1024 * 1024
+
+
+class Processor:
+
+    def __init__(self, model):
+        self._trainer = type("Trainer", (), {"model": model})()
+
+
+def load(lang):
+    # 1 MB of float32 weights
+    model = torch.nn.Linear(512, 512, bias=False)
+    return type("Pipeline", (), {"lang": lang, "processors": {"pos": Processor(model), "tokenize": Processor(None)}})
+
+
+class TestPipelineCache(unittest.TestCase):
+
+    def test_run(self):
+        self.assertEqual(pipeline_cache.pipeline_size(load("en")), MB)
+        quantized = torch.quantization.quantize_dynamic(torch.nn.Sequential(torch.nn.Linear(512, 512)),
+                                                        {torch.nn.Linear}, dtype=torch.qint8)
+        self.assertGreater(pipeline_cache.model_size(quantized), MB / 4)
+        cache = pipeline_cache.PipelineCache(2, load)
+        self.assertEqual(cache.get("en").lang, "en")
+        self.assertEqual(cache.get("de").lang, "de")
+        self.assertEqual(cache.get("en").lang, "en")
+        self.assertEqual(list(cache.pipelines), ["de", "en"])
+        # the least recently used pipeline is unloaded
+        cache.get("fr")
+        self.assertEqual(list(cache.pipelines), ["en", "fr"])
+        self.assertEqual((cache.hits, cache.loads, cache.unloads), (1, 3, 1))
+
+    def test_release(self):
+        class Pipeline:
+            def __init__(self, lang):
+                self.lang = lang
+                self.processors = {"pos": Processor(torch.nn.Linear(512, 512, bias=False))}
+
+        loaded = []
+
+        def load_released(lang):
+            # pipelines unloaded by the cache are released before the next one is loaded
+            self.assertTrue(all(ref() is None for ref in loaded))
+            nlp = Pipeline(lang)
+            loaded.append(weakref.ref(nlp))
+            return nlp
+
+        pipelines, nlp = parse.pipelines, parse.nlp
+        parse.pipelines = pipeline_cache.PipelineCache(0, load_released)
+        try:
+            for lang in ["en", "de", "fr"]:
+                parse.select_pipeline(lang)
+                self.assertEqual(parse.nlp.lang, lang)
+        finally:
+            parse.pipelines, parse.nlp = pipelines, nlp
+        self.assertEqual(len(loaded), 3)
+
+    def test_attack(self):
+        cache = pipeline_cache.PipelineCache(0, load)
+        cache.get("en")
+        cache.get("de")
+        self.assertEqual(list(cache.pipelines), ["de"])
+
+        def fail(lang):
+            raise Exception("model not found")
+
+        cache = pipeline_cache.PipelineCache(2, fail)
+        with self.assertRaises(Exception):
+            cache.get("en")
+        self.assertEqual(len(cache.pipelines), 0)
@@ -0,0 +1,63 @@
+import unittest
+import json
+import os
+import tempfile
+from stanza.utils.conll import CoNLL
+from up2 import parse, prefilter
+from tests.test_parse import CONLLU, CONLLU_MULTI
+
+PIPELINE = "en-test-prefilter"
+
+
+class TestPrefilter(unittest.TestCase):
+
+    def setUp(self):
+        # prefilter files are written into ./data of a temporary working directory
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+        documents = [CoNLL.conll2doc(input_str=CONLLU), CoNLL.conll2doc(input_str=CONLLU_MULTI)]
+        self.texts = ["Don't go .", "Hi! Yes"]
+        self.documents = documents
+        self.file = prefilter.get_tokens_file(PIPELINE, "en")
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        with open(self.file, "w", encoding="utf-8") as f:
+            for text, d in zip(self.texts, documents):
+                f.write(json.dumps({"text": text, "sentences": d.to_dict()}) + "\n")
+        with open(prefilter.get_dropped_file(PIPELINE), "w", encoding="utf-8") as f:
+            f.write("2\n")
+
+    def test_run(self):
+        self.assertEqual(prefilter.read_dropped(PIPELINE), {2})
+        reader = prefilter.TokensReader(self.file)
+        tokens = reader.get(1, self.texts[1:])
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(len(tokens[0]), 2)
+        tokens = reader.get(0, self.texts)
+        reader.close()
+        # dropped sentences are serialized from their tokenization without parsing
+        result = parse.process_batch({
+            "index": 1, "start": 0, "data": self.texts, "cached": [None, None], "tokens": tokens,
+            "dropped": [True, True], "budget": 0, "lang": "en", "save": False, "pipeline": PIPELINE
+        })
+        expected = parse.serialize(self.documents)
+        self.assertEqual(result["conllu"], expected["conllu"])
+        self.assertEqual(result["tokenized"], expected["tokenized"])
+        self.assertEqual(result["parsed"], [])
+        self.assertEqual(result["metrics"]["dropped"], 2)
+
+    def test_attack(self):
+        reader = prefilter.TokensReader(self.file)
+        with self.assertRaises(Exception):
+            reader.get(0, ["Do not go .", "Hi! Yes"])
+        with self.assertRaises(Exception):
+            reader.get(1, self.texts)
+        reader.close()
+        with self.assertRaises(Exception):
+            prefilter.read_dropped("en-test-missing")
+        with self.assertRaises(Exception):
+            prefilter.TokensReader(prefilter.get_tokens_file("en-test-missing", "en"))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.dir.cleanup()
@@ -1,16 +1,134 @@
 import unittest
-from up2 import preprocess
+import io
+import json
+import os
+import random
+import re
+import tempfile
+from multiprocessing import Pool
+from up2 import preprocess, dedup
+
+PARAMS = {
+    "min_tokens": 5,
+    "max_tokens": 80,
+    "excluded_tokens_validation": ["zh", "ja"],
+    "dedup_store": "memory",
+    "dedup_bits": 64
+}
+
+
+def validate_alpha_reference(text: str) -> bool:
+    '''
+    Original implementation of preprocess.validate_alpha
+    '''
+    for tok in text:
+        r = repr(tok)
+        if "\\x" in r or "\\u" in r:
+            return False
+    if "�" in text:
+        return False
+    for tok in text:
+        if tok.isalpha():
+            return True
+    return False
+
 
 class TestPreprocess(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.dir = tempfile.TemporaryDirectory()
+        os.makedirs(self.dir.name + "/europarl")
+        src = ["This is sentence number " + str(i) + " ." for i in range(10)]
+        tgt = ["To jest zdanie numer " + str(i) + " ." for i in range(10)]
+        src[2] = "Too short"
+        src[4] = src[3]
+        with open(self.dir.name + "/europarl/Europarl.en-pl.en", "w", encoding="utf-8") as f:
+            f.write("\n".join(src) + "\n")
+        with open(self.dir.name + "/europarl/Europarl.en-pl.pl", "w", encoding="utf-8") as f:
+            f.write("\n".join(tgt) + "\n")
+
+    def get_context(self):
+        return {
+            "stats": {},
+            "rejected": {"file": io.StringIO(), "sample": 1},
+            "map": dedup.MemoryStore(),
+            "config": {"params": PARAMS},
+            "output": {"src": io.StringIO(), "tgt": io.StringIO(), "count": 0}
+        }
 
     def test_run(self):
         preprocess.preprocess("en-test")
 
+    def test_process(self):
+        context = self.get_context()
+        accepted = preprocess.process(self.dir.name, "europarl", "en", "pl", context)
+        self.assertEqual(accepted, 8)
+        src = context["output"]["src"].getvalue().split("\n")
+        tgt = context["output"]["tgt"].getvalue().split("\n")
+        self.assertEqual(len(src), 8)
+        self.assertEqual(tgt[2], "To jest zdanie numer 3 .")
+        stats = context["stats"]["europarl"]
+        self.assertEqual(stats["read"], 10)
+        self.assertEqual(stats["accepted"], 8)
+        self.assertEqual(stats["rejected"], 2)
+        self.assertEqual(stats["src tokens"], 1)
+        self.assertEqual(stats["src duplicate"], 1)
+        rejected = context["rejected"]["file"].getvalue().splitlines()
+        self.assertEqual(len(rejected), 2)
+        self.assertEqual(json.loads(rejected[1])["src_reason"], "duplicate")
+        self.assertEqual(len(preprocess.get_summary(context["stats"])), 3)
+
+    def test_workers(self):
+        chunk_size = preprocess.CHUNK_SIZE
+        preprocess.CHUNK_SIZE = 3
+        try:
+            serial = self.get_context()
+            preprocess.process(self.dir.name, "europarl", "en", "pl", serial, 7)
+            parallel = self.get_context()
+            parallel["workers"] = 2
+            with Pool(2) as pool:
+                parallel["pool"] = pool
+                preprocess.process(self.dir.name, "europarl", "en", "pl", parallel, 7)
+        finally:
+            preprocess.CHUNK_SIZE = chunk_size
+        for f in ["src", "tgt"]:
+            self.assertEqual(parallel["output"][f].getvalue(), serial["output"][f].getvalue())
+        self.assertEqual(parallel["stats"], serial["stats"])
+        self.assertEqual(parallel["rejected"]["file"].getvalue(),
+                         serial["rejected"]["file"].getvalue())
+
+    def test_quota(self):
+        context = self.get_context()
+        accepted = preprocess.process(self.dir.name, "europarl", "en", "pl", context, 3)
+        self.assertEqual(accepted, 3)
+        self.assertEqual(context["output"]["src"].getvalue().split("\n")[-1],
+                         "This is sentence number 3 .")
+        self.assertNotIn("This is sentence number 9 .", context["map"])
+
+    def test_validate_alpha(self):
+        texts = []
+        for code in list(range(0x10000)) + [0x1F600, 0x1D400, 0xE0001, 0x10FFFF]:
+            c = chr(code)
+            texts += [c, "a" + c, "1 " + c + " 2"]
+        rnd = random.Random(1)
+        for i in range(5000):
+            texts.append("".join(chr(rnd.choice([rnd.randint(0, 0x2FF), rnd.randint(0, 0x10FFFF)]))
+                                 for j in range(rnd.randint(0, 20))))
+        expected = [validate_alpha_reference(t) for t in texts]
+        self.assertEqual([preprocess.validate_alpha(t) for t in texts], expected)
+        self.assertEqual(preprocess.validate_alpha_bulk(texts), expected)
+        self.assertEqual(preprocess.validate_alpha_bulk([]), [])
+
+    def test_preprocess_sentence(self):
+        self.assertEqual(preprocess.preprocess_sentence(" a \t b\u00a0\u2003c  "), " a b c ")
+        rnd = random.Random(1)
+        chars = [" ", "\t", "\n", "\x1c", "\x85", "\u3000", "a", "b"]
+        for i in range(20000):
+            text = "".join(rnd.choice(chars) for j in range(rnd.randint(0, 8)))
+            self.assertEqual(preprocess.preprocess_sentence(text), re.sub(r'\s+', ' ', text))
+
     def test_attack(self):
         pass
 
     def tearDown(self):
-        pass
+        self.dir.cleanup()
@@ -0,0 +1,59 @@
+import unittest
+import torch
+from stanza.utils.conll import CoNLL
+from up2 import quantization
+from tests.test_parse import CONLLU, CONLLU_MULTI
+
+
+class Model(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.lstm = torch.nn.LSTM(4, 4, batch_first=True)
+        self.linear = torch.nn.Linear(4, 2)
+
+    def forward(self, x):
+        return self.linear(self.lstm(x)[0])
+
+
+class Processor:
+
+    def __init__(self, model):
+        self._trainer = type("Trainer", (), {"model": model})()
+
+
+class TestQuantization(unittest.TestCase):
+
+    def test_run(self):
+        torch.manual_seed(0)
+        model = Model().eval()
+        nlp = type("Pipeline", (), {"processors": {"pos": Processor(model), "lemma": Processor(None)}})
+        self.assertEqual(quantization.quantize_pipeline(nlp), ["pos"])
+        quantized = nlp.processors["pos"]._trainer.model
+        self.assertNotIsInstance(quantized.linear, torch.nn.Linear)
+        self.assertNotIsInstance(quantized.lstm, torch.nn.LSTM)
+        x = torch.rand(2, 3, 4)
+        self.assertTrue(torch.allclose(model(x), quantized(x), atol=0.05))
+        self.assertIsNone(nlp.processors["lemma"]._trainer.model)
+
+        reference = [CoNLL.conll2doc(input_str=CONLLU), CoNLL.conll2doc(input_str=CONLLU_MULTI)]
+        documents = [CoNLL.conll2doc(input_str=CONLLU.replace("\tPUNCT\t.\t_\t3\tpunct", "\tSYM\t.\t_\t1\tpunct")),
+                     CoNLL.conll2doc(input_str=CONLLU_MULTI)]
+        counts = quantization.compare_documents(reference, documents)
+        self.assertEqual(counts, {"documents": 2, "tokenization": 2, "words": 7, "upos": 6, "head": 6,
+                                  "deprel": 7, "labeled": 6})
+        lines = quantization.summary(counts, 4.0, 2.0)
+        self.assertIn("speedup: 2.00x", lines[0])
+        self.assertEqual(lines[1], "Same tokenization: 2 of 2 sentences (100.0%)")
+        self.assertIn("UPOS 85.71%", lines[2])
+        self.assertIn("DEPREL 100.00%", lines[2])
+
+    def test_attack(self):
+        self.assertFalse(quantization.use_quantization({"quantize": False, "gpu": True}))
+        with self.assertRaises(Exception):
+            quantization.use_quantization({"quantize": True, "gpu": True})
+        reference = [CoNLL.conll2doc(input_str=CONLLU)]
+        documents = [CoNLL.conll2doc(input_str=CONLLU_MULTI)]
+        counts = quantization.compare_documents(reference, documents)
+        self.assertEqual((counts["tokenization"], counts["words"]), (0, 0))
+        self.assertIn("Agreement on 0 words: UPOS 0.00%", quantization.summary(counts, 1.0, 0.0)[2])
@@ -0,0 +1,98 @@
+import unittest
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from stanza.utils.conll import CoNLL
+from up2 import parse, service, service_client
+from tests.test_parse import CONLLU, CONLLU_MULTI
+
+
+def get_batch(index, start, texts, documents):
+    return {
+        "index": index, "start": start, "data": texts, "cached": [None] * len(texts),
+        "tokens": [d.to_dict() for d in documents], "dropped": [True] * len(texts), "budget": 0,
+        "lang": "en", "save": False, "pipeline": "en-test-service"
+    }
+
+
+class DyingHandler(BaseHTTPRequestHandler):
+    # reads the batch and closes the connection without a response like a killed service
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HangingHandler(DyingHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.stopped.wait(5)
+
+
+class TestService(unittest.TestCase):
+
+    def setUp(self):
+        self.texts = ["Don't go .", "Hi! Yes", "Don't go ."]
+        self.documents = [CoNLL.conll2doc(input_str=c) for c in (CONLLU, CONLLU_MULTI, CONLLU)]
+
+    def test_run(self):
+        result = parse.serialize(self.documents)
+        entries = service.split_conllu(result["conllu"], 3)
+        self.assertEqual(entries, [parse.serialize_document(d)[1] for d in self.documents])
+        # merged batches give the same results as separate batches
+        batches = [get_batch(4, 30, self.texts[0:2], self.documents[0:2]),
+                   get_batch(5, 32, self.texts[2:3], self.documents[2:3])]
+        results = service.parse_batches(json.loads(json.dumps(batches)))
+        for batch, merged in zip(batches, results):
+            expected = parse.process_batch(batch)
+            for key in ("index", "sentences", "tokenized", "conllu", "parsed", "quarantine"):
+                self.assertEqual(merged[key], expected[key])
+            self.assertEqual(merged["metrics"]["sentences"], len(batch["data"]))
+            self.assertEqual(merged["metrics"]["dropped"], len(batch["data"]))
+        self.assertIn("# sent_id = 33\n", results[1]["conllu"])
+
+        batcher = service.Batcher({"batch_size": 3}, None, 0)
+        requests = [service.Request("parse", batches[0]), service.Request("align", {"data": [1]}),
+                    service.Request("parse", batches[1]), service.Request("parse", batches[1])]
+        batcher.pending.extend(requests)
+        self.assertEqual(batcher.take(), [requests[0], requests[2]])
+        self.assertEqual(batcher.take(), [requests[1]])
+        self.assertEqual(batcher.take(), [requests[3]])
+
+    def test_attack(self):
+        with self.assertRaises(Exception):
+            service.split_conllu("# sent_id = 2\n# text = a\n\n", 1)
+        self.assertFalse(service_client.available({"service_port": 0}))
+        # nothing listens on the port
+        self.assertIsNone(service_client.get_status(1))
+        batcher = service.Batcher({"batch_size": 3}, None, 0)
+        request = service.Request("parse", {"lang": "en", "tokens": None, "budget": 0, "data": ["a"]})
+        batcher.process([request])
+        with self.assertRaises(Exception):
+            request.future.result()
+
+    def test_dying(self):
+        batch = {"index": 7, "data": ["a"]}
+        for handler in (DyingHandler, HangingHandler):
+            server = ThreadingHTTPServer((service_client.HOST, 0), handler)
+            server.stopped = threading.Event()
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            port = server.server_address[1]
+            try:
+                with mock.patch.object(service_client, "REQUEST_TIMEOUT", 0.5):
+                    with self.assertRaisesRegex(Exception, "batch 7"):
+                        service_client.request(port, "/parse", batch)
+            finally:
+                server.stopped.set()
+                server.shutdown()
+                server.server_close()
+                thread.join()
+        # the service is not running anymore
+        with self.assertRaisesRegex(Exception, "batch 7"):
+            service_client.request(port, "/parse", batch)
@@ -0,0 +1,162 @@
+'''
+Per-batch throughput and resource metrics of parse.py. Every processed batch is appended as
+a JSON line to ./data/[pipeline]/parsed/[pipeline].[lang].metrics.jsonl (every shard and batch
+queue job has its own file, named as its checkpoint manifest) with the number of sentences and
+words, processing time of every stanza processor, worker RSS high-water mark and device.
+Summary with percentiles and overall throughput is logged at the end of parse.py and can be
+printed for all jobs of a language with:
+python3 up2/batch_metrics.py --pipeline=en-fr --lang=fr
+'''
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import resource
+from typing import List
+from checkpoint import get_manifest
+
+PERCENTILES = [50, 90, 99]
+
+
+def get_metrics_file(pipeline: str, lang: str, shard_index: int = 0, num_shards: int = 1, owner: str = None) -> str:
+    '''
+    Returns metrics file name for a given pipeline, language and job
+
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards
+    :param owner: identifier of the job draining the batch queue, None without queue
+    :return: metrics file name
+    '''
+    folder = "./data/" + pipeline + "/parsed"
+    return get_manifest(folder, pipeline + "." + lang + ".metrics", shard_index, num_shards, owner)
+
+
+def max_rss() -> float:
+    '''
+    Returns resident memory high-water mark of the current process
+
+    :return: max RSS in MB
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: List[float], p: float) -> float:
+    '''
+    Returns percentile of values (nearest rank method)
+
+    :param values: list of numbers
+    :param p: percentile from 0 to 100
+    :return: value at the percentile, 0 for empty list
+    '''
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+class MetricsWriter:
+    '''
+    Appends batch metrics to the metrics file and keeps metrics of the current job
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = []
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, metrics: dict):
+        self.records.append(metrics)
+        self.file.write(json.dumps(metrics) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_metrics(pipeline: str, lang: str) -> list:
+    '''
+    Reads batch metrics of all jobs for a given pipeline and language, the last entry of
+    a batch is used (batches processed again after restart)
+
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :return: list of batch metrics
+    '''
+    name = get_metrics_file(pipeline, lang)[:-len(".jsonl")]
+    records = {}
+    for file in glob.glob(name + ".jsonl") + sorted(glob.glob(name + ".*.jsonl")):
+        with open(file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                records[entry["index"]] = entry
+    return [records[i] for i in sorted(records)]
+
+
+def summary(records: List[dict]) -> List[str]:
+    '''
+    Summarizes batch metrics: overall throughput (from the start of the first batch to the end
+    of the last batch), percentiles of batch time and batch throughput, time of every stanza
+    processor and max memory
+
+    :param records: list of batch metrics
+    :return: lines of text to be logged
+    '''
+    if not records:
+        return ["Batch metrics: no batches"]
+    sentences = sum(r["sentences"] for r in records)
+    parsed = sum(r["parsed"] for r in records)
+    words = sum(r["words"] for r in records)
+    wall = max(r["finished"] for r in records) - min(r["finished"] - r["seconds"] for r in records)
+    wall = max(wall, 1e-9)
+    seconds = [r["seconds"] for r in records]
+    rates = [r["words"] / r["seconds"] for r in records if r["parsed"] and r["seconds"] > 0]
+    processors = {}
+    for r in records:
+        for name, t in r["processors"].items():
+            processors[name] = processors.get(name, 0) + t
+    busy = sum(seconds)
+    devices = sorted(set(str(r["device"]) for r in records))
+
+    names = "/".join("p" + str(p) for p in PERCENTILES)
+    slow = "/".join("p" + str(100 - p) for p in PERCENTILES)
+    lines = [
+        f'Batch metrics: batches: {len(records)}, sentences: {sentences}, parsed: {parsed}, words: {words}, '
+        f'time: {wall:.1f} s, {parsed / wall:.1f} sentences/s, {words / wall:.1f} words/s',
+        f'Batch time {names}/max: ' +
+        " / ".join(f'{percentile(seconds, p):.2f}' for p in PERCENTILES + [100]) + " s",
+        f'Batch throughput {slow}/min: ' +
+        " / ".join(f'{percentile(rates, 100 - p):.1f}' for p in PERCENTILES + [100]) + " words/s",
+        "Processor time: " + ", ".join(
+            f'{name}: {t:.1f} s ({t / busy if busy else 0:.0%})' for name, t in processors.items()),
+        f'Max RSS: {max(r["rss_mb"] for r in records):.0f} MB, devices: {", ".join(devices)}'
+    ]
+    return lines
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s %(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S',
+        level=logging.INFO
+    )
+
+    parser = argparse.ArgumentParser(
+        description='Summary of parse.py batch metrics')
+    parser.add_argument('--pipeline', type=str)
+    parser.add_argument('--lang', type=str)
+
+    args = parser.parse_args()
+
+    for line in summary(read_metrics(args.pipeline, args.lang)):
+        logging.info(line)
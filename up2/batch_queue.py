@@ -0,0 +1,313 @@
+'''
+Batch queue used by parse.py and wordalignment.py (--queue argument). Batches are stored in
+a sqlite table and every job takes the next free batch only when one of its workers is idle,
+so fast workers take more batches and several jobs (also on different machines with a shared
+file system) can drain the same queue. Taken batches are leased for a limited time: batches of
+crashed jobs are taken again when the lease expires, failed batches are retried with
+exponential backoff.
+'''
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from typing import List
+
+LEASE = 3600
+RETRIES = 3
+BACKOFF = 60.0
+POLL = 1.0
+
+
+def get_owner() -> str:
+    '''
+    Returns identifier of the current job
+
+    :return: host name and process id
+    '''
+    return socket.gethostname() + "-" + str(os.getpid())
+
+
+class BatchQueue:
+    '''
+    Sqlite table of batches with their status: pending, leased, done or failed
+    '''
+
+    def __init__(self, path: str, lease: int = LEASE, retries: int = RETRIES, backoff: float = BACKOFF):
+        self.path = path
+        self.lease = lease
+        self.retries = retries
+        self.backoff = backoff
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # rollback journal, WAL mode does not work on network file systems
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode = DELETE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS batches (idx INTEGER PRIMARY KEY, start INTEGER, "
+            "sentences INTEGER, status TEXT, attempts INTEGER, owner TEXT, lease_until REAL, "
+            "available_at REAL, error TEXT)")
+
+    def add(self, ranges: List[tuple], on_create=None):
+        '''
+        Adds batches to the queue. Batches already present in the queue are reused (batches done by
+        previous jobs are not processed again), failed batches are returned to the queue.
+
+        :param ranges: list of (start, end) sentence ranges of all batches
+        :param on_create: function called when the queue is created, before other jobs can use it
+                          (for example to remove manifests of jobs of an earlier queue)
+        '''
+        rows = [(index, start, end - start) for index, (start, end) in enumerate(ranges, 1)]
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            existing = self.connection.execute("SELECT idx, start, sentences FROM batches").fetchall()
+            if existing and sorted(existing) != rows:
+                msg = f'Queue {self.path} contains different batches, remove it to start a new queue'
+                logging.error(msg)
+                raise Exception(msg)
+            if not existing:
+                self.connection.executemany(
+                    "INSERT INTO batches (idx, start, sentences, status, attempts, available_at) "
+                    "VALUES (?, ?, ?, 'pending', 0, 0)", rows)
+                if on_create is not None:
+                    on_create()
+            else:
+                logging.info(f'Queue {self.path} already exists, batches: {self.counts()}')
+                reset = self.connection.execute(
+                    "UPDATE batches SET status = 'pending', attempts = 0, available_at = 0 "
+                    "WHERE status = 'failed'").rowcount
+                if reset:
+                    logging.warning(f'Failed batches returned to the queue: {reset}')
+                if self.counts() == {"done": len(rows)}:
+                    logging.warning(f'All batches of queue {self.path} are done, remove it to start a new queue')
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def acquire(self, owner: str) -> tuple:
+        '''
+        Takes the first available batch: pending batch or batch with expired lease
+
+        :param owner: job identifier
+        :return: tuple (index, start, end) or None if no batch is available now
+        '''
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT idx, start, sentences, status, owner FROM batches WHERE "
+                "(status = 'pending' AND available_at <= ?) OR (status = 'leased' AND lease_until < ?) "
+                "ORDER BY idx LIMIT 1", (now, now)).fetchone()
+            if row:
+                index, start, sentences, status, previous = row
+                if status == 'leased':
+                    logging.warning(f'Batch {index} lease of {previous} expired, batch is taken again')
+                self.connection.execute(
+                    "UPDATE batches SET status = 'leased', owner = ?, lease_until = ?, "
+                    "attempts = attempts + 1 WHERE idx = ?", (owner, now + self.lease, index))
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        if not row:
+            return None
+        return index, start, start + sentences
+
+    def renew(self, indexes: List[int], owner: str):
+        '''
+        Extends leases of batches that are still processed
+
+        :param indexes: batch indexes
+        :param owner: job identifier
+        '''
+        lease_until = time.time() + self.lease
+        self.connection.executemany(
+            "UPDATE batches SET lease_until = ? WHERE idx = ? AND owner = ? AND status = 'leased'",
+            [(lease_until, index, owner) for index in indexes])
+
+    def hold(self, index: int, owner: str) -> bool:
+        '''
+        Checks if the batch is still leased by the job and renews its lease, so the batch is not
+        taken by another job while its result is saved
+
+        :param index: batch index
+        :param owner: job identifier
+        :return: True if the batch is leased by the job
+        '''
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            count = self.connection.execute(
+                "UPDATE batches SET lease_until = ? WHERE idx = ? AND owner = ? AND status = 'leased'",
+                (time.time() + self.lease, index, owner)).rowcount
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return count == 1
+
+    def complete(self, index: int, owner: str):
+        '''
+        Marks batch as done
+
+        :param index: batch index
+        :param owner: job identifier
+        '''
+        self.connection.execute(
+            "UPDATE batches SET status = 'done', error = NULL WHERE idx = ? AND owner = ?", (index, owner))
+
+    def fail(self, index: int, owner: str, error: str):
+        '''
+        Returns failed batch to the queue, the batch is available again after backoff time.
+        Batch is marked as failed after the max number of attempts.
+
+        :param index: batch index
+        :param owner: job identifier
+        :param error: error message
+        '''
+        attempts = self.connection.execute(
+            "SELECT attempts FROM batches WHERE idx = ?", (index,)).fetchone()[0]
+        if attempts >= self.retries:
+            logging.error(f'Batch {index} failed {attempts} times: {error}')
+            self.connection.execute(
+                "UPDATE batches SET status = 'failed', error = ? WHERE idx = ? AND owner = ?",
+                (error, index, owner))
+            return
+        delay = self.backoff * 2 ** (attempts - 1)
+        logging.warning(f'Batch {index} failed, attempt {attempts} of {self.retries}, retry in {delay} s: {error}')
+        self.connection.execute(
+            "UPDATE batches SET status = 'pending', available_at = ?, error = ? WHERE idx = ? AND owner = ?",
+            (time.time() + delay, error, index, owner))
+
+    def wait_time(self) -> float:
+        '''
+        Returns time until the next batch may become available
+
+        :return: seconds, None if there are no pending or leased batches
+        '''
+        row = self.connection.execute(
+            "SELECT MIN(CASE WHEN status = 'pending' THEN available_at ELSE lease_until END) "
+            "FROM batches WHERE status IN ('pending', 'leased')").fetchone()
+        if row[0] is None:
+            return None
+        return max(row[0] - time.time(), 0)
+
+    def counts(self) -> dict:
+        '''
+        Returns the number of batches by status
+        '''
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM batches GROUP BY status"))
+
+    def close(self):
+        self.connection.close()
+
+
+class LeaseRenewer:
+    '''
+    Thread renewing the lease of a batch processed in the main process
+    '''
+
+    def __init__(self, batch_queue: BatchQueue, index: int, owner: str):
+        self.batch_queue = batch_queue
+        self.index = index
+        self.owner = owner
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        # sqlite connection cannot be used by other threads, the thread opens its own connection
+        connection = BatchQueue(self.batch_queue.path, self.batch_queue.lease)
+        try:
+            while not self.stopped.wait(self.batch_queue.lease / 3):
+                connection.renew([self.index], self.owner)
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+def drain(batch_queue: BatchQueue, owner: str, get_batch, process_batch, on_result, pool=None,
+          window: int = 1, poll: float = POLL):
+    '''
+    Processes batches from the queue until there are no pending or leased batches. With a process
+    pool at most window batches are in progress, next batch is taken when one of them is finished.
+    Leases of batches in progress are renewed (also of a batch processed in the main process),
+    results of batches taken by another job after the lease expired are dropped. Raises exception
+    if some batches failed.
+
+    :param batch_queue: BatchQueue
+    :param owner: job identifier
+    :param get_batch: function (index, start, end) -> batch dictionary
+    :param process_batch: function processing batch dictionary
+    :param on_result: function called in the main process with every batch result
+    :param pool: process pool or None for processing in the main process
+    :param window: max number of batches in progress
+    :param poll: max waiting time in seconds between queue checks
+    '''
+    finished = queue.Queue()
+    in_progress = set()
+    renewed = time.time()
+
+    def handle(index, result, error):
+        if error is not None:
+            batch_queue.fail(index, owner, repr(error))
+        elif not batch_queue.hold(index, owner):
+            logging.warning(f'Batch {index} was taken by another job, result is dropped')
+        else:
+            on_result(result)
+            batch_queue.complete(index, owner)
+
+    while True:
+        while len(in_progress) < window:
+            item = batch_queue.acquire(owner)
+            if item is None:
+                break
+            index, start, end = item
+            batch = get_batch(index, start, end)
+            if pool is None:
+                try:
+                    with LeaseRenewer(batch_queue, index, owner):
+                        result = process_batch(batch)
+                except Exception as e:
+                    handle(index, None, e)
+                else:
+                    handle(index, result, None)
+                continue
+            in_progress.add(index)
+            pool.apply_async(process_batch, (batch,),
+                             callback=lambda r, i=index: finished.put((i, r, None)),
+                             error_callback=lambda e, i=index: finished.put((i, None, e)))
+
+        if not in_progress:
+            wait = batch_queue.wait_time()
+            if wait is None:
+                break
+            time.sleep(min(wait, poll))
+            continue
+
+        try:
+            index, result, error = finished.get(timeout=poll)
+            in_progress.discard(index)
+            handle(index, result, error)
+        except queue.Empty:
+            pass
+
+        if time.time() - renewed > batch_queue.lease / 3:
+            batch_queue.renew(list(in_progress), owner)
+            renewed = time.time()
+
+    counts = batch_queue.counts()
+    logging.info(f'Batch queue: {counts}')
+    if counts.get("failed"):
+        msg = f'Batch queue: {counts["failed"]} batches failed, run the job again to retry them'
+        logging.error(msg)
+        raise Exception(msg)
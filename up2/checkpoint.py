@@ -0,0 +1,267 @@
+'''
+Crash-safe batch checkpoints used by parse.py and wordalignment.py. Batch output files are
+written to temporary files and atomically renamed, every finished batch is appended to a
+manifest (JSON lines) with its sentence range, the number of sentences and size and SHA-256
+checksum of its files. Resumed processing skips only batches verified against the manifest.
+Every shard (--shard-index, --num-shards) and every job draining a batch queue (--queue) has
+its own manifest, merge scripts verify that batches from all manifests are complete and
+contiguous before they are merged. Entries are tagged with the run key (checksum of batch
+ranges), entries of earlier runs with different input or batching params are not used.
+'''
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List
+from fetch import file_sha256
+
+
+def write_file(path: str, text: str) -> dict:
+    '''
+    Writes file atomically: data is written to a temporary file, flushed to the disk
+    and renamed, so the file is never left truncated
+
+    :param path: output file
+    :param text: file content
+    :return: file entry to be stored in the manifest
+    '''
+    data = text.encode("utf-8")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return {
+        "path": path,
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest()
+    }
+
+
+def verify_file(entry: dict) -> bool:
+    '''
+    Checks if a file matches its manifest entry
+
+    :param entry: file entry from the manifest
+    :return: True if the file exists and has the same size and checksum
+    '''
+    path = entry["path"]
+    if not os.path.isfile(path) or os.path.getsize(path) != entry["size"]:
+        return False
+    return file_sha256(path) == entry["sha256"]
+
+
+def get_run(ranges: List[tuple]) -> str:
+    '''
+    Returns run key of a job: checksum of sentence ranges of all batches, the key changes with
+    the input size and batching params (batch_size, batch_tokens, outliers)
+
+    :param ranges: list of (start, end) sentence ranges of all batches
+    :return: run key
+    '''
+    return hashlib.sha256(json.dumps([list(r) for r in ranges]).encode("utf-8")).hexdigest()[:16]
+
+
+def get_manifest(folder: str, name: str, shard_index: int = 0, num_shards: int = 1, owner: str = None) -> str:
+    '''
+    Returns manifest file name for a given job shard or batch queue job
+
+    :param folder: checkpoint folder
+    :param name: manifest name, for example parse.en
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards
+    :param owner: identifier of the job draining the batch queue, None without queue
+    :return: manifest file name
+    '''
+    if owner:
+        return folder + "/" + name + ".queue-" + owner + ".jsonl"
+    if num_shards > 1:
+        return folder + "/" + name + ".shard-" + str(shard_index) + "-of-" + str(num_shards) + ".jsonl"
+    return folder + "/" + name + ".jsonl"
+
+
+def remove_queue_manifests(path: str) -> int:
+    '''
+    Removes files of batch queue jobs (see get_manifest) of a given manifest, used when a new batch
+    queue is created, so files of jobs of an earlier queue are not merged
+
+    :param path: manifest file name of a job without queue and shards
+    :return: the number of removed files
+    '''
+    files = glob.glob(path[:-len(".jsonl")] + ".queue-*.jsonl")
+    for file in files:
+        os.remove(file)
+    return len(files)
+
+
+def in_shard(index: int, shard_index: int, num_shards: int) -> bool:
+    '''
+    Checks if a batch belongs to a given shard, batches are assigned to shards in turn
+
+    :param index: batch index (starting from 1)
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards
+    :return: True if the batch is processed by the job
+    '''
+    return (index - 1) % num_shards == shard_index
+
+
+def read_manifest(path: str) -> dict:
+    '''
+    Reads batches from manifest file, the last entry of a batch is used
+
+    :param path: manifest file
+    :return: dictionary with manifest entries by batch index
+    '''
+    batches = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # line truncated by interrupted write
+                continue
+            batches[entry["index"]] = entry
+    return batches
+
+
+def read_manifests(folder: str, name: str) -> dict:
+    '''
+    Reads batches from all manifests (all shards and batch queue jobs) with a given name. Only
+    entries of the run of the newest entry are used and the newest entry of every batch is kept.
+
+    :param folder: checkpoint folder
+    :param name: manifest name, for example parse.en
+    :return: dictionary with manifest entries by batch index
+    '''
+    files = glob.glob(folder + "/" + name + ".jsonl") + \
+        sorted(glob.glob(folder + "/" + name + ".shard-*.jsonl")) + \
+        sorted(glob.glob(folder + "/" + name + ".queue-*.jsonl"))
+    entries = []
+    for file in files:
+        entries += read_manifest(file).values()
+    if not entries:
+        return {}
+    entries.sort(key=lambda e: e.get("time", 0))
+    run = entries[-1].get("run")
+    batches = {}
+    stale = 0
+    for entry in entries:
+        if entry.get("run") != run:
+            stale += 1
+            continue
+        batches[entry["index"]] = entry
+    if stale:
+        logging.warning(f'Manifests {name}: {stale} batches of earlier runs are ignored')
+    return batches
+
+
+def check_batches(batches: dict) -> list:
+    '''
+    Checks if batches are complete: all batches from 1 to the number of batches are present,
+    sentence ranges are contiguous and all batch files match their sizes and checksums
+
+    :param batches: dictionary with manifest entries by batch index
+    :return: list of errors, empty list if batches can be merged
+    '''
+    if not batches:
+        return ["No batches in the manifest"]
+    errors = []
+    totals = set(entry["batches"] for entry in batches.values())
+    if len(totals) > 1:
+        errors.append(f'Different number of batches in manifests: {sorted(totals)}')
+    total = max(totals)
+    missing = [i for i in range(1, total + 1) if i not in batches]
+    if missing:
+        errors.append(f'Missing batches: {missing}')
+    start = 0
+    for index in sorted(batches):
+        entry = batches[index]
+        if index == 1 or index - 1 in batches:
+            if entry["start"] != start:
+                errors.append(f'Batch {index} starts at sentence {entry["start"]}, expected {start}')
+        start = entry["start"] + entry["sentences"]
+        for file in entry["files"]:
+            if not verify_file(file):
+                errors.append(f'Batch {index} file {file["path"]} is not valid')
+    return errors
+
+
+class Checkpoint:
+    '''
+    Manifest of finished batches, one JSON line per batch
+    '''
+
+    def __init__(self, path: str, run: str = None):
+        '''
+        :param path: manifest file
+        :param run: run key of the job (see get_run), entries of other runs are removed from the manifest
+        '''
+        self.path = path
+        self.run = run
+        self.batches = {}
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if os.path.isfile(path):
+            self.batches = read_manifest(path)
+            stale = [i for i, entry in self.batches.items() if entry.get("run") != run]
+            if stale:
+                logging.warning(f'Manifest {path}: {len(stale)} batches of an earlier run (different input or '
+                                f'batching params) are removed')
+                for i in stale:
+                    del self.batches[i]
+                write_file(path, "".join(json.dumps(entry) + "\n" for entry in self.batches.values()))
+        self.file = open(path, "a", encoding="utf-8")
+
+    def verified(self, index: int, start: int, sentences: int) -> bool:
+        '''
+        Checks if a batch is finished: the batch is in the manifest with the same sentence
+        range and all its files match their sizes and checksums
+
+        :param index: batch index
+        :param start: number of sentences in all previous batches
+        :param sentences: the number of sentences in the batch
+        :return: True if the batch does not have to be processed again
+        '''
+        entry = self.batches.get(index)
+        if not entry:
+            return False
+        if entry["start"] != start or entry["sentences"] != sentences:
+            logging.warning(f'Batch {index} range changed, batch will be processed again')
+            return False
+        for file in entry["files"]:
+            if not verify_file(file):
+                logging.warning(f'Batch {index} file {file["path"]} is not valid, batch will be processed again')
+                return False
+        return True
+
+    def record(self, index: int, start: int, sentences: int, files: list, batches: int):
+        '''
+        Appends finished batch to the manifest
+
+        :param index: batch index
+        :param start: number of sentences in all previous batches
+        :param sentences: the number of sentences in the batch
+        :param files: list of file entries returned by write_file
+        :param batches: the number of batches of the whole job (all shards)
+        '''
+        entry = {
+            "index": index,
+            "start": start,
+            "sentences": sentences,
+            "batches": batches,
+            "files": files,
+            "run": self.run,
+            "time": time.time()
+        }
+        self.batches[index] = entry
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,155 @@
+'''
+CPU resource planner used by parse.py and wordalignment.py. Available cores (CPU affinity of
+the process limited by cgroup CPU quota) are divided between worker processes and PyTorch
+intra-op threads (torch.set_num_threads), so processes do not start thread pools with all cores
+each. Workers can be pinned to disjoint core sets (params.cpu_pinning).
+The best number of processes and threads for a machine can be measured with
+python3 up2/parse.py --pipeline=en-fr --lang=fr --calibrate
+'''
+import logging
+import math
+import os
+import re
+from typing import List
+import torch
+
+CGROUP_V2 = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def read_cgroup_limit() -> int:
+    '''
+    Reads cgroup CPU quota (cgroup v2 or v1)
+
+    :return: max number of cores or None if CPU usage is not limited
+    '''
+    try:
+        with open(CGROUP_V2, "r") as f:
+            quota, period = f.read().split()[0:2]
+        if quota == "max":
+            return None
+        return max(math.ceil(int(quota) / int(period)), 1)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(CGROUP_V1_QUOTA, "r") as f:
+            quota = int(f.read())
+        with open(CGROUP_V1_PERIOD, "r") as f:
+            period = int(f.read())
+        if quota <= 0:
+            return None
+        return max(math.ceil(quota / period), 1)
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> List[int]:
+    '''
+    Returns cores available to the process: CPU affinity limited by cgroup CPU quota
+
+    :return: sorted list of core identifiers
+    '''
+    cpus = sorted(os.sched_getaffinity(0))
+    limit = read_cgroup_limit()
+    if limit:
+        cpus = cpus[0:limit]
+    return cpus
+
+
+def get_plan(params: dict, processes: int = None, threads: int = None, cpus: List[int] = None) -> dict:
+    '''
+    Divides available cores between worker processes and intra-op threads. With params.gpu set to
+    true threads are set only when params.cpu_threads is set.
+
+    :param params: config.json params (processes, gpu, cpu_threads, cpu_pinning)
+    :param processes: the number of worker processes, params.processes by default
+    :param threads: the number of threads per worker, params.cpu_threads by default (0 - all
+                    available cores divided by the number of processes)
+    :param cpus: available cores, available_cpus() by default
+    :return: dictionary with the number of processes, threads per process (None - PyTorch default)
+             and core set of every worker (None - no pinning)
+    '''
+    if cpus is None:
+        cpus = available_cpus()
+    if processes is None:
+        processes = params["processes"]
+    if threads is None:
+        threads = params["cpu_threads"]
+    if threads < 0:
+        raise Exception(f'Unsupported cpu_threads: {threads}')
+    if not threads:
+        if params["gpu"]:
+            return {"cpus": len(cpus), "processes": processes, "threads": None, "cores": None}
+        threads = max(len(cpus) // processes, 1)
+    cores = None
+    if processes * threads > len(cpus):
+        logging.warning(f'{processes} processes with {threads} threads use more than {len(cpus)} available cores')
+    elif params["cpu_pinning"]:
+        cores = [cpus[i * threads:(i + 1) * threads] for i in range(processes)]
+    return {"cpus": len(cpus), "processes": processes, "threads": threads, "cores": cores}
+
+
+def apply_plan(plan: dict, worker: int):
+    '''
+    Sets the number of intra-op threads and core set of the current worker process
+
+    :param plan: get_plan result or None
+    :param worker: worker identifier (0 to processes-1)
+    '''
+    if not plan:
+        return
+    if plan["threads"]:
+        torch.set_num_threads(plan["threads"])
+    if plan["cores"]:
+        os.sched_setaffinity(0, plan["cores"][worker % len(plan["cores"])])
+
+
+def describe(plan: dict) -> str:
+    '''
+    Returns plan description to be logged
+    '''
+    return (f'CPU plan: cores: {plan["cpus"]}, processes: {plan["processes"]}, '
+            f'threads: {plan["threads"] or "default"}, pinning: {plan["cores"] is not None}')
+
+
+def get_configurations(cpus: int, max_processes: int = None) -> List[tuple]:
+    '''
+    Returns configurations measured by the calibration: the number of processes is a power of two
+    (and the number of cores), all cores are divided between the processes
+
+    :param cpus: the number of available cores
+    :param max_processes: max number of processes (memory limit), the number of cores by default
+    :return: list of (processes, threads) tuples
+    '''
+    limit = min(max_processes or cpus, cpus)
+    counts = []
+    processes = 1
+    while processes <= limit:
+        counts.append(processes)
+        processes *= 2
+    if limit not in counts:
+        counts.append(limit)
+    return [(p, max(cpus // p, 1)) for p in counts]
+
+
+def update_params(values: dict, path: str = "./config/config.json"):
+    '''
+    Writes parameters to config.json params, the file formatting is kept
+
+    :param values: dictionary with new parameter values
+    :param path: config file
+    '''
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    start = text.index('"params"')
+    end = text.index("}", start)
+    params = text[start:end]
+    for key, value in values.items():
+        params, count = re.subn('"' + key + r'":\s*[^,\n]+', f'"{key}": {value}', params)
+        if count != 1:
+            msg = f'Parameter {key} not found in {path}'
+            logging.error(msg)
+            raise Exception(msg)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text[:start] + params + text[end:])
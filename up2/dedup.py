@@ -0,0 +1,235 @@
+'''
+Duplicate sentence detection stores used by preprocess.py. Sentences are not kept
+in memory, only their 64-bit or 128-bit digests are stored either in memory (open addressing
+hash table in flat arrays) or on disk (sqlite database) for corpora that do not fit into memory.
+'''
+import hashlib
+import os
+import sqlite3
+from array import array
+
+COMMIT_SIZE = 100000
+# initial number of slots of the in-memory table (power of two)
+CAPACITY = 1024
+
+
+def digest(text: str, bits: int) -> bytes:
+    '''
+    Calculates sentence digest
+
+    :param text: sentence
+    :param bits: digest size in bits: 64 or 128
+    :return: digest bytes
+    '''
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=bits // 8).digest()
+
+
+def false_positive_rate(count: int, bits: int) -> float:
+    '''
+    Estimates probability that a new unique sentence is reported as duplicate
+    because its digest collides with one of the stored digests
+
+    :param count: number of stored digests
+    :param bits: digest size in bits
+    :return: false positive rate
+    '''
+    return count / 2 ** bits
+
+
+def expected_collisions(count: int, bits: int) -> float:
+    '''
+    Estimates the number of unique sentences wrongly removed as duplicates
+    in the whole corpus (birthday bound)
+
+    :param count: number of stored digests
+    :param bits: digest size in bits
+    :return: expected number of collisions
+    '''
+    return count * (count - 1) / 2 ** (bits + 1)
+
+
+class MemoryStore:
+    '''
+    In-memory open addressing hash table of sentence digests. Digests are stored in flat arrays
+    of 64-bit words (8 or 16 bytes per slot) with linear probing, the table is doubled when it
+    is more than 2/3 full, so one digest takes 12 - 24 bytes (64 bits) or 24 - 48 bytes (128 bits).
+    '''
+
+    def __init__(self, bits: int = 64, capacity: int = CAPACITY):
+        self.bits = bits
+        self.count = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity: int):
+        self.capacity = capacity
+        self.mask = capacity - 1
+        # low word 0 marks an empty slot
+        self.low = array("Q", [0]) * capacity
+        self.high = array("Q", [0]) * capacity if self.bits == 128 else None
+
+    def key(self, text: str) -> tuple:
+        '''
+        Splits sentence digest into 64-bit words
+
+        :param text: sentence
+        :return: tuple (low, high), high is 0 for 64-bit digests
+        '''
+        d = digest(text, self.bits)
+        low = int.from_bytes(d[:8], "little") or 1
+        high = int.from_bytes(d[8:], "little") if self.high is not None else 0
+        return low, high
+
+    def find(self, low: int, high: int) -> int:
+        '''
+        Returns slot of the digest or the empty slot where the digest is to be stored
+        '''
+        i = low & self.mask
+        while True:
+            value = self.low[i]
+            if value == 0 or (value == low and (self.high is None or self.high[i] == high)):
+                return i
+            i = (i + 1) & self.mask
+
+    def add(self, text: str) -> bool:
+        '''
+        Adds sentence to the store
+
+        :param text: sentence
+        :return: False if the sentence was already present in the store
+        '''
+        low, high = self.key(text)
+        i = self.find(low, high)
+        if self.low[i]:
+            return False
+        self.low[i] = low
+        if self.high is not None:
+            self.high[i] = high
+        self.count += 1
+        if self.count * 3 > self.capacity * 2:
+            self.resize(self.capacity * 2)
+        return True
+
+    def resize(self, capacity: int):
+        low, high = self.low, self.high
+        self.allocate(capacity)
+        for j in range(len(low)):
+            if low[j]:
+                i = self.find(low[j], high[j] if high is not None else 0)
+                self.low[i] = low[j]
+                if high is not None:
+                    self.high[i] = high[j]
+
+    def __contains__(self, text: str) -> bool:
+        return self.low[self.find(*self.key(text))] != 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def memory(self) -> int:
+        '''
+        Memory used by the table arrays in bytes
+        '''
+        size = len(self.low) * self.low.itemsize
+        if self.high is not None:
+            size += len(self.high) * self.high.itemsize
+        return size
+
+    def close(self):
+        self.allocate(CAPACITY)
+        self.count = 0
+
+
+class SqliteStore:
+    '''
+    Disk-backed store of sentence digests in a sqlite database
+    '''
+
+    def __init__(self, path: str, bits: int = 128):
+        self.bits = bits
+        self.path = path
+        self.count = 0
+        self.pending = 0
+        if os.path.exists(path):
+            os.remove(path)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute(
+            "CREATE TABLE digests (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+
+    def add(self, text: str) -> bool:
+        '''
+        Adds sentence to the store
+
+        :param text: sentence
+        :return: False if the sentence was already present in the store
+        '''
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO digests (digest) VALUES (?)", (digest(text, self.bits),))
+        if cursor.rowcount == 0:
+            return False
+        self.count += 1
+        self.pending += 1
+        if self.pending >= COMMIT_SIZE:
+            self.connection.commit()
+            self.pending = 0
+        return True
+
+    def __contains__(self, text: str) -> bool:
+        cursor = self.connection.execute(
+            "SELECT 1 FROM digests WHERE digest = ?", (digest(text, self.bits),))
+        return cursor.fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def memory(self) -> int:
+        '''
+        Approximate memory used by the store in bytes (sqlite page cache)
+        '''
+        page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        cache_size = self.connection.execute("PRAGMA cache_size").fetchone()[0]
+        if cache_size < 0:
+            # negative value is the cache size in KiB
+            return -cache_size * 1024
+        return cache_size * page_size
+
+    def close(self):
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def create_store(params: dict, folder: str):
+    '''
+    Creates duplicate detection store based on config/config.json -> params -> dedup_store
+    and dedup_bits
+
+    :param params: config.json params
+    :param folder: folder for the disk-backed store
+    :return: MemoryStore or SqliteStore
+    '''
+    store = params["dedup_store"]
+    bits = params["dedup_bits"]
+    if bits not in (64, 128):
+        raise Exception(f'Unsupported dedup_bits: {bits}')
+    if store == "memory":
+        return MemoryStore(bits)
+    if store == "sqlite":
+        os.makedirs(folder, exist_ok=True)
+        return SqliteStore(folder + "/dedup.sqlite", bits)
+    raise Exception(f'Unsupported dedup_store: {store}')
+
+
+def summary(store) -> str:
+    '''
+    Returns store statistics to be logged
+
+    :param store: MemoryStore or SqliteStore
+    :return: text with number of digests, memory usage and false positive estimates
+    '''
+    count = len(store)
+    return (f'Dedup store: {type(store).__name__}, digests: {count}, bits: {store.bits}, '
+            f'memory: {store.memory() / 1024 / 1024:.1f} MB ({store.memory() / max(count, 1):.1f} bytes per digest), '
+            f'false positive rate: {false_positive_rate(count, store.bits):.2e}, '
+            f'expected collisions: {expected_collisions(count, store.bits):.2e}')
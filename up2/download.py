@@ -4,12 +4,23 @@ in config/config.json file.
 '''
 import argparse
 import time
-import requests
 import os
+import json
+import hashlib
 import zipfile
+import gzip
+import shutil
 import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from urllib.parse import urlparse
+from typing import List, Union
 from utils import read_config
-import glob
+from fetch import stream_download, file_sha256, CHUNK_SIZE
+
+CACHE = "./data/cache"
+MANIFEST = CACHE + "/manifest.json"
 
 REPLACEMENTS = [
     {
@@ -44,60 +55,354 @@ def replacements(file: str) -> str:
     return file
 
 
-def download_file(source: str, type: str, url: str):
+def read_manifest() -> dict:
     '''
-    Downloads the set of files based on configuration in config/config.json file for specific dataset and url
+    Reads the download cache manifest from ./data/cache/manifest.json file
+
+    :return: manifest with archives (by url) and extracted datasets (by source/type)
+    '''
+    try:
+        with open(MANIFEST, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {"archives": {}, "extracted": {}}
+
+
+def save_manifest(manifest: dict):
+    '''
+    Atomically saves the download cache manifest
+
+    :param manifest: manifest to be saved
+    '''
+    os.makedirs(CACHE, exist_ok=True)
+    tmp = MANIFEST + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, indent=4))
+    os.replace(tmp, MANIFEST)
+
+
+def fetch_file(url: str, session: requests.Session = None, limits: dict = None,
+               entry: dict = None) -> dict:
+    '''
+    Downloads an archive into the content-addressed cache ./data/cache/[sha256].zip
+    without extracting it. In case the archive is already cached a conditional GET
+    request is sent and the cached copy is reused if it has not changed.
 
-    :param source: config.json -> sources - the name of source definition that is used to download files
-    :param type: one of: europarl, tatoeba, subtitles
     :param url: destination URL used to download a file configured in config/config.json
+    :param session: shared requests session
+    :param limits: per-host semaphores limiting the number of concurrent downloads
+    :param entry: manifest entry of the previously downloaded archive for this url
+    :return: dictionary with archive path, checksum, size, validators and download time
     '''
     logging.info(f'Starting: {url}')
-    dir = './data/source/' + source
-    os.makedirs(dir, exist_ok=True)
-    segments = url.split("/")
-    file = segments[len(segments) - 1]
-    path = dir + '/' + file
+    s1 = time.time()
+    result = {
+        "url": url,
+        "cached": False,
+        "etag": None,
+        "last_modified": None
+    }
     if "http" not in url:
-        with open(url, "rb") as f:
-            data = f.read()
+        result["path"] = url
+        result["sha256"] = file_sha256(url)
+        result["size"] = os.path.getsize(url)
     else:
-        r = requests.get(url, allow_redirects=True)
-        if r.status_code == 404:
-            msg = f'URL: {url} does not exist'
-            logging.error(msg)
-            raise Exception(msg)
-        data = r.content
-    length = round(len(data) / 1024 / 1024)
-    open(path, 'wb').write(data)
-    with zipfile.ZipFile(path, "r") as zip:
-        zip.extractall(dir + "/" + type)
-    os.remove(path)
+        os.makedirs(CACHE, exist_ok=True)
+        validators = None
+        if entry and os.path.isfile(CACHE + "/" + entry["file"]):
+            validators = entry
+        tmp = CACHE + "/" + hashlib.sha1(url.encode("utf-8")).hexdigest() + ".download"
+        host = urlparse(url).netloc
+        if limits is not None:
+            with limits[host]:
+                r = stream_download(url, tmp, session, validators=validators)
+        else:
+            r = stream_download(url, tmp, session, validators=validators)
+        result["etag"] = r["etag"]
+        result["last_modified"] = r["last_modified"]
+        if r["modified"]:
+            sha256 = file_sha256(tmp)
+            path = CACHE + "/" + sha256 + ".zip"
+            os.replace(tmp, path)
+            result["sha256"] = sha256
+            result["size"] = r["size"]
+        else:
+            logging.info(f'Not modified: {url}')
+            path = CACHE + "/" + entry["file"]
+            result["sha256"] = entry["sha256"]
+            result["size"] = entry["size"]
+            result["cached"] = True
+        result["path"] = path
+    s2 = time.time()
+    result["download"] = s2 - s1
+    return result
 
+
+def update_archive(manifest: dict, result: dict):
+    '''
+    Stores fetch_file result in the manifest and removes cached archive that is not
+    referenced by any url anymore
+
+    :param manifest: download cache manifest
+    :param result: fetch_file result
+    '''
+    if result["path"] == result["url"]:
+        return
+    archives = manifest["archives"]
+    previous = archives.get(result["url"])
+    archives[result["url"]] = {
+        "file": os.path.basename(result["path"]),
+        "sha256": result["sha256"],
+        "size": result["size"],
+        "etag": result["etag"],
+        "last_modified": result["last_modified"]
+    }
+    if previous and previous["file"] != archives[result["url"]]["file"]:
+        if all(a["file"] != previous["file"] for a in archives.values()):
+            path = CACHE + "/" + previous["file"]
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def is_extracted(entry: dict, sha256: str, compress: bool) -> bool:
+    '''
+    Checks if language files extracted from the archive are still the same as recorded
+    in the manifest
+
+    :param entry: manifest entry for extracted source and type
+    :param sha256: checksum of the archive
+    :param compress: information if extracted files should be gzip compressed
+    :return: information if extraction can be skipped
+    '''
+    if not entry or entry["archive"] != sha256 or not entry["files"]:
+        return False
+    if entry.get("compress", False) != compress:
+        return False
+    for file, checksum in entry["files"].items():
+        if not os.path.isfile(file) or file_sha256(file) != checksum:
+            return False
+    return True
+
+
+def get_members(zip: zipfile.ZipFile, langs: List[str]) -> dict:
+    '''
+    Selects archive members with sentences for the given languages, sidecar files
+    (.ids, .xml, README, LICENSE) are skipped
+
+    :param zip: opened archive
+    :param langs: languages to be extracted
+    :return: dictionary with member name as a key and output file name (after replacements) as a value
+    '''
+    members = {}
+    for info in zip.infolist():
+        if info.is_dir():
+            continue
+        name = replacements(os.path.basename(info.filename))
+        for lang in langs:
+            if name.endswith("." + lang):
+                members[info.filename] = name
+    return members
+
+
+def extract_file(source: str, type: str, path: str, langs: List[str],
+                 compress: bool = False) -> dict:
+    '''
+    Extracts files for the given languages from a downloaded archive into
+    ./data/source/[source]/[type] folder. Members are streamed from the archive
+    into the output files (optionally gzip compressed).
+
+    :param source: config.json -> sources - the name of source definition that is used to download files
+    :param type: one of: europarl, tatoeba, subtitles
+    :param path: archive path
+    :param langs: languages of the files to be extracted
+    :param compress: gzip compress extracted files
+    :return: dictionary with checksums of extracted language files and extraction time
+    '''
+    s1 = time.time()
     dir = './data/source/' + source + '/' + type
-    for file in glob.glob(dir + "/*"):
-        newfile = replacements(file)
-        if newfile != file:
-            os.rename(file, newfile)
-            logging.info(f'Renaming {file} to {newfile}')
+    os.makedirs(dir, exist_ok=True)
+    files = {}
+    with zipfile.ZipFile(path, "r") as zip:
+        for member, name in get_members(zip, langs).items():
+            file = dir + "/" + name
+            if member != name:
+                logging.info(f'Renaming {member} to {name}')
+            # only one file per language can be present in the dataset folder
+            if compress:
+                other = file
+                file = file + ".gz"
+            else:
+                other = file + ".gz"
+            if os.path.isfile(other):
+                os.remove(other)
+            tmp = file + ".tmp"
+            with zip.open(member) as src:
+                if compress:
+                    dst = gzip.open(tmp, "wb")
+                else:
+                    dst = open(tmp, "wb")
+                with dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            os.replace(tmp, file)
+            files[file] = file_sha256(file)
+
+    s2 = time.time()
+    return {
+        "files": files,
+        "extract": s2 - s1
+    }
+
+
+def get_langs(config: dict, source: str) -> List[str]:
+    '''
+    Returns source and target language of a given source definition
+
+    :param config: config.json file content
+    :param source: config.json -> sources - the name of source definition
+    :return: list with source and target language
+    '''
+    return [config["sources"][source]["src_lang"], config["sources"][source]["tgt_lang"]]
+
+
+def download_file(source: str, type: str, url: str):
+    '''
+    Downloads the set of files based on configuration in config/config.json file for specific dataset and url
 
+    :param source: config.json -> sources - the name of source definition that is used to download files
+    :param type: one of: europarl, tatoeba, subtitles
+    :param url: destination URL used to download a file configured in config/config.json
+    '''
+    config = read_config()
+    manifest = read_manifest()
+    result = fetch_file(url, entry=manifest["archives"].get(url))
+    update_archive(manifest, result)
+    key = source + "/" + type
+    compress = config["download"]["compress"]
+    if is_extracted(manifest["extracted"].get(key), result["sha256"], compress):
+        logging.info(f'Skipping extraction: {key}')
+    else:
+        extracted = extract_file(source, type, result["path"],
+                                 get_langs(config, source), compress)
+        manifest["extracted"][key] = {
+            "archive": result["sha256"],
+            "compress": compress,
+            "files": extracted["files"]
+        }
+    save_manifest(manifest)
+    length = round(result["size"] / 1024 / 1024)
     logging.info(f'Completed: {url}, file size: {length} MB')
 
-def download(source):
-    logging.info(f'Starting download: {source}')
+
+def get_host_limits(config: dict, urls: List[str]) -> dict:
+    '''
+    Creates semaphores limiting concurrent downloads per host based on
+    config/config.json -> download -> hosts
+
+    :param config: config.json file content
+    :param urls: list of urls to be downloaded
+    :return: dictionary with a semaphore for each host
+    '''
+    hosts = config["download"]["hosts"]
+    limits = {}
+    for url in urls:
+        host = urlparse(url).netloc
+        if host not in limits:
+            limits[host] = threading.BoundedSemaphore(
+                hosts.get(host, hosts["default"]))
+    return limits
+
+
+def log_summary(results: List[dict]):
+    '''
+    Logs download and extraction throughput for each downloaded file
+
+    :param results: list of fetch_file results extended with source, type and extraction time
+    '''
+    logging.info('Summary: source / dataset / size MB / download s / MB/s / cached / extract s')
+    for r in results:
+        size = r["size"] / 1024 / 1024
+        speed = size / r["download"] if r["download"] > 0 and not r["cached"] else 0
+        extract = f'{r["extract"]:.2f}' if r["extract"] is not None else "skipped"
+        logging.info(
+            f'{r["source"]} / {r["type"]} / {size:.1f} / {r["download"]:.2f} / {speed:.2f} / {r["cached"]} / {extract}')
+
+
+def download(sources: Union[str, List[str]]):
+    '''
+    Downloads and extracts all datasets for the given sources. Downloads run on a bounded
+    thread pool sharing one requests session and extractions run on a process pool.
+    Archives shared by several sources are downloaded once.
+
+    :param sources: the name or the list of names of source definitions from config/config.json
+    '''
+    if isinstance(sources, str):
+        sources = [sources]
+
+    logging.info(f'Starting download: {", ".join(sources)}')
 
     t0 = time.time()
 
     config = read_config()
 
-    if source not in config["sources"]:
-        msg = f'Sources definition for: {source} not available'
-        logging.error(msg)
-        raise Exception(msg)
+    for source in sources:
+        if source not in config["sources"]:
+            msg = f'Sources definition for: {source} not available'
+            logging.error(msg)
+            raise Exception(msg)
+
+    files = {}
+    for source in sources:
+        datasets = config["sources"][source]["datasets"]
+        for d in datasets:
+            files.setdefault(datasets[d], []).append((source, d))
 
-    downloads = config["sources"][source]
-    for d in downloads["datasets"]:
-        download_file(source, d, downloads["datasets"][d])
+    threads = config["download"]["threads"]
+    processes = config["download"]["processes"]
+    compress = config["download"]["compress"]
+    limits = get_host_limits(config, list(files))
+    manifest = read_manifest()
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=threads)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    results = []
+    with ThreadPoolExecutor(threads) as download_pool, \
+            ProcessPoolExecutor(processes) as extract_pool:
+        fetched = [download_pool.submit(fetch_file, url, session, limits,
+                                        manifest["archives"].get(url))
+                   for url in files]
+        extracted = []
+        for f in as_completed(fetched):
+            r = f.result()
+            update_archive(manifest, r)
+            save_manifest(manifest)
+            for source, type in files[r["url"]]:
+                result = dict(r, source=source, type=type, extract=None)
+                results.append(result)
+                key = source + "/" + type
+                if is_extracted(manifest["extracted"].get(key), r["sha256"], compress):
+                    logging.info(f'Skipping extraction: {key}')
+                    continue
+                extracted.append((result, extract_pool.submit(
+                    extract_file, source, type, r["path"], get_langs(config, source),
+                    compress)))
+        for r, e in extracted:
+            e = e.result()
+            r["extract"] = e["extract"]
+            manifest["extracted"][r["source"] + "/" + r["type"]] = {
+                "archive": r["sha256"],
+                "compress": compress,
+                "files": e["files"]
+            }
+            save_manifest(manifest)
+            length = round(r["size"] / 1024 / 1024)
+            logging.info(f'Completed: {r["url"]}, file size: {length} MB')
+
+    session.close()
+
+    log_summary(results)
 
     t1 = time.time()
 
@@ -107,9 +412,14 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
         description='Download')
-    parser.add_argument('--source', type=str,
-                        help='Language pair from config/config.json -> sources for example: en-de')
+    parser.add_argument('--source', type=str, nargs='+',
+                        help='Language pairs from config/config.json -> sources for example: en-de en-fr')
+    parser.add_argument('--all', action='store_true',
+                        help='Download all sources from config/config.json')
 
     args = parser.parse_args()
 
-    download(args.source)
+    if args.all:
+        download(list(read_config()["sources"]))
+    else:
+        download(args.source)
@@ -0,0 +1,153 @@
+'''
+Streaming HTTP download helpers shared by the download scripts.
+Files are written in fixed-size chunks to a .part file, interrupted transfers
+are resumed with HTTP Range requests and the file is renamed only when complete.
+'''
+import os
+import time
+import hashlib
+import logging
+import requests
+
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 5
+BACKOFF = 1.0
+TIMEOUT = 60
+
+RETRYABLE = (requests.exceptions.RequestException, IOError)
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+def get_content_length(response: requests.Response, offset: int) -> int:
+    '''
+    Returns the expected size of the whole file based on response headers
+
+    :param response: response for a (possibly ranged) GET request
+    :param offset: number of bytes already available in the .part file
+    :return: expected file size or None when the server does not report it
+    '''
+    content_range = response.headers.get("Content-Range")
+    if content_range and "/" in content_range:
+        total = content_range.split("/")[-1]
+        if total.isdigit():
+            return int(total)
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit():
+        return int(length) + offset
+    return None
+
+
+def file_sha256(path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    '''
+    Calculates SHA-256 checksum of a file reading it in chunks
+
+    :param path: file path
+    :param chunk_size: size of chunks read from the file
+    :return: hex digest of the file content
+    '''
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def stream_download(url: str, path: str, session: requests.Session = None,
+                    chunk_size: int = CHUNK_SIZE, retries: int = RETRIES,
+                    backoff: float = BACKOFF, timeout: int = TIMEOUT,
+                    validators: dict = None) -> dict:
+    '''
+    Downloads a file to the given path without keeping it in memory. Data is written
+    to path + ".part" and, in case of a dropped connection, the download is resumed
+    from the last written byte with an HTTP Range request. When validators of a
+    previously downloaded copy are provided a conditional GET request is sent and
+    nothing is downloaded if the file has not changed.
+
+    :param url: URL of the file to be downloaded
+    :param path: destination file path
+    :param session: requests session to be used, a new one is created when not provided
+    :param chunk_size: size of chunks written to the .part file
+    :param retries: number of retries after a failed or incomplete transfer
+    :param backoff: base delay in seconds between retries, doubled after each retry
+    :param timeout: connection and read timeout in seconds
+    :param validators: dictionary with etag and last_modified of a previously downloaded copy
+    :return: dictionary with modified flag, file size, etag and last_modified of the file
+    '''
+    if session is None:
+        session = requests.Session()
+    part = path + ".part"
+    attempt = 0
+    etag = None
+    last_modified = None
+    while True:
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {}
+        if offset:
+            headers["Range"] = f'bytes={offset}-'
+            if etag:
+                # the whole file is sent again if it changed since the first request
+                headers["If-Range"] = etag
+        elif validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        try:
+            with session.get(url, headers=headers, stream=True, allow_redirects=True,
+                             timeout=timeout) as r:
+                if r.status_code == 404:
+                    msg = f'URL: {url} does not exist'
+                    logging.error(msg)
+                    raise Exception(msg)
+                if r.status_code == 304:
+                    return {
+                        "modified": False,
+                        "size": None,
+                        "etag": validators.get("etag"),
+                        "last_modified": validators.get("last_modified")
+                    }
+                if r.status_code == 416:
+                    # the .part file is either already complete or does not match the server file
+                    if get_content_length(r, 0) == offset:
+                        break
+                    os.remove(part)
+                    raise IncompleteDownload(f'Range not satisfiable for: {url}')
+                r.raise_for_status()
+                mode = "ab"
+                if r.status_code != 206:
+                    # the server ignored the Range header and sent the whole file
+                    offset = 0
+                    mode = "wb"
+                total = get_content_length(r, offset)
+                etag = r.headers.get("ETag", etag)
+                last_modified = r.headers.get("Last-Modified", last_modified)
+                with open(part, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+            size = os.path.getsize(part)
+            if total is not None and size != total:
+                if size > total:
+                    os.remove(part)
+                raise IncompleteDownload(
+                    f'Incomplete download: {url}, {size} of {total} bytes')
+            break
+        except RETRYABLE as e:
+            attempt += 1
+            if attempt > retries:
+                logging.error(f'Download failed: {url} {e}')
+                raise e
+            delay = backoff * 2 ** (attempt - 1)
+            logging.warning(
+                f'Download interrupted: {url} {e}, retry {attempt} of {retries} in {delay:.1f} s')
+            time.sleep(delay)
+    os.replace(part, path)
+    return {
+        "modified": True,
+        "size": os.path.getsize(path),
+        "etag": etag,
+        "last_modified": last_modified
+    }
@@ -2,9 +2,11 @@
 Used only if params.save_batch is set to true. Allows to merge all the batch results 
 from ./data/[pipeline]/align/tmp/ to a single file that contain all sentences stored 
 in ./data/[pipeline]/align/ folder.
+Batches recorded in checkpoint manifests (all shards) are verified before they are merged.
 '''
 import argparse
 from utils import read_config
+from checkpoint import read_manifests, check_batches
 import logging
 import time
 import glob
@@ -24,6 +26,28 @@ logging.basicConfig(
 )
 
 
+def verify(pipeline: str) -> dict:
+    '''
+    Verifies that batches recorded in checkpoint manifests of all shards are complete: all batches
+    are present, sentence ranges are contiguous and files match their checksums
+
+    :param pipeline: pipeline name from config/config.json file that is processed
+    :return: dictionary with manifest entries by batch index, empty if there are no manifests
+    '''
+    batches = read_manifests("./data/" + pipeline + "/checkpoint", "align")
+    if not batches:
+        logging.warning('Checkpoint manifest not found, batches are not verified')
+        return batches
+    errors = check_batches(batches)
+    if errors:
+        msg = 'Batches cannot be merged: ' + "; ".join(errors)
+        logging.error(msg)
+        raise Exception(msg)
+    sentences = sum(entry["sentences"] for entry in batches.values())
+    logging.info(f'Verified batches: {len(batches)}, sentences: {sentences}')
+    return batches
+
+
 def merge(config: dict, pipeline: str):
     '''
     Merges alignment results stored in /tmp folder (for batch_save=true) into one file
@@ -32,11 +56,15 @@ def merge(config: dict, pipeline: str):
     :param pipeline: pipeline name from config/config.json file that is processed
     '''
     folder = "./data/" + pipeline + "/aligned"
+    batches = verify(pipeline)
     try:
-        mask = folder + "/tmp/training.*.align"
         name = folder + "/training.align"
-        files = glob.glob(mask)
-        files.sort()
+        if batches:
+            files = [f["path"] for index in sorted(batches) for f in batches[index]["files"]]
+        else:
+            mask = folder + "/tmp/training.*.align"
+            files = glob.glob(mask)
+            files.sort()
         with open(name, 'w', encoding='utf8') as outfile:
             length = len(files) - 1
             for i, file in enumerate(files):
@@ -3,9 +3,11 @@ Used only if params.save_batch is set to true. Allows to merge all the batch res
 from ./data/[pipeline]/tokenized/tmp/ and ./data/[pipeline]/parsed/tmp to single files 
 that contain all sentences stored in ./data/[pipeline]/tokenized/ and 
 ./data/[pipeline]/parsed/ folders.
+Batches recorded in checkpoint manifests (all shards) are verified before they are merged.
 '''
 import argparse
 from utils import read_config
+from checkpoint import read_manifests, check_batches
 import logging
 import time
 import glob
@@ -25,7 +27,30 @@ logging.basicConfig(
 )
 
 
-def merge_lang(pipeline: str, type: str, ext: str, lang: str):
+def verify(pipeline: str, lang: str) -> dict:
+    '''
+    Verifies that batches recorded in checkpoint manifests of all shards are complete: all batches
+    are present, sentence ranges are contiguous and files match their checksums
+
+    :param pipeline: pipeline name from config/config.json file that is processed
+    :param lang: language to be processed
+    :return: dictionary with manifest entries by batch index, empty if there are no manifests
+    '''
+    batches = read_manifests("./data/" + pipeline + "/checkpoint", "parse." + lang)
+    if not batches:
+        logging.warning(f'Checkpoint manifest for {lang} not found, batches are not verified')
+        return batches
+    errors = check_batches(batches)
+    if errors:
+        msg = f'Batches for {lang} cannot be merged: ' + "; ".join(errors)
+        logging.error(msg)
+        raise Exception(msg)
+    sentences = sum(entry["sentences"] for entry in batches.values())
+    logging.info(f'Verified {lang} batches: {len(batches)}, sentences: {sentences}')
+    return batches
+
+
+def merge_lang(pipeline: str, type: str, ext: str, lang: str, batches: dict = None):
     '''
     Merges parse results for source or target language stored in /tmp folder (for batch_save=true) into one file
 
@@ -33,13 +58,18 @@ def merge_lang(pipeline: str, type: str, ext: str, lang: str):
     :param type: file type to be processed: parsed or tokenized
     :param ext: file extension to be processed
     :param lang: language to be processed
+    :param batches: verified manifest entries by batch index, if not provided all batch files are merged
     '''
     folder = "./data/" + pipeline + "/" + type
     try:
-        mask = folder + "/tmp/" + pipeline + "." + lang + "*"
         name = folder + "/" + pipeline + "." + lang + "." + type + "." + ext
-        files = glob.glob(mask)
-        files.sort()
+        if batches:
+            files = [f["path"] for index in sorted(batches)
+                     for f in batches[index]["files"] if f["path"].endswith("." + ext)]
+        else:
+            mask = folder + "/tmp/" + pipeline + "." + lang + "." + type + ".*." + ext
+            files = glob.glob(mask)
+            files.sort()
         with open(name, 'w', encoding='utf8') as outfile:
             length = len(files) - 1
             for i, file in enumerate(files):
@@ -53,7 +83,7 @@ def merge_lang(pipeline: str, type: str, ext: str, lang: str):
         raise e
 
 
-def merge(config: dict, pipeline: str, type: str, ext: str):
+def merge(config: dict, pipeline: str, type: str, ext: str, batches: dict = None):
     '''
     Merges parse results stored in /tmp folder (for batch_save=true) into one file
 
@@ -61,12 +91,14 @@ def merge(config: dict, pipeline: str, type: str, ext: str):
     :param pipeline: pipeline name from config.json file that is processed
     :param type: file type to be processed: parsed or tokenized
     :param ext: file extension to be processed
+    :param batches: verified manifest entries by language
     '''
     src = config["pipelines"][pipeline]["source"]
     src_lang = config["sources"][src]["src_lang"]
     tgt_lang = config["sources"][src]["tgt_lang"]
-    merge_lang(pipeline, type, ext, src_lang)
-    merge_lang(pipeline, type, ext, tgt_lang)
+    batches = batches or {}
+    merge_lang(pipeline, type, ext, src_lang, batches.get(src_lang))
+    merge_lang(pipeline, type, ext, tgt_lang, batches.get(tgt_lang))
 
 def merge_parse(pipeline):
     config = read_config()
@@ -80,8 +112,13 @@ def merge_parse(pipeline):
 
     logging.info(f'Processing {pipeline}')
 
-    merge(config, pipeline, "tokenized", "txt")
-    merge(config, pipeline, "parsed", "conllu")
+    src = config["pipelines"][pipeline]["source"]
+    batches = {}
+    for lang in [config["sources"][src]["src_lang"], config["sources"][src]["tgt_lang"]]:
+        batches[lang] = verify(pipeline, lang)
+
+    merge(config, pipeline, "tokenized", "txt", batches)
+    merge(config, pipeline, "parsed", "conllu", batches)
 
     s2 = time.time()
     logging.info(f'Total processing time: {s2-s1} seconds')
@@ -6,11 +6,20 @@ import argparse
 import time
 import requests
 import os
+import json
 import logging
 from utils import read_config
+import fetch
+from fetch import stream_download, file_sha256
 import re
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
+MANIFEST = "./data/ud/manifest.json"
+
+if not os.path.exists("./logs/"):
+    os.makedirs("./logs/")
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s %(message)s',
@@ -23,67 +32,159 @@ logging.basicConfig(
 )
 
 
-def download_file(source: str, url: str):
+def read_manifest() -> dict:
     '''
-    Downloads the set of conllu files (dev, train, test) based on configuration in config/config.json file for specific universal-depencencies url
+    Reads ./data/ud/manifest.json file with checksums and validators of downloaded files
 
-    :param source: config/config.json -> universal-dependencies - the name of the definition that is used to download files
-    :param url: destination URL used to download the set of conllu files (dev, train, test) configured in config/config.json
+    :return: manifest with downloaded files (by file path)
     '''
-    logging.info(f'Starting: {url}')
-    dir = './data/ud/' + source
-    r = requests.get(url, allow_redirects=True)
-    urlp = urlparse(url)
+    try:
+        with open(MANIFEST, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest: dict):
+    '''
+    Atomically saves the manifest of downloaded files
+
+    :param manifest: manifest to be saved
+    '''
+    os.makedirs(os.path.dirname(MANIFEST), exist_ok=True)
+    tmp = MANIFEST + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, indent=4))
+    os.replace(tmp, MANIFEST)
+
+
+def get_file_urls(session: requests.Session, url: str) -> List[str]:
+    '''
+    Finds links to conllu files (dev, train, test) on universal-dependencies treebank page
+
+    :param session: shared requests session
+    :param url: treebank page url configured in config/config.json
+    :return: list of urls of raw conllu files
+    '''
+    r = session.get(url, allow_redirects=True, timeout=fetch.TIMEOUT)
     if r.status_code == 404:
-        print("URL does not exist")
-    os.makedirs(dir, exist_ok=True)
-    data = r.content
-    html = data.decode("utf-8")
+        msg = f'URL: {url} does not exist'
+        logging.error(msg)
+        raise Exception(msg)
+    r.raise_for_status()
+    urlp = urlparse(url)
+    html = r.content.decode("utf-8")
 
     urls = re.findall("(?<=href=\").*?(?=.conllu)", html)
 
-    length = 0
-
+    result = []
     for u in urls:
         uc = u + ".conllu"
         furl = urlp.scheme+"://"+urlp.netloc + uc
-        furl = furl.replace("/blob/", "/raw/")
-        r = requests.get(furl, allow_redirects=True)
-        if r.status_code == 404:
-            print("URL does not exist")
-        data = r.content
-        length += round(len(data) / 1024 / 1024)
-        filename = os.path.basename(uc)
-        path = dir + '/' + filename
-        open(path, 'wb').write(data)
+        result.append(furl.replace("/blob/", "/raw/"))
+    return result
 
-    logging.info(
-        f'Completed: {url}, total files size (dev, train, test): {length} MB')
 
+def download_conllu(session: requests.Session, url: str, path: str, entry: dict) -> dict:
+    '''
+    Streams single conllu file to ./data/ud/[source] folder. The file is skipped when
+    the server reports it as not modified and the local copy matches the checksum
+    from the manifest.
+
+    :param session: shared requests session
+    :param url: raw conllu file url
+    :param path: destination file path
+    :param entry: manifest entry of the previously downloaded file
+    :return: manifest entry of the downloaded file extended with skipped flag
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    validators = None
+    if entry and os.path.isfile(path) and file_sha256(path) == entry["sha256"]:
+        validators = entry
+    r = stream_download(url, path, session, validators=validators)
+    if not r["modified"]:
+        return dict(entry, skipped=True)
+    return {
+        "url": url,
+        "sha256": file_sha256(path),
+        "size": r["size"],
+        "etag": r["etag"],
+        "last_modified": r["last_modified"],
+        "skipped": False
+    }
+
+
+def download(sources: List[str]):
+    '''
+    Downloads the set of conllu files (dev, train, test) for many universal-dependencies
+    treebanks in parallel over one pooled session. Unchanged files are skipped.
 
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser(
-        description='Download')
-    parser.add_argument('--ud', type=str,
-                        help='Language for universal-dependencies')
-
-    args = parser.parse_args()
-
-    logging.info(f'Starting download: {args.ud}')
+    :param sources: the list of names of definitions from config/config.json -> universal-dependencies
+    '''
+    logging.info(f'Starting download: {", ".join(sources)}')
 
     t0 = time.time()
 
     config = read_config()
 
-    if args.ud not in config["universal-dependencies"]:
-        msg = f"Universal dependencies: {args.ud} definition not available"
-        logging.info(msg)
-        raise Exception(msg)
-
-    download_url = config["universal-dependencies"][args.ud]
-    download_file(args.ud, download_url)
+    for source in sources:
+        if source not in config["universal-dependencies"]:
+            msg = f"Universal dependencies: {source} definition not available"
+            logging.info(msg)
+            raise Exception(msg)
+
+    threads = config["download"]["threads"]
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=threads)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    manifest = read_manifest()
+
+    with ThreadPoolExecutor(threads) as pool:
+        pages = [(source, pool.submit(get_file_urls, session, config["universal-dependencies"][source]))
+                 for source in sources]
+        files = []
+        for source, page in pages:
+            for url in page.result():
+                path = './data/ud/' + source + '/' + os.path.basename(url)
+                files.append((source, path, pool.submit(
+                    download_conllu, session, url, path, manifest.get(path))))
+        stats = {source: {"size": 0, "skipped": 0} for source in sources}
+        for source, path, f in files:
+            r = f.result()
+            if r.pop("skipped"):
+                stats[source]["skipped"] += 1
+            else:
+                stats[source]["size"] += r["size"]
+            manifest[path] = r
+            save_manifest(manifest)
+
+    session.close()
+
+    for source in sources:
+        length = round(stats[source]["size"] / 1024 / 1024)
+        logging.info(
+            f'Completed: {config["universal-dependencies"][source]}, total files size (dev, train, test): {length} MB, unchanged files: {stats[source]["skipped"]}')
 
     t1 = time.time()
 
     logging.info(f'Total downloading time: {(t1 - t0):.2f} s')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Download')
+    parser.add_argument('--ud', type=str, nargs='+',
+                        help='Languages for universal-dependencies')
+    parser.add_argument('--all', action='store_true',
+                        help='Download all universal-dependencies definitions')
+
+    args = parser.parse_args()
+
+    if args.all:
+        download(list(read_config()["universal-dependencies"]))
+    else:
+        download(args.ud)
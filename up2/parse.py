@@ -5,17 +5,34 @@ Input files are read from ./data/[pipeline]/bitext_raw/ folder.
 Output files are stored in: ./data/[pipeline]/parsed/ and ./data/[pipeline]/tokenized/ folders.
 '''
 
+import copy
+import hashlib
 import multiprocessing
+import queue
+import random
+import signal
+import threading
 import stanza
+from stanza.pipeline.registry import PIPELINE_NAMES
 import time
 import argparse
-import stanza
+from collections import deque
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import torch
-from stanza.utils.conll import CoNLL
 import json
 import logging
 from utils import read_config, get_cuda_info, set_cuda_device
+from parse_cache import ParseCache, create_cache, summary as cache_summary
+from checkpoint import Checkpoint, get_manifest, get_run, in_shard, remove_queue_manifests, write_file
+from batch_queue import BatchQueue, drain, get_owner
+from batch_metrics import MetricsWriter, get_metrics_file, max_rss, summary as metrics_summary
+from cpu_planner import apply_plan, available_cpus, describe, get_configurations, get_plan, update_params
+from pipeline_cache import PipelineCache
+from prefilter import TokensReader, get_dropped_file, get_tokens_file, read_dropped
+import service_client
+from quantization import VERSION as QUANTIZED_VERSION, compare_documents, quantize_pipeline, use_quantization, \
+    summary as quantization_summary
 import os
 from typing import List
 
@@ -33,97 +50,336 @@ logging.basicConfig(
 )
 
 LINESEP = "\n"
+PROCESSORS = 'tokenize,pos,lemma,depparse'
+# processors run by the tokenize-only pre-pass (mwt is added by stanza when the language needs it)
+PREFILTER_PROCESSORS = 'tokenize'
+PRETOKENIZED = ('tokenize', 'mwt')
+CALIBRATION_SENTENCES = 1000
+EVALUATION_SENTENCES = 500
+WARMUP_SENTENCES = 10
 
 nlp = None
+pipelines = None
+device = None
 
 
-def doc2conll_text(doc: stanza.Document) -> str:
+def word2conll(word) -> str:
     '''
-    Converts Stanza document to string that contains data in CoNLL-U format
+    Converts Stanza word to a CoNLL-U line, the same as CoNLL.convert_token_dict(word.to_dict())
 
-    :param doc: stanza.Document to be converted
-    :return: string with CoNLL-U data
+    :param word: stanza word
+    :return: CoNLL-U line without new line character
     '''
-    doc_conll = CoNLL.doc2conll(doc)
-    for sentence in doc_conll:
-        for i, line in enumerate(sentence):
-            seg = line.split("\t")
-            if len(seg[0].split("-")) == 2:
-                del sentence[i]
-    return "\n\n".join("\n".join(line for line in sentence)
-                       for sentence in doc_conll) + "\n\n"
+    misc = []
+    if word.misc:
+        misc.append(word.misc)
+    if word.start_char is not None:
+        misc.append("start_char=" + str(word.start_char))
+    if word.end_char is not None:
+        misc.append("end_char=" + str(word.end_char))
+    head = word.head
+    if head is None:
+        # dummy head as inserted by stanza CoNLL converter
+        head = word.id - 1
+    return "\t".join((
+        str(word.id),
+        "_" if word.text is None else str(word.text),
+        "_" if word.lemma is None else str(word.lemma),
+        "_" if word.upos is None else str(word.upos),
+        "_" if word.xpos is None else str(word.xpos),
+        "_" if word.feats is None else str(word.feats),
+        str(head),
+        "_" if word.deprel is None else str(word.deprel),
+        "_" if word.deps is None else str(word.deps),
+        "|".join(misc) if misc else "_"
+    ))
 
 
-def check_if_result(pipeline: str, lang: str, index: int) -> bool:
+def get_checkpoint(pipeline: str, lang: str, shard_index: int = 0, num_shards: int = 1,
+                   owner: str = None, run: str = None) -> Checkpoint:
     '''
-    Checks if temporary result is available in the file system for a given pipeline, 
-    language and batch index
+    Opens checkpoint manifest of saved batches (config.json parameter batch_save=true) for 
+    a given pipeline, language and shard or batch queue job
 
     :param pipeline: processing pipeline from config.json file
     :param lang: source or target language identifier
-    :param index: batch index to be checked
-    :return: information if file is present or not
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards
+    :param owner: identifier of the job draining the batch queue, None without queue
+    :param run: run key of the job (see checkpoint.get_run)
+    :return: Checkpoint
     '''
-    folder_tokenized = "./data/" + pipeline + "/tokenized/tmp"
-    s = ""
-    if index:
-        s = str(index).zfill(4) + "."
-    file_tokenized = folder_tokenized + "/" + \
-        pipeline + "." + lang + ".tokenized." + s + "txt"
-    return os.path.isfile(file_tokenized)
+    folder = "./data/" + pipeline + "/checkpoint"
+    return Checkpoint(get_manifest(folder, "parse." + lang, shard_index, num_shards, owner), run)
 
 
-def process_batch(batch_data: dict) -> dict:
+def get_quarantine_file(pipeline: str, lang: str, shard_index: int = 0, num_shards: int = 1,
+                        owner: str = None) -> str:
     '''
-    Processes single batch
+    Returns file with sentences exceeding the time budget (params.sentence_time_budget) for a given
+    pipeline, language and job
 
-    :param batch_data: dictionary containing all information required to process a given batch
-    :return: dictionary with batch processing result, in case batch_save is set to true in 
-            config.json None is returned and then merge-parse.py script must be used to merge partial
-            results into one file
+    :param pipeline: processing pipeline from config.json file
+    :param lang: source or target language identifier
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards
+    :param owner: identifier of the job draining the batch queue, None without queue
+    :return: quarantine file name
+    '''
+    folder = "./data/" + pipeline + "/parsed"
+    return get_manifest(folder, pipeline + "." + lang + ".quarantine", shard_index, num_shards, owner)
+
+
+def get_queue(pipeline: str, lang: str, params: dict) -> BatchQueue:
     '''
+    Opens batch queue shared by all jobs processing a given pipeline and language (--queue argument)
+
+    :param pipeline: processing pipeline from config.json file
+    :param lang: source or target language identifier
+    :param params: config.json params (queue_lease, queue_retries)
+    :return: BatchQueue
+    '''
+    path = "./data/" + pipeline + "/checkpoint/parse." + lang + ".queue.sqlite"
+    return BatchQueue(path, params["queue_lease"], params["queue_retries"])
+
+
+def remove_queue_files(pipeline: str, lang: str):
+    '''
+    Removes checkpoint manifests, metrics and quarantine files of jobs of an earlier batch queue,
+    called when a new queue is created
+
+    :param pipeline: processing pipeline from config.json file
+    :param lang: source or target language identifier
+    '''
+    files = [get_manifest("./data/" + pipeline + "/checkpoint", "parse." + lang),
+             get_metrics_file(pipeline, lang), get_quarantine_file(pipeline, lang)]
+    removed = sum(remove_queue_manifests(f) for f in files)
+    if removed:
+        logging.info(f'Removed files of an earlier batch queue: {removed}')
+
+
+def get_device(worker: int, gpu: bool):
+    '''
+    Assigns processing device to a given worker
+
+    :param worker: worker identifier (0 to processes-1)
+    :param gpu: processing on gpu or cpu
+    :return: cuda device number or "cpu"
+    '''
+    if not gpu:
+        return "cpu"
+    if torch.cuda.device_count() == 0:
+        raise Exception("GPU device not found")
+    return worker % torch.cuda.device_count()
+
+
+def load_pipeline(lang: str, gpu: bool, processors: str = PROCESSORS) -> stanza.Pipeline:
+    '''
+    Loads stanza pipeline for a given language from locally stored models
+
+    :param lang: processing language
+    :param gpu: processing on gpu or cpu
+    :param processors: stanza processors
+    :return: stanza.Pipeline
+    '''
+    # add tokenize_pretokenized=False in case we need to provide tokenized content
+    return stanza.Pipeline(lang, processors=processors, use_gpu=gpu,
+                           depparse_min_length_to_batch_separately=40, deepparse_batch_size=25)
+
+
+def get_model_version(lang: str) -> str:
+    '''
+    Returns version of locally stored stanza models for a given language, the version changes
+    when any of the language models is updated
+
+    :param lang: processing language
+    :return: stanza version and digest of language resources
+    '''
+    resources_file = os.path.join(stanza.resources.common.DEFAULT_MODEL_DIR, "resources.json")
+    try:
+        with open(resources_file, "r", encoding="utf-8") as f:
+            resources = json.load(f)[lang]
+    except Exception:
+        resources = None
+    digest = hashlib.sha1(json.dumps(resources, sort_keys=True).encode("utf-8")).hexdigest()
+    return stanza.__version__ + "-" + digest
+
+
+def init_worker(lang: str, gpu: bool, workers, plan: dict = None, processors: str = PROCESSORS,
+                quantize: bool = False, cache_size: int = 0):
+    '''
+    Worker initializer, loads stanza pipeline once per worker before the first batch
+
+    :param lang: processing language, None in multi-language mode (pipelines are loaded by the first 
+                 batch of every language)
+    :param gpu: processing on gpu or cpu
+    :param workers: queue with worker identifiers, every worker takes one of them
+    :param plan: CPU plan (threads and cores of every worker, see cpu_planner.get_plan)
+    :param processors: stanza processors
+    :param quantize: apply dynamic int8 quantization to the loaded models (params.quantize, cpu only)
+    :param cache_size: max size in MB of models kept by the worker (params.pipeline_cache_size)
+    '''
+    global pipelines, device
     s1 = time.time()
+    worker = workers.get()
+    apply_plan(plan, worker)
+    device = get_device(worker, gpu)
+    if gpu:
+        set_cuda_device(worker)
+
+    def load(name):
+        model = load_pipeline(name, gpu, processors)
+        if quantize:
+            quantize_pipeline(model)
+        return model
+
+    pipelines = PipelineCache(cache_size, load)
+    if lang is not None:
+        select_pipeline(lang)
+    s2 = time.time()
+    logging.info(
+        f'Loading NLP model, worker: {worker}, device: {device}, quantized: {quantize}, time: {s2-s1} seconds')
+
+
+def select_pipeline(lang: str):
+    '''
+    Sets the worker pipeline to the pipeline of a given language, the pipeline is loaded if it is 
+    not kept by the worker
+
+    :param lang: processing language
+    '''
     global nlp
+    if lang not in pipelines.pipelines:
+        # the current pipeline can be unloaded by the cache before the new one is loaded
+        nlp = None
+    nlp = pipelines.get(lang)
 
-    index = batch_data["index"]
-    processes = batch_data["processes"]
-    logging.info(f'Starting batch {index}')
-    batch_size = batch_data["batch_size"]
-    batch_save = batch_data["save"]
-    pipeline = batch_data["pipeline"]
-    lang = batch_data["lang"]
 
-    if batch_save:
-        available = check_if_result(pipeline, lang, index)
-        if available:
-            logging.info(f'Skipping batch {index}')
-            return None
+def count_tokens(text: str, lang: str, params: dict) -> int:
+    '''
+    Estimates the number of tokens in a sentence before tokenization. For languages without
+    spaces between words (config/params/excluded_tokens_validation) the number of characters is used.
 
-    if not nlp:
-        if processes > 1:
-            current_process = int(
-                multiprocessing.current_process().name.split('-')[1]) - 1
-        else:
-            current_process = 1
-        gpu = batch_data["gpu"]
-        if gpu:
-            if torch.cuda.device_count() == 0:
-                raise Exception("GPU device not found")
-            device = current_process % torch.cuda.device_count()
-            set_cuda_device(device)
-        else:
-            device = "cpu"
-        lang = batch_data["lang"]
-        # add tokenize_pretokenized=False in case we need to provide tokenized content
-        nlp = stanza.Pipeline(lang, processors='tokenize,pos,lemma,depparse', use_gpu=gpu,
-                              depparse_min_length_to_batch_separately=40, deepparse_batch_size=25)
-        logging.info(
-            f'Initializing NLP batch: {index}, process: {current_process}, device: {device}')
+    :param text: sentence
+    :param lang: sentence language
+    :param params: config.json params
+    :return: estimated number of tokens
+    '''
+    if lang in params["excluded_tokens_validation"]:
+        return len(text)
+    return len(text.split(" "))
 
-    data = batch_data["data"]
-    #tokens = data.text.split(" ")
-    processed = nlp(data)
-    for p in processed:
+
+def is_outlier(text: str, length: int, params: dict) -> bool:
+    '''
+    Checks if a sentence is processed in the outlier lane, i.e. it is longer than params.outlier_chars
+    characters or params.outlier_tokens tokens (0 - threshold is not used)
+
+    :param text: sentence
+    :param length: the number of tokens (see count_tokens)
+    :param params: config.json params
+    :return: True for outlier sentence
+    '''
+    return bool((params["outlier_chars"] and len(text) > params["outlier_chars"]) or
+                (params["outlier_tokens"] and length > params["outlier_tokens"]))
+
+
+def get_batch_ranges(lengths: List[int], batch_size: int, batch_tokens: int = 0, outliers: List[bool] = None,
+                     outlier_batch_size: int = 1) -> List[tuple]:
+    '''
+    Splits sentences into batches of consecutive sentences. Batch is closed when it has batch_size
+    sentences or when the next sentence would exceed batch_tokens tokens (0 - no token budget).
+    Outlier sentences (see is_outlier) are processed in separate batches of at most outlier_batch_size 
+    consecutive outliers, so a few very long sentences do not stall normal batches.
+
+    :param lengths: the number of tokens of every sentence
+    :param batch_size: max number of sentences in a batch
+    :param batch_tokens: max number of tokens in a batch
+    :param outliers: outlier flag of every sentence or None
+    :param outlier_batch_size: max number of sentences in an outlier batch
+    :return: list of (start, end) sentence ranges
+    '''
+    ranges = []
+    start = 0
+    tokens = 0
+    lane = False
+    for i, length in enumerate(lengths):
+        outlier = bool(outliers and outliers[i])
+        size = outlier_batch_size if outlier else batch_size
+        if i > start and (outlier != lane or i - start >= size or (batch_tokens and tokens + length > batch_tokens)):
+            ranges.append((start, i))
+            start = i
+            tokens = 0
+        tokens += length
+        lane = outlier
+    if start < len(lengths):
+        ranges.append((start, len(lengths)))
+    return ranges
+
+
+def run_processors(documents: List[stanza.Document], timings: dict, skip: tuple = ()) -> List[stanza.Document]:
+    '''
+    Runs stanza pipeline processors one by one (as stanza.Pipeline does) and measures their time
+
+    :param documents: list of stanza.Document objects
+    :param timings: dictionary where processing time in seconds is added by processor name
+    :param skip: processors that are not run (already done for pretokenized documents)
+    :return: list of processed stanza.Document objects
+    '''
+    for name in PIPELINE_NAMES:
+        processor = nlp.processors.get(name)
+        if processor and name not in skip:
+            s1 = time.time()
+            documents = processor.bulk_process(documents)
+            timings[name] = timings.get(name, 0) + time.time() - s1
+    return documents
+
+
+def sort_documents(documents: List[stanza.Document], timings: dict, skip: tuple = ()) -> List[stanza.Document]:
+    '''
+    Runs stanza processors on documents sorted by length to reduce padding, documents
+    are returned in the original order
+
+    :param documents: list of stanza.Document objects
+    :param timings: dictionary where processing time of every stanza processor is added
+    :param skip: processors that are not run
+    :return: list of processed stanza.Document objects
+    '''
+    order = sorted(range(len(documents)), key=lambda i: len(documents[i].text))
+    processed = run_processors([documents[i] for i in order], timings, skip)
+    result = [None] * len(documents)
+    for i, p in zip(order, processed):
+        result[i] = p
+    return result
+
+
+def parse_documents(documents: List[stanza.Document], timings: dict = None,
+                    pretokenized: bool = False) -> List[stanza.Document]:
+    '''
+    Parses documents with the worker stanza pipeline. Documents are sent to stanza sorted by 
+    length to reduce padding and returned in the original order.
+
+    :param documents: list of stanza.Document objects
+    :param timings: dictionary where processing time of every stanza processor is added
+    :param pretokenized: documents are already tokenized by the pre-pass (parse.py --prefilter),
+                         only pos, lemma and depparse are run
+    :return: list of processed stanza.Document objects
+    '''
+    if not documents:
+        return []
+    skip = PRETOKENIZED if pretokenized else ()
+    result = sort_documents(documents, {} if timings is None else timings, skip)
+    return strip_documents(result)
+
+
+def strip_documents(result: List[stanza.Document]) -> List[stanza.Document]:
+    '''
+    Removes trailing spaces of token and word texts and lemmas
+
+    :param result: list of processed stanza.Document objects
+    :return: the same list of documents
+    '''
+    for p in result:
         for s in p.sentences:
             for t in s.tokens:
                 try:
@@ -139,32 +395,396 @@ def process_batch(batch_data: dict) -> dict:
                         t.lemma = t.lemma.strip()
                 except Exception as e:
                     logging.error(e)
+    return result
+
+
+class BudgetExceeded(Exception):
+    '''
+    Raised by the timer when parsing takes longer than its time budget
+    '''
+
+
+def raise_budget_exceeded(signum, frame):
+    raise BudgetExceeded()
+
+
+def parse_with_time_limit(documents: List[stanza.Document], timings: dict, pretokenized: bool,
+                          seconds: float) -> List[stanza.Document]:
+    '''
+    Parses documents, BudgetExceeded is raised when parsing takes more than a given time. The timer 
+    uses SIGALRM, so it must be called from the main thread of the process (pool workers and the 
+    main process of parse.py).
+
+    :param documents: list of stanza.Document objects
+    :param timings: dictionary where processing time of every stanza processor is added
+    :param pretokenized: documents are already tokenized by the pre-pass
+    :param seconds: time limit
+    :return: list of processed stanza.Document objects
+    '''
+    previous = signal.signal(signal.SIGALRM, raise_budget_exceeded)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        return parse_documents(documents, timings, pretokenized)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def parse_within_budget(texts: List[str], tokens: list, indexes: List[int], timings: dict, budget: float,
+                        quarantine: list) -> dict:
+    '''
+    Parses sentences with a time budget of budget seconds per sentence. Sentences exceeding their budget
+    are bisected into the shorter and the longer half and both halves are parsed again, so a pathological
+    sentence does not slow down the whole batch (stanza pads batches to the longest sentence). A single 
+    sentence exceeding its budget is parsed without limit and reported in quarantine.
+
+    :param texts: sentences of the batch
+    :param tokens: tokenization of the sentences stored by the pre-pass or None
+    :param indexes: indexes of sentences to be parsed
+    :param timings: dictionary where processing time of every stanza processor is added
+    :param budget: time budget per sentence in seconds (params.sentence_time_budget, 0 - no limit)
+    :param quarantine: list where (index, parsing time) tuples of sentences exceeding the budget are added
+    :return: dictionary with processed stanza.Document objects by sentence index
+    '''
+    pretokenized = tokens is not None
+
+    def documents(group):
+        # stanza modifies token dictionaries, they are copied as parsing can be retried
+        if tokens is None:
+            return [stanza.Document([], text=texts[i]) for i in group]
+        return [stanza.Document(copy.deepcopy(tokens[i]), text=texts[i]) for i in group]
+
+    if not indexes:
+        return {}
+    if not budget:
+        return dict(zip(indexes, parse_documents(documents(indexes), timings, pretokenized)))
+    try:
+        processed = parse_with_time_limit(documents(indexes), timings, pretokenized, budget * len(indexes))
+        return dict(zip(indexes, processed))
+    except BudgetExceeded:
+        pass
+    if len(indexes) == 1:
+        s1 = time.time()
+        processed = parse_documents(documents(indexes), timings, pretokenized)
+        quarantine.append((indexes[0], time.time() - s1))
+        return {indexes[0]: processed[0]}
+    logging.warning(f'{len(indexes)} sentences exceeded time budget of {budget * len(indexes):.2f} seconds, '
+                    f'parsing them in two halves')
+    order = sorted(indexes, key=lambda i: len(texts[i]))
+    middle = len(order) // 2
+    result = parse_within_budget(texts, tokens, order[:middle], timings, budget, quarantine)
+    result.update(parse_within_budget(texts, tokens, order[middle:], timings, budget, quarantine))
+    return result
+
+
+def process_batch(batch_data: dict) -> dict:
+    '''
+    Processes single batch
+
+    :param batch_data: dictionary containing all information required to process a given batch
+    :return: dictionary with serialized batch result (see serialize), in case batch_save is set to 
+            true in config.json None is returned and then merge-parse.py script must be used to merge
+            partial results into one file
+    '''
+    s1 = time.time()
+
+    index = batch_data["index"]
+    logging.info(f'Starting batch {index}')
+    start = batch_data["start"]
+    batch_save = batch_data["save"]
+    pipeline = batch_data["pipeline"]
+    lang = batch_data["lang"]
+
+    data = batch_data["data"]
+    entries = batch_data["cached"]
+    tokens = batch_data["tokens"]
+    misses = [i for i, e in enumerate(entries) if e is None]
+    dropped = []
+    timings = {}
+    quarantine = []
+    if tokens is not None:
+        # pairs dropped by the pre-pass keep only their tokenization, they are removed by postprocess.py
+        dropped = [i for i in misses if batch_data["dropped"][i]]
+        misses = [i for i in misses if not batch_data["dropped"][i]]
+    if misses:
+        select_pipeline(lang)
+    processed = parse_within_budget(data, tokens, misses, timings, batch_data["budget"], quarantine)
 
-    result = {
-        "index": index,
-        "data": processed
-    }
     s2 = time.time()
-    logging.info(f'Processing batch {index} time: {s2-s1} seconds')
+    entries = list(entries)
+    parsed = []
+    words = 0
+    for i in misses:
+        d = processed[i]
+        entries[i] = serialize_document(d)
+        parsed.append((data[i],) + entries[i])
+        words += sum(len(sent.words) for sent in d.sentences)
+    for i in dropped:
+        entries[i] = serialize_document(strip_documents([stanza.Document(tokens[i], text=data[i])])[0])
+
+    result = join_documents(entries, start)
+    result["index"] = index
+    result["parsed"] = parsed
+    timings["serialize"] = time.time() - s2
 
     if batch_save:
-        save(pipeline, lang, [result], index, batch_size)
-        return None
+        result = save_batch(result, batch_data)
+    result["quarantine"] = [{"sentence": start + i + 1, "seconds": seconds, "chars": len(data[i]), "text": data[i]}
+                            for i, seconds in quarantine]
+
+    s3 = time.time()
+    logging.info(
+        f'Processing batch {index} time: {s3-s1} seconds, sentences: {len(data)}, '
+        f'cached: {len(data) - len(misses) - len(dropped)}, dropped: {len(dropped)}, quarantined: {len(quarantine)}, '
+        f'{len(data)/(s3-s1):.1f} sentences/s')
+
+    result["metrics"] = {
+        "index": index,
+        "sentences": len(data),
+        "parsed": len(misses),
+        "dropped": len(dropped),
+        "quarantined": len(quarantine),
+        "words": words,
+        "seconds": s3 - s1,
+        "processors": timings,
+        "rss_mb": max_rss(),
+        "device": device,
+        "finished": s3
+    }
+    if device is not None and device != "cpu":
+        result["metrics"]["gpu_mb"] = torch.cuda.max_memory_allocated() / 1024 / 1024
+    return result
+
+
+def save_batch(result: dict, batch_data: dict) -> dict:
+    '''
+    Saves batch result to batch files (batch_save=true), only saved files, new parse results and
+    batch metrics are passed to the main process
+
+    :param result: serialized batch result
+    :param batch_data: processed batch dictionary
+    :return: dictionary with batch range and saved files entries for the checkpoint manifest
+    '''
+    files = save(batch_data["pipeline"], batch_data["lang"], result, batch_data["index"])
+    saved = {"index": batch_data["index"], "start": batch_data["start"], "sentences": len(batch_data["data"]),
+             "files": files, "parsed": result["parsed"]}
+    for key in ("quarantine", "metrics"):
+        if key in result:
+            saved[key] = result[key]
+    return saved
+
+
+def remote_batch(batch_data: dict, port: int) -> dict:
+    '''
+    Processes batch in the running parse service (service.py) instead of a worker, batch files are
+    saved by the calling process
+
+    :param batch_data: batch dictionary (see get_batch)
+    :param port: service port (params.service_port)
+    :return: the same result as process_batch
+    '''
+    result = service_client.request(port, "/parse", dict(batch_data, save=False))
+    if batch_data["save"]:
+        result = save_batch(result, batch_data)
+    return result
+
+
+def get_batch(sentences: List[str], index: int, start: int, end: int, lang: str, pipeline: str,
+              batch_save: bool, cache: ParseCache = None, tokens: TokensReader = None,
+              dropped: set = None, budget: float = 0) -> dict:
+    '''
+    Creates batch dictionary, sentences found in the parse cache are passed to the worker
+    with their results. With the pre-pass (params.prefilter) tokenization of sentences that are
+    not cached is passed to the worker.
+
+    :param sentences: sentences to be processed
+    :param index: batch index (starting from 1)
+    :param start: first sentence of the batch
+    :param end: sentence after the last sentence of the batch
+    :param lang: processing language
+    :param pipeline: processed pipeline name from config.json file
+    :param batch_save: config.json batch_save parameter
+    :param cache: parse cache or None
+    :param tokens: tokenization stored by the pre-pass or None
+    :param dropped: numbers of sentence pairs dropped by the pre-pass
+    :param budget: parsing time budget per sentence in seconds (params.sentence_time_budget)
+    :return: batch dictionary
+    '''
+    data = sentences[start:end]
+    if cache is not None:
+        cached = cache.get(data)
     else:
-        return result
+        cached = [None] * len(data)
+    batch_tokens = None
+    batch_dropped = None
+    if tokens is not None:
+        batch_dropped = [start + i + 1 in dropped for i in range(len(data))]
+        batch_tokens = [t if c is None else None for t, c in zip(tokens.get(start, data), cached)]
+    return {
+        "index": index,
+        "start": start,
+        "data": data,
+        "cached": cached,
+        "tokens": batch_tokens,
+        "dropped": batch_dropped,
+        "budget": budget,
+        "lang": lang,
+        "save": batch_save,
+        "pipeline": pipeline
+    }
 
 
-def process_language(config: dict, pipeline: str, lang: str, selected_sentences: List[int]):
+def get_batches(sentences: List[str], ranges: List[tuple], lang: str, pipeline: str, batch_save: bool,
+                cache: ParseCache = None, checkpoint: Checkpoint = None,
+                shard_index: int = 0, num_shards: int = 1, tokens: TokensReader = None, dropped: set = None,
+                budget: float = 0):
     '''
-    Prepares batches to be processed for a given language.
+    Generates batches to be processed, stanza documents are created in the worker. Only batches 
+    of a given shard are processed, batches already saved and verified in the checkpoint manifest
+    (batch_save=true) are skipped.
 
-    :param config: dictionary with all configuration information
+    :param sentences: sentences to be processed
+    :param ranges: list of (start, end) batch sentence ranges
+    :param lang: processing language
+    :param pipeline: processed pipeline name from config.json file
+    :param batch_save: config.json batch_save parameter
+    :param cache: parse cache or None
+    :param checkpoint: checkpoint manifest or None
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards
+    :param tokens: tokenization stored by the pre-pass or None
+    :param dropped: numbers of sentence pairs dropped by the pre-pass
+    :param budget: parsing time budget per sentence in seconds (params.sentence_time_budget)
+    :return: generator of batch dictionaries
+    '''
+    for counter, (start, end) in enumerate(ranges, 1):
+        if not in_shard(counter, shard_index, num_shards):
+            continue
+        if checkpoint is not None and checkpoint.verified(counter, start, end - start):
+            logging.info(f'Skipping batch {counter}')
+            continue
+        yield get_batch(sentences, counter, start, end, lang, pipeline, batch_save, cache, tokens, dropped, budget)
+
+
+def process_parallel(pool: Pool, batches, window: int, process=process_batch):
+    '''
+    Processes batches in the pool and returns results in batch order. At most window batches
+    are submitted ahead of the first not yet returned batch, so only a few batch results are 
+    kept in memory.
+
+    :param pool: process pool with initialized workers
+    :param batches: iterable of batch dictionaries
+    :param window: max number of batches in progress
+    :param process: batch processing function
+    :return: generator of batch results
+    '''
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(process, (batch,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def write_results(results: queue.Queue, pipeline: str, lang: str, errors: list):
+    '''
+    Writer thread, appends batch results to temporary output files as soon as they are available. 
+    Processing stops when None is received, files are renamed by finish_output.
+
+    :param results: queue with batch results in batch order
     :param pipeline: processed pipeline name from config.json file
     :param lang: processing language
-    :selected_sentences: the list of sentences to be processed, in case of None all sentneces will be processed
+    :param errors: list where writing exception is stored
+    '''
+    try:
+        file_parsed, file_tokenized = get_output_files(pipeline, lang)
+        with open(file_parsed + ".tmp", 'w', encoding='utf8') as parsed, \
+                open(file_tokenized + ".tmp", 'w', encoding='utf8') as tokenized:
+            first = True
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                if not first:
+                    tokenized.write(LINESEP)
+                first = False
+                tokenized.write(result["tokenized"])
+                parsed.write(result["conllu"])
+    except Exception as e:
+        logging.error(e)
+        errors.append(e)
+        # consume remaining results so the main thread is never blocked
+        while results.get() is not None:
+            pass
+
+
+def finish_output(pipeline: str, lang: str):
+    '''
+    Renames temporary output files written by write_results when all batches are processed
+
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    '''
+    for file in get_output_files(pipeline, lang):
+        os.replace(file + ".tmp", file)
+
+
+def store_result(result: dict, results: queue.Queue, cache: ParseCache, checkpoint: Checkpoint, batches: int,
+                 metrics: MetricsWriter, quarantine: MetricsWriter = None):
+    '''
+    Handles batch result in the main process: batch metrics and sentences exceeding the time budget
+    are written, new sentences are stored in the parse cache, saved batch is recorded in the checkpoint manifest (batch_save=true) or
+    result is passed to the writer thread (batch_save=false)
+
+    :param result: process_batch result
+    :param results: writer thread queue
+    :param cache: parse cache or None
+    :param checkpoint: checkpoint manifest or None
+    :param batches: the number of batches of the whole job (all shards)
+    :param metrics: batch metrics writer
+    :param quarantine: writer of the quarantine file or None
+    '''
+    metrics.write(result["metrics"])
+    if quarantine is not None:
+        for entry in result["quarantine"]:
+            quarantine.write(entry)
+    if cache is not None:
+        cache.put(result["parsed"])
+    if checkpoint is not None:
+        checkpoint.record(result["index"], result["start"], result["sentences"], result["files"], batches)
+    else:
+        results.put(result)
+
+
+def read_selected_sentences(pipeline: str) -> List[int]:
+    '''
+    Reads numbers of sentences selected for processing from ./data/[pipeline]/ids.txt
+
+    :param pipeline: processed pipeline name from config.json file
+    :return: list of sentence indexes (starting from 0) or None if all sentences are processed
+    '''
+    selected_sentences = []
+    try:
+        with open("./data/" + pipeline + "/ids.txt", "r", encoding="utf-8") as f:
+            list = f.read().split(LINESEP)
+            for l in list:
+                selected_sentences.append(int(l) - 1)
+    except Exception:
+        selected_sentences = None
+    return selected_sentences
+
+
+def read_sentences(config: dict, pipeline: str, lang: str, selected_sentences: List[int]) -> List[str]:
     '''
-    stanza.download(lang)
+    Reads sentences to be processed from ./data/[pipeline]/bitext_raw/ folder
 
+    :param config: dictionary with all configuration information
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :param selected_sentences: the list of sentences to be processed, in case of None all sentences are processed
+    :return: list of sentences (limited by params.limit)
+    '''
     input_file = "./data/" + pipeline + "/bitext_raw/" + pipeline + "." + lang + ".txt"
 
     with open(input_file, "r", encoding="utf-8") as f:
@@ -180,79 +800,339 @@ def process_language(config: dict, pipeline: str, lang: str, selected_sentences:
     if limit == 0 or len(sentences) < limit:
         limit = len(sentences)
 
-    documents = [stanza.Document([], text=d) for d in sentences[0:limit]]
+    return sentences[0:limit]
+
+
+def tokenize_batch(texts: List[str]) -> List[tuple]:
+    '''
+    Tokenizes batch with the tokenize-only worker pipeline (parse.py --prefilter)
+
+    :param texts: sentences
+    :return: list of tuples with JSON line (sentence and its stanza tokenization) and the number 
+             of sentences found by stanza
+    '''
+    documents = sort_documents([stanza.Document([], text=t) for t in texts], {})
+    return [(json.dumps({"text": t, "sentences": d.to_dict()}, ensure_ascii=False), len(d.sentences))
+            for t, d in zip(texts, documents)]
+
+
+def prefilter_language(config: dict, pipeline: str, lang: str, selected_sentences: List[int],
+                       offline: bool = False) -> set:
+    '''
+    Tokenizes all sentences of a given language and stores their tokenization in the prefilter folder
+
+    :param config: dictionary with all configuration information
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :param selected_sentences: the list of sentences to be processed, in case of None all sentences are processed
+    :param offline: use locally stored stanza models without checking for updates
+    :return: numbers of sentences (starting from 1) split into more than one sentence
+    '''
+    s1 = time.time()
+
+    if not offline:
+        stanza.download(lang)
+
+    sentences = read_sentences(config, pipeline, lang, selected_sentences)
+
+    params = config["params"]
+    processes = params["processes"]
+    lengths = [count_tokens(d, lang, params) for d in sentences]
+    batches = [sentences[start:end] for start, end in get_batch_ranges(lengths, params["batch_size"],
+                                                                      params["batch_tokens"])]
+    plan = get_plan(params)
+    quantize = use_quantization(params)
+
+    workers = multiprocessing.Queue()
+    for worker in range(processes):
+        workers.put(worker)
+
+    file = get_tokens_file(pipeline, lang)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    split = set()
+
+    with open(file + ".tmp", "w", encoding="utf-8") as f:
+        def write(results):
+            counter = 0
+            for result in results:
+                for line, count in result:
+                    counter += 1
+                    f.write(line + LINESEP)
+                    if count > 1:
+                        split.add(counter)
+
+        if processes > 1:
+            with Pool(processes, initializer=init_worker,
+                      initargs=(lang, params["gpu"], workers, plan, PREFILTER_PROCESSORS, quantize)) as pool:
+                write(pool.imap(tokenize_batch, batches))
+        else:
+            init_worker(lang, params["gpu"], workers, plan, PREFILTER_PROCESSORS, quantize)
+            write(map(tokenize_batch, batches))
+    os.replace(file + ".tmp", file)
+
+    s2 = time.time()
+    logging.info(f'Prefilter {lang}: sentences: {len(sentences)}, split: {len(split)}, time: {s2-s1} seconds')
+    return split
+
+
+def prefilter(pipeline, offline=False):
+    '''
+    Tokenize-only pre-pass: tokenizes both languages of a pipeline, stores tokenization used by parse.py 
+    and numbers of sentence pairs split into more than one sentence on any side (dropped pairs) used
+    by parse.py and wordalignment.py when params.prefilter is set to true
+
+    :param pipeline: processed pipeline name from config.json file
+    :param offline: use locally stored stanza models without checking for updates
+    '''
+    config = read_config()
+
+    if pipeline not in config["pipelines"]:
+        msg = f'Pipeline for: {pipeline} not available'
+        logging.error(msg)
+        raise Exception(msg)
+
+    source = config["sources"][config["pipelines"][pipeline]["source"]]
+    selected_sentences = read_selected_sentences(pipeline)
+
+    s1 = time.time()
+
+    dropped = set()
+    for lang in dict.fromkeys((source["src_lang"], source["tgt_lang"])):
+        dropped |= prefilter_language(config, pipeline, lang, selected_sentences, offline)
 
-    batches = []
+    write_file(get_dropped_file(pipeline), "".join(str(i) + LINESEP for i in sorted(dropped)))
+
+    s2 = time.time()
+    logging.info(f'Prefilter: dropped sentence pairs: {len(dropped)}, total processing time: {s2-s1} seconds')
+
+
+def process_language(config: dict, pipeline: str, lang: str, selected_sentences: List[int], offline: bool = False,
+                     shard_index: int = 0, num_shards: int = 1, use_queue: bool = False, pool: Pool = None,
+                     initialized: bool = False):
+    '''
+    Prepares batches to be processed for a given language.
+
+    :param config: dictionary with all configuration information
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :selected_sentences: the list of sentences to be processed, in case of None all sentneces will be processed
+    :param offline: use locally stored stanza models without checking for updates
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards, with more than one shard batch results are always saved 
+                       and merge_parse.py must be used
+    :param use_queue: take batches from the batch queue shared by all jobs, batch results are always 
+                      saved and merge_parse.py must be used
+    :param pool: process pool with workers initialized by the caller (multi-language mode)
+    :param initialized: workers are initialized by the caller, with pool set to None batches are
+                        processed in the main process
+    :return: list of batch metrics
+    '''
+    s1 = time.time()
+
+    if not offline:
+        stanza.download(lang)
+
+    sentences = read_sentences(config, pipeline, lang, selected_sentences)
+
+    tokens = None
+    dropped = None
+    if config["params"]["prefilter"]:
+        tokens = TokensReader(get_tokens_file(pipeline, lang))
+        dropped = read_dropped(pipeline)
+        logging.info(f'Prefilter: dropped sentence pairs: {len(dropped)}')
 
     processes = config["params"]["processes"]
     batch_size = config["params"]["batch_size"]
-    batch_save = config["params"]["batch_save"]
+    batch_tokens = config["params"]["batch_tokens"]
+    budget = config["params"]["sentence_time_budget"]
+    batch_save = config["params"]["batch_save"] or num_shards > 1 or use_queue
     gpu = config["params"]["gpu"]
+    quantize = use_quantization(config["params"])
 
-    counter = 0
-    for i in range(0, len(documents), batch_size):
-        counter += 1
-        start = i
-        end = start + batch_size
-        batches.append({
-            "index": counter,
-            "data": documents[start:end],
-            "lang": lang,
-            "gpu": gpu,
-            "save": batch_save,
-            "pipeline": pipeline,
-            "batch_size": batch_size,
-            "processes": processes
-        })
-
-    if processes > 1:
-        pool = Pool(processes)
-        result = pool.map(process_batch, batches)
-    else:
-        result = []
-        for batch in batches:
-            batch_result = process_batch(batch)
-            result.append(batch_result)
+    plan = get_plan(config["params"])
+    logging.info(describe(plan))
+
+    lengths = [count_tokens(d, lang, config["params"]) for d in sentences]
+    outliers = [is_outlier(d, length, config["params"]) for d, length in zip(sentences, lengths)]
+    ranges = get_batch_ranges(lengths, batch_size, batch_tokens, outliers, config["params"]["outlier_batch_size"])
+    logging.info(f'Outlier sentences: {sum(outliers)}')
+    version = get_model_version(lang)
+    if quantize:
+        version += "-" + QUANTIZED_VERSION
+    cache = create_cache(config["params"], lang, version, PROCESSORS)
+    checkpoint = None
+    batch_queue = None
+    owner = None
+    if use_queue:
+        owner = get_owner()
+        batch_queue = get_queue(pipeline, lang, config["params"])
+        batch_queue.add(ranges, lambda: remove_queue_files(pipeline, lang))
+    if batch_save:
+        checkpoint = get_checkpoint(pipeline, lang, shard_index, num_shards, owner, get_run(ranges))
+    metrics = MetricsWriter(get_metrics_file(pipeline, lang, shard_index, num_shards, owner))
+    quarantine = None
+    if budget:
+        quarantine = MetricsWriter(get_quarantine_file(pipeline, lang, shard_index, num_shards, owner))
+    batches = get_batches(sentences, ranges, lang, pipeline, batch_save, cache, checkpoint,
+                          shard_index, num_shards, tokens, dropped, budget)
 
+    def queue_batch(index, start, end):
+        return get_batch(sentences, index, start, end, lang, pipeline, batch_save, cache, tokens, dropped, budget)
+
+    def queue_result(result):
+        store_result(result, results, cache, checkpoint, len(ranges), metrics, quarantine)
+
+    workers = multiprocessing.Queue()
+    for worker in range(processes):
+        workers.put(worker)
+
+    results = queue.Queue(maxsize=processes + 1)
+    errors = []
+    writer = None
     if not batch_save:
+        writer = threading.Thread(target=write_results, args=(results, pipeline, lang, errors))
+        writer.start()
+
+    s2 = time.time()
+    logging.info(f'Startup time: {s2-s1} seconds, batches: {len(ranges)}')
+
+    process = process_batch
+    port = None
+    if pool is None and not initialized and service_client.available(config["params"]):
+        # models are loaded by the running service, concurrent batches are sent from threads
+        port = config["params"]["service_port"]
 
-        sorted_result = sorted(result, key=lambda d: d['index'])
+        def process(batch):
+            return remote_batch(batch, port)
 
-        save(pipeline, lang, sorted_result)
+    def run(pool):
+        if use_queue:
+            # next batch is taken from the queue only when a worker is idle
+            drain(batch_queue, owner, queue_batch, process, queue_result, pool, processes if pool else 1)
+        elif pool is not None:
+            for result in process_parallel(pool, batches, 2 * processes, process):
+                store_result(result, results, cache, checkpoint, len(ranges), metrics, quarantine)
+        else:
+            for batch in batches:
+                result = process(batch)
+                store_result(result, results, cache, checkpoint, len(ranges), metrics, quarantine)
+
+    try:
+        if pool is not None or initialized:
+            run(pool)
+        elif port is not None:
+            with ThreadPool(processes) as pool:
+                run(pool)
+        elif processes > 1:
+            with Pool(processes, initializer=init_worker,
+                      initargs=(lang, gpu, workers, plan, PROCESSORS, quantize)) as pool:
+                run(pool)
+        else:
+            init_worker(lang, gpu, workers, plan, PROCESSORS, quantize)
+            run(None)
+    finally:
+        if writer:
+            results.put(None)
+            writer.join()
+        if cache is not None:
+            logging.info(cache_summary(cache))
+            cache.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        if batch_queue is not None:
+            batch_queue.close()
+        if tokens is not None:
+            tokens.close()
+        metrics.close()
+        if quarantine is not None:
+            quarantine.close()
+            logging.info(f'Sentences exceeding time budget: {len(quarantine.records)}, see {quarantine.path}')
+
+    if errors:
+        raise errors[0]
+
+    if writer:
+        finish_output(pipeline, lang)
+
+    s3 = time.time()
+    logging.info(f'Model loading and batch processing time: {s3-s2} seconds')
 
+    return metrics.records
 
-def save(pipeline: str, lang: str, sorted_result: dict, index: int = None, batch_size: int = None):
+
+def serialize_document(d: stanza.Document) -> tuple:
     '''
-    Saves file with tokenized sentences and file with data in ConLL-U format
+    Converts processed document to the output formats walking every sentence once. 
+    Multi-word tokens are removed from CoNLL-U data, we keep only words.
+
+    :param d: processed stanza document
+    :return: tuple with tokenized sentence (|||-separated words) and data in CoNLL-U format 
+             without sent_id
+    '''
+    atokens = []
+    words = []
+    blocks = []
+    # it should be always one sentence, other sentences are removed in postprocess.py
+    for sent in d.sentences:
+        lines = list(sent.comments)
+        for token in sent.tokens:
+            atokens.append(token.text)
+            for word in token.words:
+                words.append(word.text)
+                lines.append(word2conll(word))
+        blocks.append("\n".join(lines) + "\n\n")
+    asentence = " ".join(atokens)
+    sentence = " ".join(words)
+
+    conllu = []
+    if sentence != asentence:
+        conllu.append("# actual text = " + asentence + "\n")
+    conllu.append("# text = " + sentence + "\n")
+    conllu.extend(blocks)
+    return "|||".join(words), "".join(conllu)
+
+
+def join_documents(entries: List[tuple], start: int = 0) -> dict:
+    '''
+    Joins serialized documents into batch result
+
+    :param entries: list of serialize_document results
+    :param start: number of sentences in all previous batches (used for sent_id)
+    :return: dictionary with tokenized sentences (one sentence per line) and data in CoNLL-U format
+    '''
+    conllu = []
+    for counter, entry in enumerate(entries, start + 1):
+        conllu.append("# sent_id = " + str(counter) + "\n")
+        conllu.append(entry[1])
+
+    return {
+        "sentences": len(entries),
+        "tokenized": "\n".join(entry[0] for entry in entries),
+        "conllu": "".join(conllu)
+    }
+
+
+def serialize(documents: List[stanza.Document], start: int = 0) -> dict:
+    '''
+    Converts processed documents to the output formats
+
+    :param documents: processed stanza documents
+    :param start: number of sentences in all previous batches (used for sent_id)
+    :return: dictionary with tokenized sentences (|||-separated words, one sentence per line) 
+             and data in CoNLL-U format
+    '''
+    return join_documents([serialize_document(d) for d in documents], start)
+
+
+def get_output_files(pipeline: str, lang: str, index: int = None) -> tuple:
+    '''
+    Returns output file names (parsed and tokenized), folders are created if needed
 
     :param pipeline: processed pipeline name from config.json file
     :param lang: processing language
-    :param sorted_result: Stanza result to be saved into the files
     :index: batch number (applies only when config.json parameter batch_save=true)
-    :batch_size: batch size (applies only when config.json parameter batch_save=true)
-    '''
-    asentences = []
-    sentences = []
-    tsentences = []
-    for s in sorted_result:
-        for d in s['data']:
-            atokens = []
-            # it should be always one sentence, we do not need to care about it
-            for sent in d.sentences:
-                for token in sent.tokens:
-                    atokens.append(token.text)
-            asentence = " ".join(atokens)
-            tokens = []
-            for sent in d.sentences:
-                for word in sent.words:
-                    tokens.append(word.text)
-            sentence = " ".join(tokens)
-            tsentence = "|||".join(tokens)
-
-            asentences.append(asentence)
-            sentences.append(sentence)
-            tsentences.append(tsentence)
-
+    :return: tuple with CoNLL-U file name and tokenized file name
+    '''
     s = ""
     if index:
         s = "/tmp"
@@ -269,28 +1149,142 @@ def save(pipeline: str, lang: str, sorted_result: dict, index: int = None, batch
         "." + lang + ".parsed." + s + "conllu"
     file_tokenized = folder_tokenized + "/" + \
         pipeline + "." + lang + ".tokenized." + s + "txt"
+    return file_parsed, file_tokenized
+
+
+def save(pipeline: str, lang: str, result: dict, index: int = None):
+    '''
+    Saves file with tokenized sentences and file with data in ConLL-U format
+
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :param result: serialized batch result to be saved into the files
+    :index: batch number (applies only when config.json parameter batch_save=true)
+    :return: list of saved files entries for the checkpoint manifest
+    '''
+    file_parsed, file_tokenized = get_output_files(pipeline, lang, index)
 
-    with open(file_tokenized, 'w', encoding='utf8') as f:
-        f.write('\n'.join(tsentences))
-
-    counter = 0
-    with open(file_parsed, 'w', encoding='utf8') as f:
-        for s in sorted_result:
-            for d in s['data']:
-                counter += 1
-                if index and batch_size:
-                    sent = (index - 1) * batch_size + counter
-                else:
-                    sent = counter
-                f.write("# sent_id = " + str(sent) + "\n")
-                if sentences[counter - 1] != asentences[counter - 1]:
-                    f.write("# actual text = " +
-                            asentences[counter - 1] + "\n")
-                f.write("# text = " + sentences[counter - 1] + "\n")
-                conllu = doc2conll_text(d)
-                f.write(conllu)
-
-def parse(pipeline, lang):
+    return [
+        write_file(file_tokenized, result["tokenized"]),
+        write_file(file_parsed, result["conllu"])
+    ]
+
+
+def calibration_batch(texts: List[str]) -> tuple:
+    '''
+    Parses calibration sample batch in the worker
+
+    :param texts: sentences
+    :return: tuple with batch start and end time
+    '''
+    s1 = time.time()
+    parse_documents([stanza.Document([], text=t) for t in texts])
+    return s1, time.time()
+
+
+def calibrate(pipeline: str, lang: str, offline: bool = False, sentences: int = CALIBRATION_SENTENCES,
+              max_processes: int = None):
+    '''
+    Measures parsing speed of a sample of pipeline sentences with different numbers of processes and
+    threads on cpu (see cpu_planner.get_configurations) and writes the fastest configuration to 
+    config.json params (processes, cpu_threads). Model loading time is not measured.
+
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :param offline: use locally stored stanza models without checking for updates
+    :param sentences: the number of sample sentences
+    :param max_processes: max number of processes (memory limit)
+    '''
+    config = read_config()
+    params = config["params"]
+
+    if params["gpu"]:
+        msg = 'Calibration is available only for processing on cpu (params.gpu=false)'
+        logging.error(msg)
+        raise Exception(msg)
+
+    if not offline:
+        stanza.download(lang)
+
+    input_file = "./data/" + pipeline + "/bitext_raw/" + pipeline + "." + lang + ".txt"
+    with open(input_file, "r", encoding="utf-8") as f:
+        sample = list(filter(None, f.read().split(LINESEP)))[0:sentences]
+
+    cpus = available_cpus()
+    results = []
+    for processes, threads in get_configurations(len(cpus), max_processes):
+        plan = get_plan(params, processes, threads, cpus)
+        workers = multiprocessing.Queue()
+        for worker in range(processes):
+            workers.put(worker)
+        size = -(-len(sample) // (2 * processes))
+        chunks = [sample[i:i + size] for i in range(0, len(sample), size)]
+        with Pool(processes, initializer=init_worker,
+                  initargs=(lang, False, workers, plan, PROCESSORS, params["quantize"])) as pool:
+            times = pool.map(calibration_batch, chunks, chunksize=1)
+        seconds = max(t[1] for t in times) - min(t[0] for t in times)
+        speed = len(sample) / seconds
+        logging.info(f'Calibration: processes: {processes}, threads: {threads}, time: {seconds:.1f} s, '
+                     f'{speed:.1f} sentences/s')
+        results.append((speed, processes, threads))
+
+    speed, processes, threads = max(results)
+    update_params({"processes": processes, "cpu_threads": threads})
+    logging.info(f'Best configuration: processes: {processes}, threads: {threads}, {speed:.1f} sentences/s, '
+                 f'saved in config/config.json')
+
+
+def timed_parse(texts: List[str]) -> tuple:
+    '''
+    Parses sentences with the loaded pipeline after a short warm-up
+
+    :param texts: sentences
+    :return: tuple with processed stanza documents and parsing time in seconds (without warm-up)
+    '''
+    parse_documents([stanza.Document([], text=t) for t in texts[0:WARMUP_SENTENCES]])
+    s1 = time.time()
+    documents = parse_documents([stanza.Document([], text=t) for t in texts])
+    return documents, time.time() - s1
+
+
+def evaluate_quantization(pipeline: str, lang: str, offline: bool = False, sentences: int = EVALUATION_SENTENCES):
+    '''
+    Parses a random sample of pipeline sentences with fp32 models and with dynamic int8 quantized models
+    (params.quantize) on cpu and logs speedup and agreement of UPOS, HEAD and DEPREL with fp32 results.
+    One process with all available cores (or params.cpu_threads) is used.
+
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :param offline: use locally stored stanza models without checking for updates
+    :param sentences: the number of sample sentences
+    '''
+    config = read_config()
+    params = config["params"]
+
+    if params["gpu"]:
+        msg = 'Quantization evaluation is available only for processing on cpu (params.gpu=false)'
+        logging.error(msg)
+        raise Exception(msg)
+
+    if not offline:
+        stanza.download(lang)
+
+    texts = read_sentences(config, pipeline, lang, read_selected_sentences(pipeline))
+    sample = random.Random(0).sample(texts, min(sentences, len(texts)))
+
+    workers = multiprocessing.Queue()
+    workers.put(0)
+    init_worker(lang, False, workers, get_plan(params, 1))
+    reference, fp32_seconds = timed_parse(sample)
+    processors = quantize_pipeline(nlp)
+    logging.info(f'Quantized processors: {", ".join(processors)}')
+    documents, int8_seconds = timed_parse(sample)
+
+    for line in quantization_summary(compare_documents(reference, documents), fp32_seconds, int8_seconds):
+        logging.info(line)
+
+
+def parse(pipeline, lang, offline=False, shard_index=0, num_shards=1, use_queue=False):
     config = read_config()
 
     if pipeline not in config["pipelines"]:
@@ -298,14 +1292,17 @@ def parse(pipeline, lang):
         logging.error(msg)
         raise Exception(msg)
 
-    selected_sentences = []
-    try:
-        with open("./data/" + pipeline + "/ids.txt", "r", encoding="utf-8") as f:
-            list = f.read().split(LINESEP)
-            for l in list:
-                selected_sentences.append(int(l) - 1)
-    except Exception:
-        selected_sentences = None
+    if num_shards < 1 or shard_index < 0 or shard_index >= num_shards:
+        msg = f'Invalid shard: {shard_index} of {num_shards}'
+        logging.error(msg)
+        raise Exception(msg)
+
+    if use_queue and num_shards > 1:
+        msg = 'Batch queue and shards cannot be used together'
+        logging.error(msg)
+        raise Exception(msg)
+
+    selected_sentences = read_selected_sentences(pipeline)
 
     cuda = get_cuda_info()
 
@@ -313,20 +1310,147 @@ def parse(pipeline, lang):
 
     s1 = time.time()
 
-    logging.info(f'Processing {lang}')
+    logging.info(f'Processing {lang}, shard: {shard_index} of {num_shards}, queue: {use_queue}')
+
+    records = process_language(config, pipeline, lang, selected_sentences, offline, shard_index, num_shards,
+                               use_queue)
+
+    s2 = time.time()
+    for line in metrics_summary(records):
+        logging.info(line)
+    logging.info(f'Total processing time: {s2-s1} seconds')
+
+
+def get_language_work(config: dict, langs: List[str] = None, pipeline: str = None) -> List[tuple]:
+    '''
+    Groups pipelines to be processed by language, so every language model is loaded once. Pipelines 
+    without input files in ./data/[pipeline]/bitext_raw/ are skipped.
+
+    :param config: dictionary with all configuration information
+    :param langs: processed languages, None - all languages
+    :param pipeline: processed pipeline name from config.json file, None - all pipelines
+    :return: list of (language, list of pipelines) tuples
+    '''
+    names = [pipeline] if pipeline else list(config["pipelines"])
+    work = {}
+    for name in names:
+        if name not in config["pipelines"]:
+            msg = f'Pipeline for: {name} not available'
+            logging.error(msg)
+            raise Exception(msg)
+        source = config["sources"][config["pipelines"][name]["source"]]
+        for lang in (source["src_lang"], source["tgt_lang"]):
+            if langs is not None and lang not in langs:
+                continue
+            input_file = "./data/" + name + "/bitext_raw/" + name + "." + lang + ".txt"
+            if not os.path.isfile(input_file):
+                logging.warning(f'Input file {input_file} not found, skipping {name} {lang}')
+                continue
+            work.setdefault(lang, []).append(name)
+    return list(work.items())
+
+
+def parse_languages(langs: List[str] = None, pipeline: str = None, offline: bool = False):
+    '''
+    Multi-language mode: parses languages of several pipelines in one process. Workers are started once
+    and keep loaded stanza pipelines in the pipeline cache (params.pipeline_cache_size), work is grouped 
+    by language. Output files are the same as of parse.py runs for every pipeline and language.
+
+    :param langs: processed languages, None - all languages
+    :param pipeline: processed pipeline name from config.json file, None - all pipelines
+    :param offline: use locally stored stanza models without checking for updates
+    '''
+    config = read_config()
+    params = config["params"]
+    work = get_language_work(config, langs, pipeline)
+
+    cuda = get_cuda_info()
+    logging.info("Cuda: " + json.dumps(cuda))
+
+    processes = params["processes"]
+    gpu = params["gpu"]
+    quantize = use_quantization(params)
+    plan = get_plan(params)
+    logging.info(describe(plan))
+
+    s1 = time.time()
+    logging.info(f'Processing languages: {", ".join(lang + ": " + " ".join(names) for lang, names in work)}')
+
+    workers = multiprocessing.Queue()
+    for worker in range(processes):
+        workers.put(worker)
+    initargs = (None, gpu, workers, plan, PROCESSORS, quantize, params["pipeline_cache_size"])
+
+    def run(pool, initialized=True):
+        for lang, names in work:
+            if not offline:
+                stanza.download(lang)
+            for name in names:
+                logging.info(f'Processing {name} {lang}')
+                records = process_language(config, name, lang, read_selected_sentences(name), True,
+                                           pool=pool, initialized=initialized)
+                for line in metrics_summary(records):
+                    logging.info(line)
 
-    process_language(config, pipeline, lang, selected_sentences)
+    if service_client.available(params):
+        # every language is parsed by the running service
+        run(None, False)
+    elif processes > 1:
+        with Pool(processes, initializer=init_worker, initargs=initargs) as pool:
+            run(pool)
+    else:
+        init_worker(*initargs)
+        run(None)
 
     s2 = time.time()
     logging.info(f'Total processing time: {s2-s1} seconds')
 
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
         description='Parsers evaluation')
     parser.add_argument('--pipeline', type=str)
     parser.add_argument('--lang', type=str)
+    parser.add_argument('--langs', type=str, default=None,
+                        help='comma-separated languages parsed in one process for --pipeline or all pipelines')
+    parser.add_argument('--all-pipelines', action='store_true',
+                        help='parse all languages of all pipelines with input files in one process')
+    parser.add_argument('--offline', action='store_true',
+                        help='use locally stored stanza models, do not contact the model hub')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='shard processed by this job (from 0 to num-shards - 1)')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='the number of jobs processing the pipeline, batches are assigned to shards in turn')
+    parser.add_argument('--queue', action='store_true',
+                        help='take batches from the batch queue shared by all jobs processing the pipeline')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='tokenize both languages of the pipeline and find sentence pairs split into more sentences')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='measure the best number of processes and threads on cpu and save it in config.json')
+    parser.add_argument('--calibration-sentences', type=int, default=CALIBRATION_SENTENCES,
+                        help='the number of sentences parsed with every calibrated configuration')
+    parser.add_argument('--max-processes', type=int, default=None,
+                        help='max number of processes tried by the calibration')
+    parser.add_argument('--evaluate-quantization', action='store_true',
+                        help='compare speed and results of int8 quantized models with fp32 models on cpu')
+    parser.add_argument('--evaluation-sentences', type=int, default=EVALUATION_SENTENCES,
+                        help='the number of sentences parsed by the quantization evaluation')
 
     args = parser.parse_args()
 
-    parse(args.pipeline, args.lang)
+    if args.prefilter:
+        prefilter(args.pipeline, args.offline)
+    elif args.calibrate:
+        calibrate(args.pipeline, args.lang, args.offline, args.calibration_sentences, args.max_processes)
+    elif args.evaluate_quantization:
+        evaluate_quantization(args.pipeline, args.lang, args.offline, args.evaluation_sentences)
+    elif args.langs or args.all_pipelines:
+        if args.queue or args.num_shards > 1:
+            msg = 'Batch queue and shards cannot be used with --langs and --all-pipelines'
+            logging.error(msg)
+            raise Exception(msg)
+        parse_languages(args.langs.split(",") if args.langs else None,
+                        None if args.all_pipelines else args.pipeline, args.offline)
+    else:
+        parse(args.pipeline, args.lang, args.offline, args.shard_index, args.num_shards, args.queue)
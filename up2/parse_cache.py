@@ -0,0 +1,192 @@
+'''
+Persistent sentence level parse cache used by parse.py. Serialized stanza results
+(CoNLL-U lines and tokenized line) are stored in a sqlite database keyed by language,
+stanza model version, processors and sentence digest, so sentences repeated across
+pipelines (for example English side of all en-xx pipelines) are parsed only once.
+The least recently used sentences are removed when the database exceeds its size limit.
+The size of stored results is kept in the database by triggers, so the limit holds for all
+jobs sharing the cache.
+'''
+import hashlib
+import os
+import sqlite3
+import time
+from typing import List
+
+CACHE = "./data/cache/parse.sqlite"
+QUERY_SIZE = 500
+EVICT_RATIO = 0.9
+
+
+def get_key(lang: str, version: str, processors: str, text: str) -> bytes:
+    '''
+    Calculates cache key of a sentence
+
+    :param lang: sentence language
+    :param version: stanza model version
+    :param processors: stanza processors
+    :param text: sentence
+    :return: key digest
+    '''
+    value = "\0".join((lang, version, processors, text))
+    return hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+
+
+class ParseCache:
+    '''
+    Sqlite database with serialized parse results and LRU eviction
+    '''
+
+    def __init__(self, path: str, size: int, lang: str, version: str, processors: str):
+        self.path = path
+        self.size = size
+        self.lang = lang
+        self.version = version
+        self.processors = processors
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        # rollback journal as for the batch queue, WAL mode does not work on network file systems
+        # and the cache can be shared by shard and queue jobs on several nodes
+        self.connection.execute("PRAGMA journal_mode = DELETE")
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, tokenized TEXT, "
+            "conllu TEXT, size INTEGER, used REAL) WITHOUT ROWID")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)")
+        self.connection.execute(
+            "INSERT OR IGNORE INTO stats (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM entries")
+        self.connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries "
+            "BEGIN UPDATE stats SET total = total + NEW.size; END")
+        self.connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries "
+            "BEGIN UPDATE stats SET total = total - OLD.size; END")
+        self.connection.commit()
+
+    def total(self) -> int:
+        '''
+        Returns size of results stored in the cache by all jobs
+
+        :return: size in bytes
+        '''
+        return self.connection.execute("SELECT total FROM stats").fetchone()[0]
+
+    def key(self, text: str) -> bytes:
+        return get_key(self.lang, self.version, self.processors, text)
+
+    def get(self, texts: List[str]) -> list:
+        '''
+        Looks up sentences in the cache, last used time of found sentences is updated
+
+        :param texts: sentences
+        :return: list with (tokenized, conllu) tuple for every found sentence and None otherwise
+        '''
+        keys = [self.key(t) for t in texts]
+        found = {}
+        for i in range(0, len(keys), QUERY_SIZE):
+            chunk = keys[i:i + QUERY_SIZE]
+            rows = self.connection.execute(
+                "SELECT key, tokenized, conllu FROM entries WHERE key IN (" +
+                ",".join("?" * len(chunk)) + ")", chunk)
+            for key, tokenized, conllu in rows:
+                found[key] = (tokenized, conllu)
+        if found:
+            used = time.time()
+            self.connection.executemany(
+                "UPDATE entries SET used = ? WHERE key = ?", [(used, k) for k in found])
+            self.connection.commit()
+        result = [found.get(k) for k in keys]
+        hits = len(result) - result.count(None)
+        self.hits += hits
+        self.misses += len(result) - hits
+        return result
+
+    def put(self, entries: List[tuple]):
+        '''
+        Stores parse results in the cache and removes least recently used sentences when
+        the cache is larger than its size limit
+
+        :param entries: list of (sentence, tokenized, conllu) tuples
+        '''
+        if not entries:
+            return
+        used = time.time()
+        rows = []
+        for text, tokenized, conllu in entries:
+            size = len(tokenized.encode("utf-8")) + len(conllu.encode("utf-8"))
+            rows.append((self.key(text), tokenized, conllu, size, used))
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO entries (key, tokenized, conllu, size, used) VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+        if self.total() > self.size:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes least recently used sentences until the cache is below EVICT_RATIO of its size limit
+        '''
+        target = self.size * EVICT_RATIO
+        while True:
+            # size is read again, other jobs can add or remove sentences
+            total = self.total()
+            if total <= target:
+                break
+            rows = self.connection.execute(
+                "SELECT key, size FROM entries ORDER BY used LIMIT ?", (QUERY_SIZE,)).fetchall()
+            if not rows:
+                break
+            removed = []
+            for key, size in rows:
+                if total <= target:
+                    break
+                removed.append((key,))
+                total -= size
+            cursor = self.connection.executemany("DELETE FROM entries WHERE key = ?", removed)
+            self.connection.commit()
+            self.evicted += cursor.rowcount
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def create_cache(params: dict, lang: str, version: str, processors: str, path: str = CACHE):
+    '''
+    Creates parse cache based on config/config.json -> params -> parse_cache_size
+
+    :param params: config.json params
+    :param lang: processing language
+    :param version: stanza model version
+    :param processors: stanza processors
+    :param path: cache database file
+    :return: ParseCache or None if the cache is disabled (parse_cache_size = 0)
+    '''
+    size = params["parse_cache_size"]
+    if size < 0:
+        raise Exception(f'Unsupported parse_cache_size: {size}')
+    if size == 0:
+        return None
+    return ParseCache(path, size * 1024 * 1024, lang, version, processors)
+
+
+def summary(cache: ParseCache) -> str:
+    '''
+    Returns cache statistics to be logged
+
+    :param cache: ParseCache
+    :return: text with hit rate, the number of cached sentences and cache size
+    '''
+    lookups = cache.hits + cache.misses
+    rate = cache.hits / lookups if lookups else 0
+    return (f'Parse cache: hits: {cache.hits}, misses: {cache.misses}, hit rate: {rate:.1%}, '
+            f'sentences: {len(cache)}, size: {cache.total() / 1024 / 1024:.1f} MB, evicted: {cache.evicted}')
@@ -0,0 +1,105 @@
+'''
+Cache of loaded stanza pipelines of a worker process used by the multi-language mode of parse.py
+(--langs, --all-pipelines). Pipelines are kept by language and the least recently used pipelines are
+unloaded when the size of their models exceeds params.pipeline_cache_size MB (0 - only the last used
+pipeline is kept). The budget applies to every worker process.
+'''
+import gc
+import logging
+import time
+from collections import OrderedDict
+import torch
+
+
+def model_size(model: torch.nn.Module) -> int:
+    '''
+    Returns size of model parameters and buffers including packed weights of quantized layers
+
+    :param model: torch model
+    :return: size in bytes
+    '''
+    size = 0
+    for value in model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if torch.is_tensor(tensor):
+                size += tensor.numel() * tensor.element_size()
+    return size
+
+
+def pipeline_size(nlp) -> int:
+    '''
+    Returns size of models of all processors of a loaded stanza pipeline
+
+    :param nlp: stanza.Pipeline
+    :return: size in bytes
+    '''
+    size = 0
+    for processor in nlp.processors.values():
+        model = getattr(getattr(processor, "_trainer", None), "model", None)
+        if model is not None:
+            size += model_size(model)
+    return size
+
+
+class PipelineCache:
+    '''
+    LRU cache of loaded stanza pipelines bounded by the size of their models
+    '''
+
+    def __init__(self, size_mb: int, load):
+        '''
+        :param size_mb: max size of cached models in MB (params.pipeline_cache_size)
+        :param load: function loading stanza pipeline for a given language
+        '''
+        self.size = size_mb * 1024 * 1024
+        self.load = load
+        self.pipelines = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+        self.unloads = 0
+
+    def total(self) -> int:
+        return sum(size for nlp, size in self.pipelines.values())
+
+    def unload(self, needed: int):
+        '''
+        Unloads the least recently used pipelines until needed bytes fit into the budget, the last used
+        pipeline is kept when needed is 0
+
+        :param needed: size of the pipeline to be loaded
+        '''
+        keep = 0 if needed else 1
+        unloaded = False
+        while len(self.pipelines) > keep and self.total() + needed > self.size:
+            lang, (nlp, size) = self.pipelines.popitem(last=False)
+            # the pipeline is released before memory is collected
+            del nlp
+            logging.info(f'Unloading NLP model {lang}, size: {size / 1024 / 1024:.0f} MB')
+            self.unloads += 1
+            unloaded = True
+        if unloaded:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def get(self, lang: str):
+        '''
+        Returns pipeline for a given language, the pipeline is loaded if it is not cached
+
+        :param lang: processing language
+        :return: stanza.Pipeline
+        '''
+        if lang in self.pipelines:
+            self.hits += 1
+            self.pipelines.move_to_end(lang)
+            return self.pipelines[lang][0]
+        # the largest cached pipeline is used as the estimated size of the new one
+        self.unload(max((size for nlp, size in self.pipelines.values()), default=0))
+        s1 = time.time()
+        nlp = self.load(lang)
+        size = pipeline_size(nlp)
+        self.pipelines[lang] = (nlp, size)
+        self.loads += 1
+        self.unload(0)
+        logging.info(f'Loading NLP model {lang}, size: {size / 1024 / 1024:.0f} MB, time: {time.time() - s1} seconds, '
+                     f'cached models: {", ".join(self.pipelines)}')
+        return nlp
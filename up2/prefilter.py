@@ -0,0 +1,100 @@
+'''
+Files of the tokenize-only pre-pass (parse.py --prefilter). The pre-pass tokenizes both sides of
+a pipeline and stores stanza tokenization of every sentence in
+./data/[pipeline]/prefilter/[pipeline].[lang].tokens.jsonl and numbers of sentence pairs split by
+stanza into more than one sentence (removed later by postprocess.py) in
+./data/[pipeline]/prefilter/dropped.txt. With params.prefilter set to true parse.py runs only
+pos, lemma and depparse on the stored tokenization of kept pairs and wordalignment.py does not
+align dropped pairs.
+'''
+import logging
+import json
+import os
+from typing import List
+
+
+def get_folder(pipeline: str) -> str:
+    return "./data/" + pipeline + "/prefilter"
+
+
+def get_tokens_file(pipeline: str, lang: str) -> str:
+    '''
+    Returns file with tokenization of every sentence of a given language
+
+    :param pipeline: processed pipeline name from config.json file
+    :param lang: processing language
+    :return: file name
+    '''
+    return get_folder(pipeline) + "/" + pipeline + "." + lang + ".tokens.jsonl"
+
+
+def get_dropped_file(pipeline: str) -> str:
+    '''
+    Returns file with numbers of dropped sentence pairs (one per line, starting from 1)
+
+    :param pipeline: processed pipeline name from config.json file
+    :return: file name
+    '''
+    return get_folder(pipeline) + "/dropped.txt"
+
+
+def read_dropped(pipeline: str) -> set:
+    '''
+    Reads numbers of dropped sentence pairs
+
+    :param pipeline: processed pipeline name from config.json file
+    :return: set of sentence numbers (starting from 1)
+    '''
+    file = get_dropped_file(pipeline)
+    if not os.path.isfile(file):
+        msg = f'Prefilter file {file} not found, run parse.py --prefilter first'
+        logging.error(msg)
+        raise Exception(msg)
+    with open(file, "r", encoding="utf-8") as f:
+        return set(int(line) for line in f.read().split("\n") if line)
+
+
+class TokensReader:
+    '''
+    Random access to sentence tokenization stored by the pre-pass, offsets of all lines
+    are read when the file is opened
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.isfile(path):
+            msg = f'Prefilter file {path} not found, run parse.py --prefilter first'
+            logging.error(msg)
+            raise Exception(msg)
+        self.offsets = []
+        self.file = open(path, "rb")
+        offset = 0
+        for line in self.file:
+            self.offsets.append(offset)
+            offset += len(line)
+
+    def get(self, start: int, texts: List[str]) -> list:
+        '''
+        Reads tokenization of consecutive sentences
+
+        :param start: number of the first sentence (starting from 0)
+        :param texts: sentences, they must be the same as the sentences tokenized by the pre-pass
+        :return: list of stanza.Document.to_dict() results
+        '''
+        if start + len(texts) > len(self.offsets):
+            msg = f'Prefilter file {self.path} has {len(self.offsets)} sentences, run parse.py --prefilter again'
+            logging.error(msg)
+            raise Exception(msg)
+        self.file.seek(self.offsets[start])
+        result = []
+        for i, text in enumerate(texts):
+            entry = json.loads(self.file.readline())
+            if entry["text"] != text:
+                msg = f'Sentence {start + i + 1} differs from prefilter file {self.path}, run parse.py --prefilter again'
+                logging.error(msg)
+                raise Exception(msg)
+            result.append(entry["sentences"])
+        return result
+
+    def close(self):
+        self.file.close()
@@ -6,14 +6,28 @@ Processing results are stored in ./data/[pipeline]/bitext_raw/ folder.
 
 import argparse
 import time
+import json
 import re
+import sys
+from bisect import bisect_right
+from collections import deque, Counter
+from itertools import islice
+from multiprocessing import Pool
 from utils import read_config
+from dedup import create_store, summary
 import logging
 import glob
+import gzip
 import os
-from typing import Tuple, List
+from typing import Callable, Tuple, Iterator, List
 
 LINESEP = "\n"
+CHUNK_SIZE = 10000
+REASONS = {
+    "Alpha validation failed": "alpha",
+    "Incorrect tokens length": "tokens",
+    "Duplicate sentence": "duplicate"
+}
 
 if not os.path.exists("./logs/"):
     os.makedirs("./logs/")
@@ -29,6 +43,34 @@ logging.basicConfig(
 )
 
 
+def get_char_class(predicate: Callable[[str], bool], limit: int) -> str:
+    '''
+    Builds regular expression character class with all code points below limit
+    that fulfil a given predicate
+
+    :param predicate: function checking a single character
+    :param limit: first code point that is not checked
+    :return: character class, for example [a-z]
+    '''
+    ranges = []
+    start = None
+    for code in range(limit + 1):
+        if code < limit and predicate(chr(code)):
+            if start is None:
+                start = code
+        elif start is not None:
+            ranges.append(re.escape(chr(start)) + "-" + re.escape(chr(code - 1)))
+            start = None
+    return "[" + "".join(ranges) + "]"
+
+
+# characters escaped by repr() as \x.. or \u.... (non-printable code points below U+10000,
+# excluding \t, \n and \r that have their own escapes) and "�"
+INVALID = re.compile(get_char_class(
+    lambda c: (not c.isprintable() and c not in "\t\n\r") or c == "�", 0x10000))
+ALPHA = re.compile(get_char_class(str.isalpha, sys.maxunicode + 1))
+
+
 def validate_alpha(text: str) -> bool:
     '''
     Performs three validations checking if there are some incorrect characters in a sentence
@@ -41,29 +83,50 @@ def validate_alpha(text: str) -> bool:
     :param text: text to be validated
     :return: validation result
     '''
-    # check for \\x and \\u characters
-    for tok in text:
-        r = repr(tok)
-        if "\\x" in r or "\\u" in r:
-            return False
-    # check for "�" character
-    if "�" in text:
+    if INVALID.search(text):
         return False
-    # check if there is at least one alpha character in a given sentence
-    for tok in text:
-        if tok.isalpha():
-            return True
-    return False
+    return ALPHA.search(text) is not None
+
+
+def validate_alpha_bulk(texts: List[str]) -> List[bool]:
+    '''
+    Performs validate_alpha for a list of sentences. Incorrect characters are searched
+    in one pass over all the sentences.
+
+    :param texts: texts to be validated
+    :return: list of validation results
+    '''
+    result = [True] * len(texts)
+    starts = []
+    position = 0
+    for text in texts:
+        starts.append(position)
+        position += len(text) + 1
+    for match in INVALID.finditer(LINESEP.join(texts)):
+        result[bisect_right(starts, match.start()) - 1] = False
+    search = ALPHA.search
+    for i, text in enumerate(texts):
+        if result[i] and search(text) is None:
+            result[i] = False
+    return result
 
 
 def preprocess_sentence(sentence: str) -> str:
     '''
-    Replaces all multiple spaces in a given sentence with one space
+    Replaces all multiple spaces in a given sentence with one space, the result is the same
+    as re.sub('\\s+', ' ', sentence) (str.isspace and \\s match the same characters)
 
     :param sentence: sentence to be fixed
     :return: fixed sentence
     '''
-    result = re.sub('\s+', ' ', sentence)
+    tokens = sentence.split()
+    if not tokens:
+        return ' ' if sentence else ''
+    result = ' '.join(tokens)
+    if sentence[0].isspace():
+        result = ' ' + result
+    if sentence[-1].isspace():
+        result = result + ' '
     return result
 
 
@@ -84,12 +147,34 @@ def validate_tokens(text: str, min: int, max: int) -> bool:
     return False
 
 
+def check(text: str, params: dict, lang: str, alpha: bool = None) -> str:
+    '''
+    Performs validations that do not depend on other sentences:
+    - validate_alpha
+    - validate tokens (excluding some languages: ZH where we cannot apply filtering based on tokens length)
+
+    :param text: text to be validated
+    :param params: config.json params
+    :param lang: language for which validation will be performed
+    :param alpha: validate_alpha result in case it was already calculated
+    :return: validation error message, empty string if text is correct
+    '''
+    if alpha is None:
+        alpha = validate_alpha(text)
+    if not alpha:
+        return "Alpha validation failed"
+    if lang not in params["excluded_tokens_validation"]:
+        if not validate_tokens(text, params["min_tokens"], params["max_tokens"]):
+            return "Incorrect tokens length"
+    return ""
+
+
 def validate(text: str, context: dict, lang: str) -> Tuple[bool, str]:
     '''
     Main validation function that calls:
     - validate_alpha
     - validate tokens (excluding some languages: ZH where we cannot apply filtering based on tokens length)
-    - exclude duplicated sentences from processed dataset - there is a common map for source and target language.
+    - exclude duplicated sentences from processed dataset - there is a common dedup store for source and target language.
 
     :param text: text to be validated
     :param context: context object with configuration
@@ -97,67 +182,227 @@ def validate(text: str, context: dict, lang: str) -> Tuple[bool, str]:
     :return: validation result
     :return: validation error message
     '''
-    if not validate_alpha(text):
-        return False, "Alpha validation failed"
-    params = context["config"]["params"]
-    if lang not in params["excluded_tokens_validation"]:
-        if not validate_tokens(text, params["min_tokens"], params["max_tokens"]):
-            return False, "Incorrect tokens length"
-    if text in context["map"]:
+    msg = check(text, context["config"]["params"], lang)
+    if msg:
+        return False, msg
+    if not context["map"].add(text):
         return False, "Duplicate sentence"
-    else:
-        context["map"][text] = {}
     return True, ""
 
 
-def get_data_from_file(folder: str, type: str, lang: str) -> List[str]:
+def check_pairs(pairs: List[Tuple[str, str]], params: dict, src_lang: str,
+                tgt_lang: str) -> List[Tuple[str, str, str, str]]:
+    '''
+    Normalises and checks a chunk of sentence pairs, duplicates are not checked
+    because it requires access to all previous sentences. Executed in worker processes
+    when preprocess.py is started with --workers greater than 1.
+
+    :param pairs: list of raw source and target sentences
+    :param params: config.json params
+    :param src_lang: source language for parallel corpus
+    :param tgt_lang: target language for parallel corpus
+    :return: list of normalised source and target sentences with validation error messages
+    '''
+    src = [preprocess_sentence(p[0]) for p in pairs]
+    tgt = [preprocess_sentence(p[1]) for p in pairs]
+    src_alpha = validate_alpha_bulk(src)
+    tgt_alpha = validate_alpha_bulk(tgt)
+    return [(s, t, check(s, params, src_lang, sa), check(t, params, tgt_lang, ta))
+            for s, t, sa, ta in zip(src, tgt, src_alpha, tgt_alpha)]
+
+
+def get_chunks(items: Iterator, size: int) -> Iterator[list]:
+    '''
+    Splits iterator into lists of a given size
+
+    :param items: iterator to be split
+    :param size: chunk size
+    :return: iterator over chunks
+    '''
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def check_parallel(pool: Pool, chunks: Iterator[list], params: dict, src_lang: str,
+                   tgt_lang: str, window: int) -> Iterator[Tuple[str, str, str, str]]:
+    '''
+    Executes check_pairs for chunks in worker processes and returns results in the
+    original order. At most window chunks are read ahead so memory usage stays bounded.
+
+    :param pool: worker processes pool
+    :param chunks: iterator over chunks of raw sentence pairs
+    :param params: config.json params
+    :param src_lang: source language for parallel corpus
+    :param tgt_lang: target language for parallel corpus
+    :param window: maximal number of chunks processed at the same time
+    :return: iterator over check_pairs results
+    '''
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(
+            check_pairs, (chunk, params, src_lang, tgt_lang)))
+        if len(pending) >= window:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+def get_data_from_file(folder: str, type: str, lang: str) -> Iterator[str]:
     '''
     Reads the content of source file with raw parallel corpus for a given language
+    line by line, the file can be gzip compressed (*.[lang].gz)
 
     :param folder: folder that contains a file to be read
     :param type: type of source file: europarl, tatoeba, subtitles
     :param lang: we read only a file for src or tgt language
-    :return: list of strings with sentences
+    :return: iterator over sentences
     '''
     path = folder + "/" + type + "/*."+lang
-    files = glob.glob(path)
+    files = glob.glob(path) + glob.glob(path + ".gz")
     if len(files) != 1:
         raise Exception(f'Problem with finding a file for {path}')
-    with open(files[0], "r", encoding="utf-8") as f:
-        return f.read().split(LINESEP)
+    if files[0].endswith(".gz"):
+        opener = gzip.open
+    else:
+        opener = open
+    with opener(files[0], "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.endswith(LINESEP):
+                line = line[:-1]
+            yield line
+
+
+def write_pair(context: dict, src: str, tgt: str):
+    '''
+    Appends accepted sentence pair to the output files
+
+    :param context: context with opened output files
+    :param src: source language sentence
+    :param tgt: target language sentence
+    '''
+    output = context["output"]
+    if output["count"] > 0:
+        output["src"].write(LINESEP)
+        output["tgt"].write(LINESEP)
+    output["src"].write(src)
+    output["tgt"].write(tgt)
+    output["count"] += 1
+
 
+def record_rejection(context: dict, type: str, counter: int, src: str, tgt: str,
+                     src_msg: str, tgt_msg: str):
+    '''
+    Counts rejected sentence pair by dataset and reason and writes every n-th rejected
+    pair (config/config.json -> params -> rejected_sample) to the compressed JSONL file
 
-def process(folder: str, type: str, src_lang: str, tgt_lang: str, context: dict):
+    :param context: context with statistics and opened rejected pairs file
+    :param type: type of source file: europarl, tatoeba, subtitles
+    :param counter: sentence pair number in the dataset
+    :param src: source language sentence
+    :param tgt: target language sentence
+    :param src_msg: source sentence validation error message
+    :param tgt_msg: target sentence validation error message
+    '''
+    stats = context["stats"][type]
+    stats["rejected"] += 1
+    if src_msg:
+        stats["src " + REASONS[src_msg]] += 1
+    if tgt_msg:
+        stats["tgt " + REASONS[tgt_msg]] += 1
+    rejected = context["rejected"]
+    if rejected["file"] and (stats["rejected"] - 1) % rejected["sample"] == 0:
+        rejected["file"].write(json.dumps({
+            "dataset": type,
+            "sentence": counter,
+            "src": src,
+            "tgt": tgt,
+            "src_reason": REASONS.get(src_msg),
+            "tgt_reason": REASONS.get(tgt_msg)
+        }, ensure_ascii=False) + LINESEP)
+
+
+def get_summary(stats: dict) -> List[str]:
     '''
-    The main processing function
+    Formats preprocessing statistics as a table with one row per dataset
+
+    :param stats: statistics (counters) for each dataset
+    :return: table lines
+    '''
+    columns = ["read", "accepted", "rejected"] + \
+        [side + " " + reason for side in ["src", "tgt"] for reason in REASONS.values()]
+    width = max([len(c) for c in columns] + [len(t) for t in stats] + [12])
+    lines = ["dataset".ljust(width) + "".join(c.rjust(width + 1) for c in columns)]
+    total = Counter()
+    for type, counter in stats.items():
+        total.update(counter)
+        lines.append(type.ljust(width) +
+                     "".join(str(counter[c]).rjust(width + 1) for c in columns))
+    lines.append("total".ljust(width) +
+                 "".join(str(total[c]).rjust(width + 1) for c in columns))
+    return lines
+
+
+def process(folder: str, type: str, src_lang: str, tgt_lang: str, context: dict,
+            sentences: int = 0) -> int:
+    '''
+    The main processing function. Sentence pairs are read, validated and written to the
+    output files one by one, reading stops as soon as the number of sentences configured
+    for the dataset is reached.
 
     :param folder: folder that contains a file to be read
     :param type: type of source file: europarl, tatoeba, subtitles
     :param src_lang: source language for parallel corpus
     :param tgt_lang: target language for parallel corpus
-    :param context: context with processing parameters
+    :param context: context with processing parameters, context["pool"] with worker processes
+                    is used for normalisation and validation when available
+    :param sentences: number of sentences to be selected from the dataset, 0 - means all
+    :return: number of accepted sentence pairs
     '''
-    data = context["data"]
     counter = 0
+    accepted = 0
+    stats = context["stats"].setdefault(type, Counter())
+    params = context["config"]["params"]
     src = get_data_from_file(folder, type, src_lang)
     tgt = get_data_from_file(folder, type, tgt_lang)
-    for item in zip(src, tgt):
-        s = preprocess_sentence(item[0])
-        t = preprocess_sentence(item[1])
-        counter += 1
-        if counter % 1000 == 0:
-            logging.info(f'{counter}')
-        so, sm = validate(s, context, src_lang)
-        to, tm = validate(t, context, tgt_lang)
-        if so and to:
-            data[type]['src'].append(s)
-            data[type]['tgt'].append(t)
-        else:
-            context['log'].append(
-                f'Skipping {type} sentence {counter} / SRC: {s} / TGT: {t} / SRC MSG: {sm} / TGT MSG: {tm}')
-
-
-def preprocess(arg_pipeline):
+    chunks = get_chunks(zip(src, tgt), CHUNK_SIZE)
+    pool = context.get("pool")
+    if pool:
+        checked = check_parallel(pool, chunks, params, src_lang, tgt_lang,
+                                 2 * context["workers"])
+    else:
+        checked = (item for chunk in chunks
+                   for item in check_pairs(chunk, params, src_lang, tgt_lang))
+    try:
+        for s, t, sm, tm in checked:
+            counter += 1
+            if counter % 1000 == 0:
+                logging.info(f'{counter}')
+            # duplicates are checked in the original order, source sentence first
+            if not sm and not context["map"].add(s):
+                sm = "Duplicate sentence"
+            if not tm and not context["map"].add(t):
+                tm = "Duplicate sentence"
+            if not sm and not tm:
+                write_pair(context, s, t)
+                accepted += 1
+                if accepted == sentences:
+                    break
+            else:
+                record_rejection(context, type, counter, s, t, sm, tm)
+    finally:
+        checked.close()
+        src.close()
+        tgt.close()
+    stats["read"] += counter
+    stats["accepted"] += accepted
+    logging.info(f'Rejected {stats["rejected"]} of {counter} {type} sentences.')
+    return accepted
+
+
+def preprocess(arg_pipeline, workers=1):
     logging.info(f'Starting preprocessing: {arg_pipeline}')
 
     t0 = time.time()
@@ -172,10 +417,10 @@ def preprocess(arg_pipeline):
             raise Exception("Pipeline not available")
 
         context = {
-            "data": {},
-            "log": [],
-            "map": {},
-            "config": config
+            "stats": {},
+            "config": config,
+            "workers": workers,
+            "pool": None
         }
 
         pipeline = config["pipelines"][arg_pipeline]
@@ -186,46 +431,56 @@ def preprocess(arg_pipeline):
 
         folder = "./data/source/" + pipeline["source"]
 
-        for type in datasets:
-            context["data"][type] = {
-                "src": [],
-                "tgt": []
-            }
-            process(folder, type, src_lang, tgt_lang, context)
-
         folder_br = "./data/" + arg_pipeline + "/bitext_raw"
         src_file = folder_br + "/" + arg_pipeline + "." + src_lang + ".txt"
         tgt_file = folder_br + "/" + arg_pipeline + "." + tgt_lang + ".txt"
         log_file = folder_br + "/preprocess.log"
+        rejected_file = folder_br + "/rejected.jsonl.gz"
 
         os.makedirs(folder_br, exist_ok=True)
 
-        src_f = open(src_file, 'w', encoding='utf8')
-        tgt_f = open(tgt_file, 'w', encoding='utf8')
-
-        type_count = len(pipeline) - 1
-
-        for i, type in enumerate(datasets):
-            length = len(context["data"][type]["src"])
-
-            sentences = pipeline["sentences"][type]
-
-            if sentences == 0 or sentences > length:
-                sentences = length
-
-            logging.info(f'Saving {sentences} of {type} sentences.')
-
-            src_f.write('\n'.join(context["data"][type]['src'][0:sentences]))
-            tgt_f.write('\n'.join(context["data"][type]['tgt'][0:sentences]))
-            if i < type_count:
-                src_f.write("\n")
-                tgt_f.write("\n")
-
-        src_f.close()
-        tgt_f.close()
+        sample = config["params"]["rejected_sample"]
+        context["rejected"] = {
+            "file": None,
+            "sample": sample
+        }
 
+        context["map"] = create_store(config["params"], folder_br)
+
+        # worker processes, the dedup store and the rejected sentences file are released on error too
+        try:
+            if sample:
+                context["rejected"]["file"] = gzip.open(rejected_file, 'wt', encoding='utf8')
+
+            if workers > 1:
+                context["pool"] = Pool(workers)
+
+            with open(src_file, 'w', encoding='utf8') as src_f, \
+                    open(tgt_file, 'w', encoding='utf8') as tgt_f:
+                context["output"] = {
+                    "src": src_f,
+                    "tgt": tgt_f,
+                    "count": 0
+                }
+                for type in datasets:
+                    sentences = pipeline["sentences"][type]
+                    accepted = process(folder, type, src_lang, tgt_lang, context, sentences)
+                    logging.info(f'Saving {accepted} of {type} sentences.')
+
+            logging.info(summary(context["map"]))
+        finally:
+            if context["pool"]:
+                context["pool"].terminate()
+                context["pool"].join()
+            if context["rejected"]["file"]:
+                context["rejected"]["file"].close()
+            context["map"].close()
+
+        summary_lines = get_summary(context["stats"])
+        for line in summary_lines:
+            logging.info(line)
         with open(log_file, 'w', encoding='utf8') as f:
-            f.write('\n'.join(context['log']))
+            f.write('\n'.join(summary_lines))
 
     except Exception as e:
         logging.error(e)
@@ -242,7 +497,9 @@ if __name__ == '__main__':
         description='Preprocess')
     parser.add_argument('--pipeline', type=str,
                         help='Language pipeline')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used for sentences normalisation and validation')
 
     args = parser.parse_args()
 
-    preprocess(args.pipeline)
\ No newline at end of file
+    preprocess(args.pipeline, args.workers)
\ No newline at end of file
@@ -0,0 +1,96 @@
+'''
+Dynamic int8 quantization of stanza models for processing on cpu (params.quantize). Linear and LSTM
+layers of all loaded processors are quantized once when the worker loads the pipeline. Speedup and
+agreement of quantized models with fp32 models on a sample of pipeline sentences are measured with
+python3 up2/parse.py --pipeline=en-fr --lang=fr --evaluate-quantization
+'''
+import logging
+from typing import List
+import torch
+
+QUANTIZED_MODULES = {torch.nn.Linear, torch.nn.LSTM}
+# version suffix of quantized models, quantized results are cached separately
+VERSION = "int8"
+
+
+def use_quantization(params: dict) -> bool:
+    '''
+    Checks if stanza models are quantized, quantized models run only on cpu
+
+    :param params: config.json params (quantize, gpu)
+    :return: params.quantize
+    '''
+    if params["quantize"] and params["gpu"]:
+        msg = 'Quantization (params.quantize) is available only for processing on cpu (params.gpu=false)'
+        logging.error(msg)
+        raise Exception(msg)
+    return params["quantize"]
+
+
+def quantize_pipeline(nlp) -> List[str]:
+    '''
+    Applies dynamic int8 quantization to linear and LSTM layers of every processor of a loaded
+    stanza pipeline
+
+    :param nlp: stanza.Pipeline
+    :return: names of quantized processors
+    '''
+    quantized = []
+    for name, processor in nlp.processors.items():
+        trainer = getattr(processor, "_trainer", None)
+        model = getattr(trainer, "model", None)
+        if model is None:
+            continue
+        trainer.model = torch.quantization.quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8)
+        quantized.append(name)
+    return quantized
+
+
+def compare_documents(reference: list, documents: list) -> dict:
+    '''
+    Compares documents parsed by quantized models with documents parsed by fp32 models. Words are
+    compared only in documents with the same tokenization.
+
+    :param reference: stanza documents parsed by fp32 models
+    :param documents: the same documents parsed by quantized models
+    :return: dictionary with the number of documents, documents with the same tokenization, compared
+             words and words with the same upos, head, deprel and both head and deprel
+    '''
+    counts = {"documents": 0, "tokenization": 0, "words": 0, "upos": 0, "head": 0, "deprel": 0, "labeled": 0}
+    for r, d in zip(reference, documents):
+        counts["documents"] += 1
+        rwords = [w for s in r.sentences for w in s.words]
+        dwords = [w for s in d.sentences for w in s.words]
+        if [w.text for w in rwords] != [w.text for w in dwords]:
+            continue
+        counts["tokenization"] += 1
+        for a, b in zip(rwords, dwords):
+            counts["words"] += 1
+            counts["upos"] += a.upos == b.upos
+            counts["head"] += a.head == b.head
+            counts["deprel"] += a.deprel == b.deprel
+            counts["labeled"] += a.head == b.head and a.deprel == b.deprel
+    return counts
+
+
+def summary(counts: dict, fp32_seconds: float, int8_seconds: float) -> List[str]:
+    '''
+    Returns evaluation summary to be logged
+
+    :param counts: compare_documents result
+    :param fp32_seconds: parsing time of fp32 models
+    :param int8_seconds: parsing time of quantized models
+    :return: list of lines
+    '''
+    def share(value, total):
+        return 100 * value / total if total else 0
+
+    words = counts["words"]
+    return [
+        f'Quantization: sentences: {counts["documents"]}, fp32: {fp32_seconds:.1f} s, int8: {int8_seconds:.1f} s, '
+        f'speedup: {fp32_seconds / int8_seconds if int8_seconds else 0:.2f}x',
+        f'Same tokenization: {counts["tokenization"]} of {counts["documents"]} sentences '
+        f'({share(counts["tokenization"], counts["documents"]):.1f}%)',
+        f'Agreement on {words} words: UPOS {share(counts["upos"], words):.2f}%, HEAD {share(counts["head"], words):.2f}%, '
+        f'DEPREL {share(counts["deprel"], words):.2f}%, HEAD+DEPREL {share(counts["labeled"], words):.2f}%'
+    ]
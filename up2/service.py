@@ -0,0 +1,378 @@
+'''
+Long-running local service keeping stanza and word alignment models loaded between runs of parse.py
+and wordalignment.py. The service listens on 127.0.0.1:[params.service_port], batches sent by the
+scripts (see service_client.py) are processed with parse.process_batch and wordalignment.process_batch
+and concurrent batches of the same kind and language are merged into one batch. Start the service with
+python3 up2/service.py --langs=en,fr --align
+'''
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+if not os.path.exists("./logs/"):
+    os.makedirs("./logs/")
+
+# configured before parse and wordalignment are imported, so the service logs into its own file
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(message)s',
+    datefmt='%Y/%m/%d %H:%M:%S',
+    level=logging.INFO,
+    handlers=[
+        logging.FileHandler("./logs/service.log"),
+        logging.StreamHandler()
+    ]
+)
+
+import parse
+import wordalignment
+import service_client
+from utils import read_config
+from cpu_planner import describe, get_plan
+from quantization import use_quantization
+
+# time in seconds to wait for concurrent batches before a batch is processed
+WAIT = 0.05
+
+
+def get_key(kind: str, batch_data: dict) -> tuple:
+    '''
+    Returns key of batches that can be merged: parse batches of the same language, pre-pass
+    tokenization and time budget, all alignment batches
+
+    :param kind: parse or align
+    :param batch_data: batch dictionary
+    :return: tuple
+    '''
+    if kind == "parse":
+        return kind, batch_data["lang"], batch_data["tokens"] is None, batch_data["budget"]
+    return kind,
+
+
+class Request:
+    '''
+    Batch waiting for processing, its result is set to the future
+    '''
+
+    def __init__(self, kind: str, batch_data: dict):
+        self.kind = kind
+        self.batch = batch_data
+        self.key = get_key(kind, batch_data)
+        self.future = Future()
+
+
+def split_conllu(conllu: str, count: int) -> List[str]:
+    '''
+    Splits CoNLL-U data of a batch (see parse.join_documents) into sentence entries without sent_id
+
+    :param conllu: CoNLL-U data with sent_id starting from 1
+    :param count: the number of sentences
+    :return: list of CoNLL-U entries
+    '''
+    entries = []
+    position = 0
+    for counter in range(1, count + 1):
+        marker = "# sent_id = " + str(counter) + "\n"
+        if not conllu.startswith(marker, position):
+            raise Exception(f'Sentence {counter} not found in batch result')
+        start = position + len(marker)
+        if counter < count:
+            position = conllu.index("\n# sent_id = " + str(counter + 1) + "\n", start) + 1
+        else:
+            position = len(conllu)
+        entries.append(conllu[start:position])
+    return entries
+
+
+def parse_batches(batches: List[dict]) -> List[dict]:
+    '''
+    Parses several batches as one batch with parse.process_batch and splits the result
+
+    :param batches: parse batch dictionaries with the same key (see get_key)
+    :return: list of results, the same as process_batch results of the batches (batch_save=false)
+    '''
+    merged = dict(batches[0], start=0, save=False, data=[], cached=[])
+    if merged["tokens"] is not None:
+        merged["tokens"] = []
+        merged["dropped"] = []
+    for b in batches:
+        merged["data"] += b["data"]
+        merged["cached"] += b["cached"]
+        if merged["tokens"] is not None:
+            merged["tokens"] += b["tokens"]
+            merged["dropped"] += b["dropped"]
+    result = parse.process_batch(merged)
+
+    total = len(merged["data"])
+    tokenized = result["tokenized"].split("\n") if total else []
+    conllu = split_conllu(result["conllu"], total)
+    results = []
+    offset = 0
+    for b in batches:
+        n = len(b["data"])
+        entries = list(zip(tokenized[offset:offset + n], conllu[offset:offset + n]))
+        dropped = [i for i in range(n) if b["dropped"] and b["dropped"][i]]
+        parsed = [i for i in range(n) if b["cached"][i] is None and i not in dropped]
+        r = parse.join_documents(entries, b["start"])
+        r["index"] = b["index"]
+        r["parsed"] = [(b["data"][i],) + entries[i] for i in parsed]
+        r["quarantine"] = [dict(q, sentence=b["start"] + q["sentence"] - offset) for q in result["quarantine"]
+                           if offset < q["sentence"] <= offset + n]
+        r["metrics"] = dict(result["metrics"], index=b["index"], sentences=n, parsed=len(parsed),
+                            dropped=len(dropped), quarantined=len(r["quarantine"]),
+                            words=sum(len(entries[i][0].split("|||")) for i in parsed if entries[i][0]),
+                            service_sentences=total)
+        results.append(r)
+        offset += n
+    return results
+
+
+def align_batches(batches: List[dict], params: dict, plan: dict) -> List[dict]:
+    '''
+    Aligns several batches as one batch with wordalignment.process_batch and splits the result
+
+    :param batches: alignment batch dictionaries
+    :param params: config.json params of the service
+    :param plan: CPU plan of the service
+    :return: list of results, the same as process_batch results of the batches (batch_save=false)
+    '''
+    if wordalignment.aligner is None:
+        workers = queue.Queue()
+        workers.put(0)
+        wordalignment.init_worker(params["gpu"], workers, plan)
+    merged = dict(batches[0], start=0, save=False, data=[])
+    for b in batches:
+        merged["data"] += b["data"]
+    result = wordalignment.process_batch(merged)
+    results = []
+    offset = 0
+    for b in batches:
+        results.append({"index": b["index"], "data": result["data"][offset:offset + len(b["data"])]})
+        offset += len(b["data"])
+    return results
+
+
+class Batcher:
+    '''
+    Queue of batches sent by concurrent requests, batches are processed one by one in the thread
+    calling run (models are used by one thread only)
+    '''
+
+    def __init__(self, params: dict, plan: dict, wait: float = WAIT):
+        '''
+        :param params: config.json params of the service, batch_size is the max number of sentences
+                       of merged batches
+        :param plan: CPU plan of the service
+        :param wait: time in seconds to wait for concurrent batches
+        '''
+        self.params = params
+        self.plan = plan
+        self.wait = wait
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, kind: str, batch_data: dict) -> dict:
+        '''
+        Adds batch to the queue and waits for its result
+
+        :param kind: parse or align
+        :param batch_data: batch dictionary
+        :return: batch result
+        '''
+        request = Request(kind, batch_data)
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify_all()
+        return request.future.result()
+
+    def take(self) -> List[Request]:
+        '''
+        Takes the first waiting batch and other waiting batches with the same key up to batch_size sentences
+
+        :return: list of requests, empty when the batcher is stopped
+        '''
+        with self.condition:
+            while not self.pending and not self.stopped:
+                self.condition.wait()
+            deadline = time.time() + self.wait
+            while not self.stopped and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            if self.stopped:
+                return []
+            key = self.pending[0].key
+            group = []
+            rest = deque()
+            sentences = 0
+            for request in self.pending:
+                size = len(request.batch["data"])
+                if request.key == key and (not group or sentences + size <= self.params["batch_size"]):
+                    group.append(request)
+                    sentences += size
+                else:
+                    rest.append(request)
+            self.pending = rest
+            return group
+
+    def process(self, group: List[Request]):
+        '''
+        Processes merged batches and sets results of their requests
+        '''
+        s1 = time.time()
+        try:
+            batches = [r.batch for r in group]
+            if group[0].kind == "parse":
+                results = parse_batches(batches)
+            else:
+                results = align_batches(batches, self.params, self.plan)
+        except Exception as e:
+            logging.error(f'Service {group[0].kind} error: {e}')
+            for request in group:
+                request.future.set_exception(e)
+            return
+        for request, result in zip(group, results):
+            request.future.set_result(result)
+        self.batches += 1
+        self.requests += len(group)
+        logging.info(f'Service {group[0].kind}: requests: {len(group)}, '
+                     f'sentences: {sum(len(r.batch["data"]) for r in group)}, time: {time.time() - s1} seconds')
+
+    def run(self):
+        '''
+        Processes batches until the batcher is stopped
+        '''
+        while not self.stopped:
+            group = self.take()
+            if group:
+                self.process(group)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+def create_handler(batcher: Batcher, params: dict):
+    '''
+    Creates HTTP request handler: GET /status, POST /parse and POST /align with JSON batch dictionary
+
+    :param batcher: Batcher processing the batches
+    :param params: config.json params of the service
+    :return: BaseHTTPRequestHandler class
+    '''
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, code: int, body: bytes, content_type: str = "application/json"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/status":
+                self.send_error(404)
+                return
+            status = {
+                "pid": os.getpid(),
+                "params": {"gpu": params["gpu"], "quantize": params["quantize"]},
+                "models": list(parse.pipelines.pipelines),
+                "aligner": wordalignment.aligner is not None,
+                "batches": batcher.batches,
+                "requests": batcher.requests
+            }
+            self.reply(200, json.dumps(status).encode("utf-8"))
+
+        def do_POST(self):
+            if self.path not in ("/parse", "/align"):
+                self.send_error(404)
+                return
+            batch_data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            try:
+                result = batcher.submit(self.path[1:], batch_data)
+            except Exception as e:
+                self.reply(500, str(e).encode("utf-8"), "text/plain; charset=utf-8")
+                return
+            self.reply(200, json.dumps(result, ensure_ascii=False).encode("utf-8"))
+
+        def log_message(self, format, *args):
+            # batches are logged by the batcher
+            pass
+
+    return Handler
+
+
+def serve(langs: List[str] = None, align: bool = False):
+    '''
+    Loads models and serves batches until the service is interrupted (Ctrl+C). Stanza pipelines of other
+    languages are loaded by their first batch and kept within params.pipeline_cache_size.
+
+    :param langs: languages of stanza pipelines loaded at startup
+    :param align: load the word alignment model at startup
+    '''
+    config = read_config()
+    params = config["params"]
+    port = params["service_port"]
+
+    if not port:
+        msg = 'Service port is not set (params.service_port)'
+        logging.error(msg)
+        raise Exception(msg)
+
+    if service_client.get_status(port) is not None:
+        msg = f'Service is already running on port {port}'
+        logging.error(msg)
+        raise Exception(msg)
+
+    s1 = time.time()
+    quantize = use_quantization(params)
+    plan = get_plan(params, 1)
+    logging.info(describe(plan))
+
+    workers = multiprocessing.Queue()
+    workers.put(0)
+    parse.init_worker(None, params["gpu"], workers, plan, parse.PROCESSORS, quantize, params["pipeline_cache_size"])
+    for lang in langs or []:
+        parse.select_pipeline(lang)
+
+    batcher = Batcher(params, plan)
+    if align:
+        align_batches([{"index": 0, "data": [], "batch_size": 0, "pipeline": None}], params, plan)
+
+    server = ThreadingHTTPServer((service_client.HOST, port), create_handler(batcher, params))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info(f'Service listening on {service_client.HOST}:{port}, startup time: {time.time() - s1} seconds')
+
+    try:
+        # batches are processed in the main thread, parse time budget uses SIGALRM
+        batcher.run()
+    except KeyboardInterrupt:
+        logging.info('Service stopped')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Parse and word alignment service')
+    parser.add_argument('--langs', type=str, default=None,
+                        help='comma-separated languages of stanza pipelines loaded at startup')
+    parser.add_argument('--align', action='store_true',
+                        help='load the word alignment model at startup')
+
+    args = parser.parse_args()
+
+    serve(args.langs.split(",") if args.langs else None, args.align)
@@ -0,0 +1,82 @@
+'''
+Client of the local parse and word alignment service (service.py). parse.py and wordalignment.py
+send their batches to the service when it is running on params.service_port (0 - service is not
+used), otherwise models are loaded by their own workers.
+'''
+import json
+import logging
+import urllib.error
+import urllib.request
+
+HOST = "127.0.0.1"
+# time in seconds to wait for the service status
+STATUS_TIMEOUT = 1.0
+# time in seconds to wait for the result of a batch
+REQUEST_TIMEOUT = 3600
+# the service is local, proxy settings of the environment are not used
+OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def get_url(port: int, path: str) -> str:
+    return "http://" + HOST + ":" + str(port) + path
+
+
+def get_status(port: int) -> dict:
+    '''
+    Reads status of the service
+
+    :param port: service port
+    :return: dictionary with service params and loaded models or None if the service is not running
+    '''
+    try:
+        with OPENER.open(get_url(port, "/status"), timeout=STATUS_TIMEOUT) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+
+def available(params: dict) -> bool:
+    '''
+    Checks if batches can be processed by the running service, the service must run with the same
+    gpu and quantize params
+
+    :param params: config.json params (service_port, gpu, quantize)
+    :return: True if the service is used
+    '''
+    port = params["service_port"]
+    if not port:
+        return False
+    status = get_status(port)
+    if status is None:
+        return False
+    for key in ("gpu", "quantize"):
+        if status["params"][key] != params[key]:
+            logging.warning(f'Service on port {port} runs with {key}={status["params"][key]}, service is not used')
+            return False
+    logging.info(f'Using service on port {port}, pid: {status["pid"]}')
+    return True
+
+
+def request(port: int, path: str, batch_data: dict) -> dict:
+    '''
+    Sends batch to the service and waits for its result
+
+    :param port: service port
+    :param path: /parse or /align
+    :param batch_data: batch dictionary
+    :return: batch result
+    '''
+    data = json.dumps(batch_data, ensure_ascii=False).encode("utf-8")
+    req = urllib.request.Request(get_url(port, path), data=data, headers={"Content-Type": "application/json"})
+    try:
+        with OPENER.open(req, timeout=REQUEST_TIMEOUT) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        msg = f'Service error, batch {batch_data["index"]}: {e.read().decode("utf-8", "replace")}'
+        logging.error(msg)
+        raise Exception(msg)
+    except (OSError, ValueError) as e:
+        # the service stopped, did not answer in time or sent an incomplete result
+        msg = f'Service error, batch {batch_data["index"]}: {e}'
+        logging.error(msg)
+        raise Exception(msg)
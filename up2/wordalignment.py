@@ -8,9 +8,15 @@ from conllu import parse_incr
 import time
 from simalign import SentenceAligner
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import multiprocessing
 import torch
 from utils import read_config, set_cuda_device, get_cuda_info
+from checkpoint import Checkpoint, get_manifest, get_run, in_shard, remove_queue_manifests, write_file
+from batch_queue import BatchQueue, drain, get_owner
+from cpu_planner import apply_plan, describe, get_plan
+from prefilter import read_dropped
+import service_client
 import logging
 import os
 import json
@@ -33,22 +39,33 @@ logging.basicConfig(
 )
 
 
-def check_if_result(pipeline: str, index: int):
+def get_checkpoint(pipeline: str, shard_index: int = 0, num_shards: int = 1, owner: str = None,
+                   run: str = None) -> Checkpoint:
     '''
-    Checks if temporary result is available in the file system for a given pipeline, 
-    language and batch index
+    Opens checkpoint manifest of saved batches (config.json parameter batch_save=true) 
+    for a given pipeline and shard or batch queue job
 
     :param pipeline: processing pipeline from config.json file
-    :param lang: source or target language identifier
-    :param index: batch index to be checked
-    :return: information if file is present or not
+    :param shard_index: shard processed by the job
+    :param num_shards: the number of shards
+    :param owner: identifier of the job draining the batch queue, None without queue
+    :param run: run key of the job (see checkpoint.get_run)
+    :return: Checkpoint
     '''
-    folder = "./data/" + pipeline + "/aligned/tmp"
-    s = ""
-    if index:
-        s = str(index).zfill(4) + "."
-    output_file = folder + "/training." + s + "align"
-    return os.path.isfile(output_file)
+    folder = "./data/" + pipeline + "/checkpoint"
+    return Checkpoint(get_manifest(folder, "align", shard_index, num_shards, owner), run)
+
+
+def get_queue(pipeline: str, params: dict) -> BatchQueue:
+    '''
+    Opens batch queue shared by all jobs processing a given pipeline (--queue argument)
+
+    :param pipeline: processing pipeline from config.json file
+    :param params: config.json params (queue_lease, queue_retries)
+    :return: BatchQueue
+    '''
+    path = "./data/" + pipeline + "/checkpoint/align.queue.sqlite"
+    return BatchQueue(path, params["queue_lease"], params["queue_retries"])
 
 
 def save_alignments(pipeline: str, batches: dict, index: int = None, batch_size: int = None):
@@ -59,6 +76,7 @@ def save_alignments(pipeline: str, batches: dict, index: int = None, batch_size:
     :param batches: Word alignment results returned by batch processing to be stored in output file
     :index: batch number (applies only when config.json parameter batch_save=true)
     :batch_size: batch size (applies only when config.json parameter batch_save=true)
+    :return: saved file entry for the checkpoint manifest
     '''
     sentences = []
     for b in batches:
@@ -83,8 +101,29 @@ def save_alignments(pipeline: str, batches: dict, index: int = None, batch_size:
 
     output_file = folder + "/training." + s + "align"
 
-    with open(output_file, 'w', encoding='utf8') as f:
-        f.write('\n'.join(sentences))
+    return write_file(output_file, '\n'.join(sentences))
+
+
+def init_worker(gpu: bool, workers, plan: dict = None):
+    '''
+    Worker initializer, applies the CPU plan and loads the aligner once per worker before the first batch
+
+    :param gpu: processing on gpu or cpu
+    :param workers: queue with worker identifiers, every worker takes one of them
+    :param plan: CPU plan (threads and cores of every worker, see cpu_planner.get_plan)
+    '''
+    global aligner
+    worker = workers.get()
+    apply_plan(plan, worker)
+    if gpu:
+        device = worker % torch.cuda.device_count()
+        set_cuda_device(device)
+        device = "cuda:" + str(device)
+    else:
+        device = "cpu"
+    aligner = SentenceAligner(
+        model="bert", token_type="word", matching_methods="i", device=device)
+    logging.info(f'Initializing aligner, worker: {worker}, device: {device}')
 
 
 def process_batch(batch_data: dict) -> dict:
@@ -96,37 +135,8 @@ def process_batch(batch_data: dict) -> dict:
             config.json None is returned and then merge-align.py script must be used to merge partial
             results into one file
     '''
-    global aligner
-
     index = batch_data["index"]
-    batch_size = batch_data["batch_size"]
     batch_save = batch_data["save"]
-    pipeline = batch_data["pipeline"]
-    processes = batch_data["processes"]
-
-    if batch_save:
-        available = check_if_result(pipeline, index)
-        if available:
-            logging.info(f'Skipping batch {index}')
-            return None
-
-    if not aligner:
-        if processes > 1:
-            current_process = int(
-                multiprocessing.current_process().name.split('-')[1]) - 1
-        else:
-            current_process = 1
-        gpu = batch_data["gpu"]
-        if gpu:
-            device = current_process % torch.cuda.device_count()
-            set_cuda_device(device)
-            device = "cuda:"+str(device)
-        else:
-            device = "cpu"
-        aligner = SentenceAligner(
-            model="bert", token_type="word", matching_methods="i", device=device)
-        logging.info(
-            f'Initializing aligner batch: {index}, process: {current_process}, device: {device}')
 
     data = batch_data["data"]
     processed = []
@@ -134,6 +144,10 @@ def process_batch(batch_data: dict) -> dict:
     s1 = time.time()
 
     for d in data:
+        if d["dropped"]:
+            # pair dropped by parse.py --prefilter, removed by postprocess.py
+            processed.append([])
+            continue
         try:
             alignments = []
             alignments = aligner.get_word_aligns(d["src"], d["tgt"])[TYPE]
@@ -151,18 +165,54 @@ def process_batch(batch_data: dict) -> dict:
     logging.info(f'Processing alignment {index} time: {s2-s1} seconds')
 
     if batch_save:
-        save_alignments(pipeline, [result], index, batch_size)
-        return None
+        return save_batch(result, batch_data)
     else:
         return result
 
 
-def word_alignment(arg_pipeline):
+def save_batch(result: dict, batch_data: dict) -> dict:
+    '''
+    Saves batch alignments to the batch file (batch_save=true)
+
+    :param result: batch processing result
+    :param batch_data: processed batch dictionary
+    :return: dictionary with batch range and saved file entry for the checkpoint manifest
+    '''
+    file = save_alignments(batch_data["pipeline"], [result], batch_data["index"], batch_data["batch_size"])
+    return {"index": batch_data["index"], "start": batch_data["start"], "sentences": len(batch_data["data"]),
+            "files": [file]}
+
+
+def remote_batch(batch_data: dict, port: int) -> dict:
+    '''
+    Processes batch in the running alignment service (service.py), batch file is saved by the calling process
+
+    :param batch_data: batch dictionary
+    :param port: service port (params.service_port)
+    :return: the same result as process_batch
+    '''
+    result = service_client.request(port, "/align", dict(batch_data, save=False))
+    if batch_data["save"]:
+        result = save_batch(result, batch_data)
+    return result
+
+
+def word_alignment(arg_pipeline, shard_index=0, num_shards=1, use_queue=False):
     config = read_config()
 
     if arg_pipeline not in config["pipelines"]:
         raise Exception("Pipeline not available")
 
+    if num_shards < 1 or shard_index < 0 or shard_index >= num_shards:
+        msg = f'Invalid shard: {shard_index} of {num_shards}'
+        logging.error(msg)
+        raise Exception(msg)
+
+    if use_queue and num_shards > 1:
+        msg = 'Batch queue and shards cannot be used together'
+        logging.error(msg)
+        raise Exception(msg)
+
     cuda = get_cuda_info()
 
     logging.info("Cuda: " + json.dumps(cuda))
@@ -192,6 +242,11 @@ def word_alignment(arg_pipeline):
 
     t0 = time.time()
 
+    dropped = set()
+    if config["params"]["prefilter"]:
+        dropped = read_dropped(arg_pipeline)
+        logging.info(f'Prefilter: dropped sentence pairs: {len(dropped)}')
+
     sentences = []
     counter = 0
     for data in zip(source_data, target_data):
@@ -201,7 +256,8 @@ def word_alignment(arg_pipeline):
         sentences.append({
             "counter": counter,
             "src": source_tokens,
-            "tgt": target_tokens
+            "tgt": target_tokens,
+            "dropped": counter in dropped
         })
 
     limit = config["params"]["limit"]
@@ -213,33 +269,93 @@ def word_alignment(arg_pipeline):
 
     processes = config["params"]["processes"]
     batch_size = config["params"]["batch_size"]
-    batch_save = config["params"]["batch_save"]
+    # shard and queue results are always saved in batches and merged by merge_align.py
+    batch_save = config["params"]["batch_save"] or num_shards > 1 or use_queue
     gpu = config["params"]["gpu"]
+    plan = get_plan(config["params"])
+    logging.info(describe(plan))
+
+    ranges = [(i, min(i + batch_size, len(sentences))) for i in range(0, len(sentences), batch_size)]
+    total = len(ranges)
+
+    checkpoint = None
+    batch_queue = None
+    owner = None
+    if use_queue:
+        owner = get_owner()
+        batch_queue = get_queue(arg_pipeline, config["params"])
+        batch_queue.add(ranges, lambda: remove_queue_manifests(get_manifest(folder + "/checkpoint", "align")))
+    if batch_save:
+        checkpoint = get_checkpoint(arg_pipeline, shard_index, num_shards, owner, get_run(ranges))
 
-    counter = 0
-    batches = []
-    for i in range(0, len(sentences), batch_size):
-        counter += 1
-        start = i
-        end = start + batch_size
-        batches.append({
-            "index": counter,
+    def get_batch(index, start, end):
+        return {
+            "index": index,
+            "start": start,
             "data": sentences[start:end],
-            "gpu": gpu,
             "save": batch_save,
             "pipeline": arg_pipeline,
-            "batch_size": batch_size,
-            "processes": processes
-        })
+            "batch_size": batch_size
+        }
 
-    if processes > 1:
-        pool = Pool(processes)
-        result = pool.map(process_batch, batches)
-    else:
-        result = []
-        for batch in batches:
-            batch_result = process_batch(batch)
-            result.append(batch_result)
+    def record(batch_result):
+        checkpoint.record(batch_result["index"], batch_result["start"],
+                          batch_result["sentences"], batch_result["files"], total)
+
+    batches = []
+    if not use_queue:
+        for counter, (start, end) in enumerate(ranges, 1):
+            if not in_shard(counter, shard_index, num_shards):
+                continue
+            if checkpoint is not None and checkpoint.verified(counter, start, end - start):
+                logging.info(f'Skipping batch {counter}')
+                continue
+            batches.append(get_batch(counter, start, end))
+
+    workers = multiprocessing.Queue()
+    for worker in range(processes):
+        workers.put(worker)
+
+    def new_pool(processes):
+        return Pool(processes, initializer=init_worker, initargs=(gpu, workers, plan))
+
+    process = process_batch
+    if service_client.available(config["params"]):
+        # the aligner is loaded by the running service, concurrent batches are sent from threads
+        port = config["params"]["service_port"]
+        new_pool = ThreadPool
+
+        def process(batch):
+            return remote_batch(batch, port)
+    elif processes <= 1:
+        init_worker(gpu, workers, plan)
+
+    result = []
+
+    def collect(results):
+        for batch_result in results:
+            if checkpoint is not None:
+                record(batch_result)
+            else:
+                result.append(batch_result)
+
+    try:
+        if use_queue and processes > 1:
+            # next batch is taken from the queue only when a worker is idle
+            with new_pool(processes) as pool:
+                drain(batch_queue, owner, get_batch, process, record, pool, processes)
+        elif use_queue:
+            drain(batch_queue, owner, get_batch, process, record)
+        elif processes > 1:
+            with new_pool(processes) as pool:
+                collect(pool.imap_unordered(process, batches))
+        else:
+            collect(map(process, batches))
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        if batch_queue is not None:
+            batch_queue.close()
 
     if not batch_save:
         sorted_result = sorted(result, key=lambda d: d['index'])
@@ -258,7 +374,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Parsers evaluation')
     parser.add_argument('--pipeline', type=str)
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='shard processed by this job (from 0 to num-shards - 1)')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='the number of jobs processing the pipeline, batches are assigned to shards in turn')
+    parser.add_argument('--queue', action='store_true',
+                        help='take batches from the batch queue shared by all jobs processing the pipeline')
 
     args = parser.parse_args()
 
-    word_alignment(args.pipeline)
+    word_alignment(args.pipeline, args.shard_index, args.num_shards, args.queue)